@@ -0,0 +1,480 @@
+#!/usr/bin/env python3
+"""
+Background job queue for long-running generation requests
+"""
+
+import heapq
+import itertools
+import math
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+
+
+class JobCancelled(Exception):
+    """Raised inside a running job once cancellation has been requested"""
+
+
+class QueueFull(Exception):
+    """Raised by JobQueue.submit when admission control rejects a job"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def parse_weights(value):
+    """Parse "name:weight,name:weight" into a dict of positive floats"""
+    weights = {}
+    for item in (value or '').split(','):
+        name, _, weight = item.strip().rpartition(':')
+        if not name:
+            continue
+        weight = float(weight)
+        if weight <= 0:
+            raise ValueError(f'Weight for {name!r} must be positive')
+        weights[name] = weight
+    return weights
+
+
+def parse_classes(value, classes):
+    """Parse "name:class,name:class" into a dict, checking every class is known"""
+    mapping = {}
+    for item in (value or '').split(','):
+        name, _, priority = item.strip().rpartition(':')
+        if not name:
+            continue
+        if priority not in classes:
+            raise ValueError(f"Priority for {name!r} must be one of {', '.join(classes)}")
+        mapping[name] = priority
+    return mapping
+
+
+class Job:
+    """A single unit of work tracked by the job queue"""
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+
+    FINISHED_STATES = (SUCCEEDED, FAILED, CANCELLED)
+
+    def __init__(self, func, args=(), kwargs=None):
+        self.id = uuid.uuid4().hex
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.client = ''
+        self.priority = None
+        self.cost = 1
+        # Identical jobs submitted while this one is queued or running attach to it
+        # as followers; they take no worker and finish with this job's result
+        self.coalesce_key = None
+        self.leader = None
+        self.followers = []
+        self.status = Job.QUEUED
+        self.stage = None
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.events = []
+        self.events_closed = False
+        self._cancel_event = threading.Event()
+        self._events_changed = threading.Condition()
+
+    @property
+    def finished(self):
+        return self.status in Job.FINISHED_STATES
+
+    @property
+    def cancel_requested(self):
+        return self._cancel_event.is_set()
+
+    def check_cancelled(self):
+        """Raise JobCancelled if the job has been asked to stop"""
+        if self._cancel_event.is_set():
+            raise JobCancelled()
+
+    def set_stage(self, stage):
+        """Move the job to a new pipeline stage, honouring pending cancellation"""
+        self.check_cancelled()
+        self.stage = stage
+        for follower in list(self.followers):
+            follower.stage = stage
+        self.emit('stage', stage=stage)
+
+    def emit(self, event, **data):
+        """Record a progress event, forward it to followers and wake up anyone streaming this job"""
+        with self._events_changed:
+            self.events.append({'id': len(self.events), 'event': event,
+                                'data': dict(data, elapsed=round(time.time() - self.created_at, 3))})
+            if event in Job.FINISHED_STATES:
+                self.events_closed = True
+            self._events_changed.notify_all()
+        for follower in list(self.followers):
+            follower.emit(event, **data)
+
+    def wait_for_events(self, after=0, timeout=None):
+        """
+        Return events with an id >= after, waiting up to timeout seconds for
+        new ones. An empty list means the wait timed out, or, once events_closed
+        is set, that the caller has already seen every event. The final event
+        of a job is always one of the finished states.
+        """
+        with self._events_changed:
+            if len(self.events) <= after and not self.events_closed:
+                self._events_changed.wait(timeout)
+            return self.events[after:]
+
+    def to_dict(self):
+        """Serialize the job for the status endpoint"""
+        return {
+            'job_id': self.id,
+            'status': self.status,
+            'stage': self.stage,
+            'priority': self.priority,
+            'coalesced_with': self.leader.id if self.leader is not None else None,
+            'cancel_requested': self.cancel_requested,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'result': self.result,
+            'error': self.error,
+        }
+
+
+class JobQueue:
+    """
+    Runs submitted jobs on a bounded pool of worker threads.
+
+    Workers are started lazily on the first submission so that importing the
+    API module (e.g. in tests) does not spawn threads.
+
+    Admission control: at most max_pending jobs may wait in the queue (and at
+    most max_pending_per_client per client); beyond that submit raises
+    QueueFull with an estimated Retry-After. Waiting jobs are served by
+    self-clocked weighted fair queuing over (priority, client) flows, so a
+    client with many queued jobs only gets its weighted share of the workers
+    and interactive requests overtake bulk batch work without starving it.
+
+    Coalescing: a job submitted with the coalesce_key of a job that is still
+    queued or running attaches to that job instead of being queued. It takes
+    no worker and no queue slot, mirrors the other job's progress and finishes
+    with its result. If the job it is attached to is cancelled, the first
+    remaining duplicate is queued in its place.
+    """
+
+    DEFAULT_PRIORITY_WEIGHTS = {'interactive': 4.0, 'batch': 1.0}
+
+    def __init__(self, workers=2, max_history=1000, max_pending=0, max_pending_per_client=0,
+                 priority_weights=None, client_weights=None, on_start=None):
+        self.workers = max(1, int(workers))
+        self.max_history = max(1, int(max_history))
+        self.max_pending = max(0, int(max_pending))
+        self.max_pending_per_client = max(0, int(max_pending_per_client))
+        self.priority_weights = dict(priority_weights or self.DEFAULT_PRIORITY_WEIGHTS)
+        self.client_weights = dict(client_weights or {})
+        # Called with each job as a worker picks it up (e.g. to record its queue wait)
+        self.on_start = on_start
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+        self._threads = []
+        self._heap = []
+        self._sequence = itertools.count()
+        self._virtual_time = 0.0
+        self._flow_finish = {}
+        self._leaders = {}
+        self._pending = Counter()
+        self._service_seconds = None
+        self._wait_seconds = None
+
+    @property
+    def default_priority(self):
+        return next(iter(self.priority_weights))
+
+    def submit(self, func, *args, client='', priority=None, cost=1, coalesce_key=None, **kwargs):
+        """
+        Enqueue func(job, *args, **kwargs) and return the Job immediately.
+
+        Args:
+            client: identity the job is accounted to for fair queuing (API key or IP)
+            priority: one of the configured priority classes (defaults to the first)
+            cost: relative amount of work, e.g. the number of images to render
+            coalesce_key: jobs with equal keys share one run while the first is in flight
+
+        Raises:
+            ValueError: unknown priority class
+            QueueFull: the queue or the client's share of it is full
+        """
+        priority = priority or self.default_priority
+        if priority not in self.priority_weights:
+            raise ValueError(f"Priority must be one of {', '.join(self.priority_weights)}")
+        job = Job(func, args, kwargs)
+        job.client = client
+        job.priority = priority
+        job.cost = max(1, cost)
+        job.coalesce_key = coalesce_key
+        with self._lock:
+            leader = self._leaders.get(coalesce_key) if coalesce_key is not None else None
+            if leader is not None:
+                self._jobs[job.id] = job
+                self._prune()
+                self._attach(job, leader)
+                return job
+
+            depth = sum(self._pending.values())
+            if self.max_pending and depth >= self.max_pending:
+                raise QueueFull('Generation queue is full', self._retry_after(depth))
+            client_depth = sum(count for (_, name), count in self._pending.items() if name == client)
+            if self.max_pending_per_client and client_depth >= self.max_pending_per_client:
+                raise QueueFull('Too many queued jobs for this client', self._retry_after(client_depth))
+
+            self._jobs[job.id] = job
+            self._prune()
+            self._ensure_workers()
+            self._enqueue(job)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def counts(self):
+        """Number of tracked jobs in each state"""
+        with self._lock:
+            counts = {status: 0 for status in (Job.QUEUED, Job.RUNNING) + Job.FINISHED_STATES}
+            for job in self._jobs.values():
+                counts[job.status] += 1
+            return counts
+
+    def depths(self):
+        """Number of queued jobs per priority class"""
+        with self._lock:
+            depths = {priority: 0 for priority in self.priority_weights}
+            for (priority, _), count in self._pending.items():
+                depths[priority] += count
+            return depths
+
+    def position(self, job):
+        """Number of queued jobs that will start before this one, or None if it is not queued"""
+        with self._lock:
+            if job.status != Job.QUEUED:
+                return None
+            # A coalesced job starts with the job it is attached to
+            job = job.leader or job
+            return sum(1 for tag, sequence, other in self._heap
+                       if other.status == Job.QUEUED and (tag, sequence) < job.queue_key)
+
+    def stats(self):
+        """Queue depth, limits and recent wait and service times"""
+        depths = self.depths()
+        with self._lock:
+            depth = sum(depths.values())
+            return {
+                'depth': depth,
+                'depth_by_priority': depths,
+                'clients': len({client for _, client in self._pending}),
+                'max_pending': self.max_pending,
+                'max_pending_per_client': self.max_pending_per_client,
+                'workers': self.workers,
+                'priority_weights': self.priority_weights,
+                'mean_wait_seconds': self._rounded(self._wait_seconds),
+                'mean_service_seconds': self._rounded(self._service_seconds),
+                'estimated_wait_seconds': self._estimated_wait(depth),
+            }
+
+    def cancel(self, job_id):
+        """
+        Cancel a job. Queued jobs are cancelled immediately; running jobs stop
+        at their next stage boundary. Returns the Job or None if unknown.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.finished:
+                return job
+            job._cancel_event.set()
+            if job.leader is not None:
+                # A coalesced job holds no worker, so it stops at once
+                if job in job.leader.followers:
+                    job.leader.followers.remove(job)
+                job.status = Job.CANCELLED
+                job.finished_at = time.time()
+                job.emit(Job.CANCELLED)
+            elif job.status == Job.QUEUED:
+                self._release(job)
+                job.status = Job.CANCELLED
+                job.finished_at = time.time()
+                job.emit(Job.CANCELLED)
+                self._hand_over(job)
+            return job
+
+    @staticmethod
+    def _rounded(value):
+        return None if value is None else round(value, 3)
+
+    def _estimated_wait(self, ahead):
+        """Seconds until a job with `ahead` jobs in front of it would start (caller holds the lock)"""
+        if self._service_seconds is None:
+            return None
+        return round(self._service_seconds * ahead / self.workers, 3)
+
+    def _retry_after(self, ahead):
+        """Whole seconds a rejected client should wait before retrying (caller holds the lock)"""
+        estimate = self._estimated_wait(ahead + 1)
+        return max(1, math.ceil(estimate if estimate is not None else 5))
+
+    def _enqueue(self, job):
+        """Give a job its fair-queuing finish tag and push it onto the heap (caller holds the lock)"""
+        flow = (job.priority, job.client)
+        weight = self.priority_weights[job.priority] * self.client_weights.get(job.client, 1.0)
+        start = max(self._virtual_time, self._flow_finish.get(flow, 0.0))
+        job.finish_tag = start + job.cost / weight
+        self._flow_finish[flow] = job.finish_tag
+        self._pending[flow] += 1
+        if job.coalesce_key is not None:
+            self._leaders[job.coalesce_key] = job
+        job.emit(Job.QUEUED)
+        job.queue_key = (job.finish_tag, next(self._sequence))
+        heapq.heappush(self._heap, job.queue_key + (job,))
+        self._ready.notify()
+
+    def _attach(self, job, leader):
+        """Make job follow an identical queued or running job (caller holds the lock)"""
+        job.leader = leader
+        job.emit(Job.QUEUED)
+        job.emit('coalesced', job_id=leader.id)
+        leader.followers.append(job)
+        if leader.status == Job.RUNNING:
+            job.status = Job.RUNNING
+            job.started_at = time.time()
+            job.stage = leader.stage
+            job.emit(Job.RUNNING)
+
+    def _forget(self, job):
+        """Stop new duplicates from attaching to a job (caller holds the lock)"""
+        if job.coalesce_key is not None and self._leaders.get(job.coalesce_key) is job:
+            del self._leaders[job.coalesce_key]
+
+    def _hand_over(self, job):
+        """
+        Queue the first follower of a cancelled job in its place, with the
+        remaining followers attached to it (caller holds the lock)
+        """
+        self._forget(job)
+        followers, job.followers = job.followers, []
+        if not followers:
+            return
+        leader = followers[0]
+        leader.leader = None
+        leader.followers = followers[1:]
+        for follower in followers:
+            follower.status = Job.QUEUED
+            follower.started_at = None
+            follower.stage = None
+        for follower in leader.followers:
+            follower.leader = leader
+        self._ensure_workers()
+        self._enqueue(leader)
+
+    def _complete_follower(self, follower, leader):
+        """Finish a follower with its leader's outcome (caller holds the lock)"""
+        if follower.finished:
+            return
+        follower.status = leader.status
+        follower.error = leader.error
+        follower.result = dict(leader.result, coalesced=True) if isinstance(leader.result, dict) else leader.result
+        follower.started_at = follower.started_at or leader.started_at
+        follower.finished_at = time.time()
+        follower.emit(follower.status, result=follower.result, error=follower.error)
+
+    def _release(self, job):
+        """Remove a queued job from the pending accounting (caller holds the lock)"""
+        flow = (job.priority, job.client)
+        self._pending[flow] -= 1
+        if self._pending[flow] <= 0:
+            del self._pending[flow]
+            # An idle flow restarts from the current virtual time anyway
+            if self._flow_finish.get(flow, 0.0) <= self._virtual_time:
+                self._flow_finish.pop(flow, None)
+
+    def _ensure_workers(self):
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(
+                target=self._worker,
+                name=f'job-worker-{len(self._threads)}',
+                daemon=True
+            )
+            self._threads.append(thread)
+            thread.start()
+
+    def _prune(self):
+        """Drop the oldest finished jobs once the history limit is exceeded"""
+        excess = len(self._jobs) - self.max_history
+        if excess <= 0:
+            return
+        for job_id in [job_id for job_id, job in self._jobs.items() if job.finished][:excess]:
+            del self._jobs[job_id]
+
+    def _next_job(self):
+        """Wait for the queued job with the smallest finish tag and mark it running"""
+        with self._ready:
+            while True:
+                while not self._heap:
+                    self._ready.wait()
+                _, _, job = heapq.heappop(self._heap)
+                # Cancelled jobs stay in the heap until they reach the front
+                if job.status == Job.QUEUED:
+                    break
+            self._virtual_time = job.finish_tag
+            self._release(job)
+            job.status = Job.RUNNING
+            job.started_at = time.time()
+            for follower in job.followers:
+                follower.status = Job.RUNNING
+                follower.started_at = job.started_at
+            self._wait_seconds = self._average(self._wait_seconds, job.started_at - job.created_at)
+        return job
+
+    @staticmethod
+    def _average(previous, value, alpha=0.2):
+        """Exponentially weighted moving average"""
+        return value if previous is None else previous + alpha * (value - previous)
+
+    def _worker(self):
+        while True:
+            self._run(self._next_job())
+
+    def _run(self, job):
+        job.emit(Job.RUNNING)
+        try:
+            if self.on_start is not None:
+                self.on_start(job)
+            job.result = job.func(job, *job.args, **job.kwargs)
+            job.status = Job.SUCCEEDED
+        except JobCancelled:
+            job.status = Job.CANCELLED
+        except Exception as e:
+            print(f"Job {job.id} failed: {e}")
+            job.error = str(e)
+            job.status = Job.FAILED
+        finally:
+            job.finished_at = time.time()
+            with self._lock:
+                self._service_seconds = self._average(self._service_seconds, job.finished_at - job.started_at)
+                if job.status == Job.CANCELLED:
+                    # Duplicates of a cancelled job still want their images
+                    self._hand_over(job)
+                    followers = []
+                else:
+                    self._forget(job)
+                    followers, job.followers = job.followers, []
+            job.emit(job.status, result=job.result, error=job.error)
+            with self._lock:
+                for follower in followers:
+                    self._complete_follower(follower, job)
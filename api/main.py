@@ -7,14 +7,20 @@ import os
 import subprocess
 import sys
 import json
+import hashlib
+from functools import lru_cache
 from pathlib import Path
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, abort, request, jsonify, send_from_directory, stream_with_context
 from werkzeug.utils import secure_filename
 
 import sys
 import os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from config import Config
+from api.jobs import Job, JobQueue, QueueFull, parse_classes, parse_weights
+
+# The generation utilities live in utils/ as standalone scripts
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'utils'))
 
 app = Flask(__name__)
 app.config.from_object(Config)
@@ -26,6 +32,57 @@ Config.init_app(app)
 IMAGES_DIR = Config.GENERATED_IMAGES_DIR
 os.makedirs(IMAGES_DIR, exist_ok=True)
 
+# Generated images are never rewritten, so browsers may cache them for a year
+IMAGE_MAX_AGE = 365 * 24 * 3600
+
+def _register_metrics():
+    """Expose job queue and Draw Things backend state alongside the pipeline metrics"""
+    from metrics import REGISTRY, Gauge, Histogram
+    from gen_images import get_scheduler
+
+    jobs = REGISTRY.register(Gauge('pixelart_jobs', 'Tracked generation jobs by status', ['status']))
+    jobs.set_function(lambda: {(status,): count for status, count in job_queue.counts().items()})
+    depth = REGISTRY.register(Gauge('pixelart_queue_depth', 'Jobs waiting in the queue by priority', ['priority']))
+    depth.set_function(lambda: {(priority,): count for priority, count in job_queue.depths().items()})
+    wait = REGISTRY.register(Histogram(
+        'pixelart_queue_wait_seconds', 'Time jobs spent queued before a worker started them', ['priority']))
+    job_queue.on_start = lambda job: wait.observe(job.started_at - job.created_at, priority=job.priority)
+    backend_in_flight = REGISTRY.register(Gauge(
+        'pixelart_backend_in_flight', 'Requests in flight per Draw Things backend', ['backend']))
+    backend_in_flight.set_function(
+        lambda: {(backend['url'],): backend['in_flight'] for backend in get_scheduler().stats()})
+    backend_healthy = REGISTRY.register(Gauge(
+        'pixelart_backend_healthy', 'Whether each Draw Things backend is healthy (1) or not (0)', ['backend']))
+    backend_healthy.set_function(
+        lambda: {(backend['url'],): int(backend['healthy']) for backend in get_scheduler().stats()})
+
+# Only the API keys configured here are trusted; any other client is queued by IP
+API_KEY_WEIGHTS = {f'key:{key}': weight for key, weight in parse_weights(Config.API_KEY_WEIGHTS).items()}
+
+# Generation requests run in the background on a bounded worker pool, with a
+# bounded, per-client fair queue in front of it
+job_queue = JobQueue(
+    workers=Config.JOB_WORKERS,
+    max_history=Config.JOB_HISTORY_LIMIT,
+    max_pending=Config.JOB_QUEUE_LIMIT,
+    max_pending_per_client=Config.JOB_CLIENT_QUEUE_LIMIT,
+    priority_weights=parse_weights(Config.JOB_PRIORITY_WEIGHTS),
+    client_weights=API_KEY_WEIGHTS,
+)
+
+# The priority class of each trusted key's generation jobs (everyone else gets the default)
+API_KEY_PRIORITIES = {f'key:{key}': priority for key, priority
+                      in parse_classes(Config.API_KEY_PRIORITIES, job_queue.priority_weights).items()}
+_unknown_keys = set(API_KEY_PRIORITIES) - set(API_KEY_WEIGHTS)
+if _unknown_keys:
+    raise ValueError(f"API_KEY_PRIORITIES lists keys missing from API_KEY_WEIGHTS: "
+                     f"{', '.join(sorted(key[4:] for key in _unknown_keys))}")
+
+_register_metrics()
+
+# Directory for packed texture atlases, one subdirectory per atlas job
+ATLAS_DIR = Config.ATLAS_DIR
+
 @app.route('/')
 def index():
     """Serve the main HTML page"""
@@ -39,16 +96,94 @@ def index():
     if not os.path.exists(index_path):
         index_path = os.path.join(root_dir, 'frontend', 'index.html')
         if os.path.exists(index_path):
-            return send_from_directory(os.path.join(root_dir, 'frontend'), 'index.html')
+            return render_index(os.path.join(root_dir, 'frontend'))
         else:
             # Return a simple error page if index.html is not found
             return '<h1>Pixel Art Generator</h1><p>Index file not found. Check if frontend/index.html exists.</p>', 404
     
-    return send_from_directory(root_dir, 'index.html')
+    return render_index(root_dir)
+
+def render_index(directory):
+    """Return index.html with server-side limits filled in, so the form matches the API"""
+    with open(os.path.join(directory, 'index.html'), encoding='utf-8') as f:
+        html = f.read()
+    return html.replace('__MAX_VARIANTS__', str(Config.MAX_VARIANTS))
+
+def run_generation(job, user_description, negative_requirements='', seed=-1, variants=1):
+    """
+    Run the prompt and image stages for a queued generation job.
+
+    Everything the job needs is carried in an in-memory generation record, so
+    concurrent jobs never share a scratch file or guess at each other's images.
+    """
+    from pipeline import GenerationPipeline, GenerationRequest
+
+    request = GenerationRequest(user_description, negative_requirements, seed, variants)
+    result = GenerationPipeline(IMAGES_DIR).run(request, on_stage=job.set_stage, on_event=job.emit)
+
+    data = result.to_dict()
+    data['image_url'] = f"/images/{data['image_filename']}"
+    data['variants'] = [
+        {
+            'image_filename': filename,
+            'image_url': f'/images/{filename}',
+            'renditions': {name: f'/images/{derived}' for name, derived in renditions.items()},
+        }
+        for filename, renditions in zip(data.pop('image_filenames'), data.pop('renditions'))
+    ]
+    return data
+
+def run_atlas_pack(job, filenames, rendition=None, padding=Config.ATLAS_PADDING,
+                   max_size=Config.ATLAS_MAX_SIZE, trim=False):
+    """Pack generated images into texture atlases for an atlas job"""
+    from atlas import collect_images, pack_atlases
+    from image_store import resolve
+
+    job.set_stage('pack')
+    if filenames:
+        paths = [resolve(IMAGES_DIR, filename) for filename in filenames]
+    else:
+        paths = collect_images(IMAGES_DIR, rendition)
+    results = pack_atlases(paths, Path(ATLAS_DIR) / job.id, max_size=max_size, padding=padding, trim=trim)
+    return {
+        'atlases': [
+            {
+                'image_url': f"/atlases/{job.id}/{result['image'].name}",
+                'frames_url': f"/atlases/{job.id}/{result['frames'].name}",
+                'width': result['size'][0],
+                'height': result['size'][1],
+                'count': result['count'],
+            }
+            for result in results
+        ]
+    }
+
+def client_identity():
+    """The identity a request is queued under: its API key if that key is configured, else its IP"""
+    client = f"key:{request.headers.get('X-API-Key', '')}"
+    return client if client in API_KEY_WEIGHTS else f'ip:{request.remote_addr}'
+
+def client_priority(client):
+    """The priority class a client's generation jobs are queued in"""
+    return API_KEY_PRIORITIES.get(client, job_queue.default_priority)
+
+def queue_full_response(error):
+    """429 with Retry-After for a job rejected by admission control"""
+    response = jsonify({'error': str(error), 'retry_after': error.retry_after})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
+def format_sse(event):
+    """Format a job event as a server-sent event frame"""
+    return f"id: {event['id']}\nevent: {event['event']}\ndata: {json.dumps(event['data'])}\n\n"
 
 @app.route('/generate', methods=['POST'])
 def generate_image():
-    """Generate an image based on user prompts"""
+    """Queue an image generation job and return its ID immediately"""
+    from metrics import COALESCED_REQUESTS
+    from singleflight import coalesce_enabled, request_key
+
     try:
         data = request.get_json()
         
@@ -59,104 +194,270 @@ def generate_image():
         if not user_description:
             return jsonify({'error': 'Prompt is required'}), 400
         
-        # Import and run the generation functions directly
-        print("Generating prompts and image...")
+        # Pinning a seed makes the request deterministic and therefore cacheable
+        seed = data.get('seed')
+        if seed is None or seed == '':
+            seed = -1
         try:
-            # Import the required functions
-            import sys
-            import os
-            utils_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'utils')
-            sys.path.insert(0, utils_path)
-                    
-            from gen_prompt import generate_stable_diffusion_prompt, save_prompts_to_template
-            from gen_images import load_prompt_from_json, call_draw_things_api, save_image
-                    
-            # Generate prompts
-            positive_prompt, negative_prompt = generate_stable_diffusion_prompt(user_description, negative_requirements)
-                    
-            # Save prompts to template
-            save_prompts_to_template(positive_prompt, negative_prompt, "prompt.json")
-                    
-            # Load the saved prompts to get all parameters
-            positive_prompt, negative_prompt, steps, cfg = load_prompt_from_json("prompt.json")
-                    
-            # Generate image using the Draw Things API
-            img = call_draw_things_api(
-                prompt=positive_prompt,
-                negative_prompt=negative_prompt,
-                steps=steps,
-                cfg=cfg
-            )
-                    
-            if img is None:
-                return jsonify({'error': 'Image generation failed - check if Draw Things API is running'}), 500
-                    
-            # Save the generated image
-            save_image(img)  # Uses config-defined directory
-                    
-        except ImportError as e:
-            print(f"Import error: {e}")
-            return jsonify({'error': f'Import failed: {str(e)}'}), 500
-        except Exception as e:
-            print(f"Generation error: {e}")
-            return jsonify({'error': f'Generation failed: {str(e)}'}), 500
-        
-        # Read the generated prompt.json to get the prompts
-        # The file is created in the project root directory
-        project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-        prompt_file = Path(project_root) / 'prompt.json'
+            seed = int(seed)
+        except (TypeError, ValueError):
+            return jsonify({'error': 'Seed must be an integer'}), 400
+        if seed < 0:
+            seed = -1
         
-        # Check if the file exists in project root first, otherwise check current directory
-        if not prompt_file.exists():
-            # Try to find it in the current directory
-            prompt_file = Path('prompt.json')
+        # All variants come from one prompt expansion and one txt2img request
+        variants = data.get('variants')
+        if variants is None or variants == '':
+            variants = 1
+        try:
+            variants = int(variants)
+        except (TypeError, ValueError):
+            return jsonify({'error': 'Variants must be an integer'}), 400
+        if not 1 <= variants <= Config.MAX_VARIANTS:
+            return jsonify({'error': f'Variants must be between 1 and {Config.MAX_VARIANTS}'}), 400
         
-        if prompt_file.exists():
-            with open(prompt_file, 'r', encoding='utf-8') as f:
-                prompt_data = json.load(f)
-            positive_prompt = prompt_data.get('positive', '')
-            negative_prompt = prompt_data.get('negative', '')
-            steps = prompt_data.get('steps', 8)
-            cfg = prompt_data.get('cfg', 10)
-        else:
-            positive_prompt = ""
-            negative_prompt = ""
-            steps = 8
-            cfg = 10
+        # The priority class comes from the trusted client identity, never from the request
+        client = client_identity()
+        priority = client_priority(client)
         
-        # Find the most recently generated image
-        # Use the configured image directory path
-        image_files = []
-        for ext in ['.png', '.jpg', '.jpeg']:
-            image_files.extend(list(Path(IMAGES_DIR).glob(f'*{ext}')))
+        # With COALESCE_MODE=pipeline, a request identical to one still queued or
+        # running attaches to that job and shares its result without using a worker
+        coalesce_key = None
+        if coalesce_enabled('pipeline'):
+            coalesce_key = request_key(user_description, negative_requirements, seed=seed, variants=variants)
         
-        if not image_files:
-            return jsonify({'error': 'No image was generated'}), 500
-            
-        # Get the most recent image
-        latest_image = max(image_files, key=lambda x: x.stat().st_mtime)
-        image_filename = latest_image.name
+        try:
+            job = job_queue.submit(run_generation, user_description, negative_requirements, seed, variants,
+                                   client=client, priority=priority, cost=variants,
+                                   coalesce_key=coalesce_key)
+        except QueueFull as e:
+            return queue_full_response(e)
+        if job.leader is not None:
+            COALESCED_REQUESTS.inc(stage='pipeline')
         
         return jsonify({
             'success': True,
-            'image_url': f'/images/{image_filename}',
-            'image_filename': image_filename,
-            'positive_prompt': positive_prompt,
-            'negative_prompt': negative_prompt,
-            'steps': steps,
-            'cfg': cfg
-        })
+            'job_id': job.id,
+            'status': job.status,
+            'status_url': f'/jobs/{job.id}'
+        }), 202
         
     except Exception as e:
         print(f"Exception in generate_image: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Report the status and, once finished, the result of a generation job"""
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    data = job.to_dict()
+    if job.status == Job.QUEUED:
+        data['queue_position'] = job_queue.position(job)
+    return jsonify(data)
+
+@app.route('/jobs/<job_id>/events', methods=['GET'])
+def stream_job_events(job_id):
+    """Stream a job's progress events (stage transitions, timings, previews) as server-sent events"""
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+
+    # EventSource reconnects send the last event they saw
+    last_event_id = request.headers.get('Last-Event-ID', '')
+    start = int(last_event_id) + 1 if last_event_id.isdigit() else 0
+
+    def generate():
+        position = start
+        while True:
+            events = job.wait_for_events(position, timeout=15)
+            if not events:
+                if job.events_closed:
+                    # Reconnected after the final event: nothing more will come
+                    return
+                # Comment line keeps proxies from closing an idle stream
+                yield ': keep-alive\n\n'
+                continue
+            for event in events:
+                yield format_sse(event)
+            position += len(events)
+            if events[-1]['event'] in Job.FINISHED_STATES:
+                return
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.route('/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    """Cancel a queued or running generation job"""
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    if job.finished:
+        return jsonify({'error': f'Job already {job.status}', **job.to_dict()}), 409
+    job = job_queue.cancel(job_id)
+    return jsonify(job.to_dict())
+
+@app.route('/queue', methods=['GET'])
+def queue_status():
+    """Report the generation queue depth, limits and recent wait times"""
+    return jsonify(job_queue.stats())
+
+@app.route('/backends', methods=['GET'])
+def list_backends():
+    """Report each Draw Things backend and the LM Studio circuit breaker"""
+    from gen_images import get_scheduler
+    from backend_client import get_lm_studio_breaker
+
+    return jsonify({'backends': get_scheduler().stats(), 'lm_studio': get_lm_studio_breaker().stats()})
+
+@app.route('/metrics', methods=['GET'])
+def export_metrics():
+    """Expose pipeline metrics in the Prometheus text exposition format"""
+    from metrics import CONTENT_TYPE, REGISTRY
+
+    return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
+@app.route('/images', methods=['GET'])
+def list_images():
+    """Page through generated images, newest first, optionally filtered by prompt text"""
+    from image_index import get_image_index
+
+    try:
+        limit = min(max(int(request.args.get('limit', 50)), 1), 500)
+        cursor = request.args.get('cursor')
+        cursor = int(cursor) if cursor else None
+    except ValueError:
+        return jsonify({'error': 'limit and cursor must be integers'}), 400
+
+    images, next_cursor = get_image_index().list(limit=limit, cursor=cursor, query=request.args.get('q'))
+    for image in images:
+        image['url'] = f"/images/{image['filename']}"
+
+    return jsonify({
+        'images': images,
+        'next_cursor': next_cursor
+    })
+
+@app.route('/atlases', methods=['POST'])
+def create_atlas():
+    """Queue a job packing generated images into power-of-two texture atlases"""
+    from image_store import resolve
+
+    data = request.get_json(silent=True) or {}
+
+    filenames = data.get('filenames') or []
+    rendition = data.get('rendition')
+    if not isinstance(filenames, list) or any(
+            not isinstance(filename, str) or secure_filename(filename) != filename for filename in filenames):
+        return jsonify({'error': 'filenames must be a list of image filenames'}), 400
+    if rendition not in (None, 'native', 'alpha', 'indexed'):
+        return jsonify({'error': 'rendition must be one of native, alpha, indexed'}), 400
+    missing = [filename for filename in filenames if resolve(IMAGES_DIR, filename) is None]
+    if missing:
+        return jsonify({'error': 'Images not found', 'missing': missing}), 404
+
+    try:
+        padding = int(data.get('padding', Config.ATLAS_PADDING))
+        max_size = int(data.get('max_size', Config.ATLAS_MAX_SIZE))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'padding and max_size must be integers'}), 400
+    if padding < 0 or max_size < 64 or max_size > Config.ATLAS_MAX_SIZE or max_size & (max_size - 1):
+        return jsonify({
+            'error': f'padding must be >= 0 and max_size a power of two between 64 and {Config.ATLAS_MAX_SIZE}'
+        }), 400
+
+    # Atlas packing is bulk work and queues in the last (lowest) priority class
+    try:
+        job = job_queue.submit(run_atlas_pack, filenames, rendition, padding, max_size, bool(data.get('trim')),
+                               client=client_identity(), priority=list(job_queue.priority_weights)[-1])
+    except QueueFull as e:
+        return queue_full_response(e)
+    return jsonify({
+        'success': True,
+        'job_id': job.id,
+        'status': job.status,
+        'status_url': f'/jobs/{job.id}'
+    }), 202
+
+@app.route('/atlases/<job_id>/<filename>')
+def serve_atlas(job_id, filename):
+    """Serve a packed atlas image or its JSON frame map"""
+    return send_from_directory(os.path.join(os.path.abspath(ATLAS_DIR), secure_filename(job_id)), filename)
+
+@lru_cache(maxsize=4096)
+def _content_hash(path, mtime_ns, size):
+    """SHA-256 of a file; keyed on mtime and size so a rewritten file is hashed again"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()[:32]
+
+def file_etag(path):
+    """Strong ETag derived from the file's content, hashed once per file version"""
+    stat = os.stat(path)
+    return _content_hash(path, stat.st_mtime_ns, stat.st_size)
+
+def _mark_immutable(response):
+    # send_from_directory marks files without a max_age as no-cache; drop that so
+    # browsers reuse their copy instead of revalidating on every view
+    response.cache_control.no_cache = None
+    response.cache_control.public = True
+    response.cache_control.max_age = IMAGE_MAX_AGE
+    response.cache_control.immutable = True
+    return response
+
 @app.route('/images/<filename>')
 def serve_image(filename):
-    """Serve generated images"""
-    # Use absolute path for security
-    abs_images_dir = os.path.abspath(IMAGES_DIR)
-    return send_from_directory(abs_images_dir, filename)
+    """
+    Serve generated images by ID (/images/<id> or /images/<id>.png), their
+    renditions (/images/<id>_native.png) or legacy flat filenames, optionally
+    transformed.
+
+    Generated files never change once written, so they are served as immutable
+    with a content-hash ETag; revalidations are answered with 304 and byte
+    ranges with 206 without re-reading the file.
+
+    The scale, max_size and format query parameters request a derived
+    rendition (nearest-neighbour resampling), which is computed once on a
+    thread pool and then served from the derived-image cache.
+    """
+    from image_store import resolve
+    from image_transform import get_derived_cache, parse_transform
+
+    # Image IDs map straight to their shard directory, so no directory is scanned
+    path = resolve(os.path.abspath(IMAGES_DIR), filename)
+    if path is None:
+        abort(404)
+
+    try:
+        params = parse_transform(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    if params is not None:
+        source_hash = file_etag(path)
+        etag = f'{source_hash}-{params.tag}'
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            data = get_derived_cache().render(path, source_hash, params)
+            response = Response(data, mimetype=params.mimetype)
+        response.set_etag(etag)
+        return _mark_immutable(response.make_conditional(request))
+
+    response = send_from_directory(
+        path.parent, path.name,
+        etag=file_etag(path),
+        conditional=True,
+        max_age=IMAGE_MAX_AGE
+    )
+    return _mark_immutable(response)
 
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5001)
\ No newline at end of file
@@ -0,0 +1,390 @@
+#!/usr/bin/env python3
+"""
+基准测试与压测：在本地替身服务上驱动 /generate 接口和 gen_all 批量流水线
+
+替身服务（stub_servers.py）在独立子进程中运行，不与被测代码争用 GIL 和内存。
+被测代码的所有目录（图像、索引、缓存）都放在临时目录中，不会碰到真实数据。
+每个目标按给定的并发级别各跑一轮，记录吞吐量、p50/p95/p99 延迟、各阶段平均耗时和进程内存，
+写入 JSON 文件；指定 --baseline 时与上一次的结果比较，超出阈值的退化会让进程以非零状态退出。
+
+其余配置（JOB_WORKERS、DRAW_THINGS_MAX_CONCURRENCY、SAVE_NATIVE_SPRITE 等）照常从环境变量读取。
+
+用法：python bench/run_bench.py --concurrency 1,4,8 --requests 32 --output bench_results.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import platform
+import argparse
+import tempfile
+import threading
+import subprocess
+import contextlib
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import requests
+
+from stub_servers import add_stub_arguments
+
+BENCH_DIR = Path(__file__).resolve().parent
+PROJECT_ROOT = BENCH_DIR.parent
+TARGETS = ("api", "batch")
+STAGES = ("prompt", "image", "base64_decode", "png_decode", "save", "postprocess")
+SUBJECTS = ("iron sword", "wooden shield", "health potion", "treasure chest", "slime monster",
+            "magic staff", "gold coin", "knight helmet")
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """线性插值的百分位数（q 取 0~100）"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def latency_summary(latencies: List[float]) -> Dict[str, Optional[float]]:
+    """延迟统计（毫秒）"""
+    def ms(value):
+        return None if value is None else round(value * 1000, 1)
+    return {
+        "p50": ms(percentile(latencies, 50)),
+        "p95": ms(percentile(latencies, 95)),
+        "p99": ms(percentile(latencies, 99)),
+        "mean": ms(sum(latencies) / len(latencies)) if latencies else None,
+        "max": ms(max(latencies)) if latencies else None,
+    }
+
+
+def rss_mb() -> Optional[float]:
+    """当前进程的常驻内存（MB）"""
+    try:
+        with open("/proc/self/statm") as f:
+            return round(int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 ** 2, 1)
+    except (OSError, ValueError, IndexError):
+        return peak_rss_mb()
+
+
+def peak_rss_mb() -> Optional[float]:
+    """进程启动以来的常驻内存峰值（MB）"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 上单位是 KB，macOS 上是字节
+    return round(peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024, 1)
+
+
+def stage_snapshot():
+    from metrics import STAGE_SECONDS
+    return {stage: (STAGE_SECONDS.count(stage=stage), STAGE_SECONDS.total(stage=stage)) for stage in STAGES}
+
+
+def stage_means(before, after) -> Dict[str, float]:
+    """两次快照之间各阶段的平均耗时（毫秒）"""
+    means = {}
+    for stage in STAGES:
+        count = after[stage][0] - before[stage][0]
+        if count:
+            means[stage] = round((after[stage][1] - before[stage][1]) / count * 1000, 1)
+    return means
+
+
+def stub_stats(urls) -> Dict[str, dict]:
+    stats = {}
+    for name, url in urls.items():
+        origin = url.split("/sdapi/")[0]
+        try:
+            stats[name] = requests.get(f"{origin}/_stub/stats", timeout=5).json()
+        except (requests.RequestException, ValueError):
+            stats[name] = {}
+    return stats
+
+
+def start_stubs(args):
+    """在子进程中启动替身服务，返回 (进程, {"lm_studio": url, "draw_things": url})"""
+    command = [sys.executable, str(BENCH_DIR / "stub_servers.py")]
+    for name in ("llm_latency", "llm_jitter", "llm_failure_rate", "token_delay",
+                 "image_latency", "image_jitter", "image_failure_rate", "image_size"):
+        command += [f"--{name.replace('_', '-')}", str(getattr(args, name))]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    line = process.stdout.readline()
+    if not line:
+        process.kill()
+        raise RuntimeError("stub servers failed to start")
+    return process, json.loads(line)
+
+
+def configure_environment(urls, workdir: Path, max_concurrency: int):
+    """在导入 config 之前把后端地址和所有数据目录指向替身服务和临时目录"""
+    os.environ.update({
+        "LM_STUDIO_BASE_URL": urls["lm_studio"],
+        "DRAW_THINGS_API_URL": urls["draw_things"],
+        "DRAW_THINGS_API_URLS": urls["draw_things"],
+        "GENERATED_IMAGES_DIR": str(workdir / "images"),
+        "IMAGE_INDEX_PATH": str(workdir / "image_index.db"),
+        "IMAGE_CACHE_DIR": str(workdir / "image_cache"),
+        "DERIVED_CACHE_DIR": str(workdir / "derived_cache"),
+        "ATLAS_DIR": str(workdir / "atlases"),
+        "PROMPT_CACHE_PATH": "",
+    })
+    os.environ.setdefault("JOB_WORKERS", str(max_concurrency))
+    for path in (PROJECT_ROOT, PROJECT_ROOT / "utils"):
+        if str(path) not in sys.path:
+            sys.path.insert(0, str(path))
+
+
+def start_api_server(verbose: bool = False):
+    """在后台线程中以多线程 WSGI 服务器运行 Flask 应用，返回 (服务器, 基础 URL)"""
+    from werkzeug.serving import make_server
+    from api.main import app
+
+    if not verbose:
+        # 每次轮询都会打印一行访问日志
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
+
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, name="bench-api", daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def run_api(base_url: str, concurrency: int, total: int, variants: int, run_id: str, poll_interval: float):
+    """
+    用 concurrency 个客户端线程提交 total 个 /generate 请求，每个客户端等自己的任务完成后再提交下一个
+
+    延迟取服务端记录的任务创建到结束的时间，不受轮询间隔影响。
+
+    Returns:
+        tuple: (成功任务的延迟列表, 排队等待时间列表, 失败数)
+    """
+    latencies, waits, failures = [], [], []
+    lock = threading.Lock()
+    counter = iter(range(total))
+
+    def client():
+        session = requests.Session()
+        while True:
+            with lock:
+                index = next(counter, None)
+            if index is None:
+                return
+            prompt = f"{SUBJECTS[index % len(SUBJECTS)]} {run_id}-{index}"
+            try:
+                response = session.post(f"{base_url}/generate", json={"prompt": prompt, "variants": variants},
+                                        timeout=30)
+                response.raise_for_status()
+                status_url = f"{base_url}{response.json()['status_url']}"
+                while True:
+                    job = session.get(status_url, timeout=30).json()
+                    if job["status"] in ("succeeded", "failed", "cancelled"):
+                        break
+                    time.sleep(poll_interval)
+            except (requests.RequestException, ValueError, KeyError) as e:
+                with lock:
+                    failures.append(str(e))
+                continue
+            with lock:
+                if job["status"] == "succeeded":
+                    latencies.append(job["finished_at"] - job["created_at"])
+                    waits.append(job["started_at"] - job["created_at"])
+                else:
+                    failures.append(job.get("error") or job["status"])
+
+    threads = [threading.Thread(target=client, name=f"bench-client-{i}") for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, waits, len(failures)
+
+
+def run_batch(workdir: Path, concurrency: int, total: int, variants: int, run_id: str):
+    """
+    用 gen_all.run_batch 处理一个 total 项的清单，提示词和图像阶段的并发都设为 concurrency
+
+    Returns:
+        tuple: (成功项的延迟列表, 空列表, 失败数)
+    """
+    import gen_all
+
+    manifest = workdir / f"manifest-{run_id}.jsonl"
+    with open(manifest, "w", encoding="utf-8") as f:
+        for index in range(total):
+            prompt = f"{SUBJECTS[index % len(SUBJECTS)]} {run_id}-{index}"
+            f.write(json.dumps({"id": f"{run_id}-{index}", "prompt": prompt, "variants": variants}) + "\n")
+    progress = gen_all.run_batch(str(manifest), str(workdir / f"checkpoint-{run_id}.jsonl"),
+                                 prompt_workers=concurrency, image_workers=concurrency)
+    return progress.latencies, [], progress.failed
+
+
+def run_level(target: str, concurrency: int, args, context) -> dict:
+    """以一个并发级别跑一轮，返回该轮的统计"""
+    run_id = f"{target}-c{concurrency}-{int(time.time() * 1000)}"
+    stages_before = stage_snapshot()
+    stubs_before = stub_stats(context["urls"])
+    rss_start = rss_mb()
+    start = time.perf_counter()
+    if target == "api":
+        latencies, waits, failed = run_api(context["api_url"], concurrency, args.requests,
+                                           args.variants, run_id, args.poll_interval)
+    else:
+        latencies, waits, failed = run_batch(context["workdir"], concurrency, args.requests,
+                                             args.variants, run_id)
+    duration = time.perf_counter() - start
+    stubs_after = stub_stats(context["urls"])
+
+    result = {
+        "target": target,
+        "concurrency": concurrency,
+        "requests": args.requests,
+        "succeeded": len(latencies),
+        "failed": failed,
+        "duration_s": round(duration, 3),
+        "throughput_rps": round(len(latencies) / duration, 3) if duration else None,
+        "images_per_s": round(len(latencies) * args.variants / duration, 3) if duration else None,
+        "latency_ms": latency_summary(latencies),
+        "stage_mean_ms": stage_means(stages_before, stage_snapshot()),
+        "memory_mb": {"rss_start": rss_start, "rss_end": rss_mb(), "peak_rss": peak_rss_mb()},
+        "backend_calls": {
+            name: {key: stubs_after[name].get(key, 0) - stubs_before[name].get(key, 0)
+                   for key in ("requests", "failures")}
+            for name in stubs_after
+        },
+    }
+    if waits:
+        result["queue_wait_ms"] = latency_summary(waits)
+    return result
+
+
+def find_regressions(runs: List[dict], baseline: dict, threshold: float) -> List[dict]:
+    """
+    与基线结果逐轮比较（按目标和并发级别匹配）：吞吐量下降或 p95 延迟上升超过 threshold 视为退化
+    """
+    previous = {(run["target"], run["concurrency"]): run for run in baseline.get("runs", [])}
+    regressions = []
+    for run in runs:
+        base = previous.get((run["target"], run["concurrency"]))
+        if base is None:
+            continue
+        checks = [
+            ("throughput_rps", run["throughput_rps"], base.get("throughput_rps"), -1),
+            ("latency_p95_ms", run["latency_ms"]["p95"], (base.get("latency_ms") or {}).get("p95"), 1),
+        ]
+        for metric, current, reference, direction in checks:
+            if not current or not reference:
+                continue
+            change = (current - reference) / reference
+            if change * direction > threshold:
+                regressions.append({"target": run["target"], "concurrency": run["concurrency"],
+                                    "metric": metric, "baseline": reference, "current": current,
+                                    "change": round(change, 3)})
+    return regressions
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=PROJECT_ROOT,
+                              capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def parse_levels(value: str) -> List[int]:
+    levels = [int(level) for level in value.split(",") if level.strip()]
+    if not levels or min(levels) < 1:
+        raise argparse.ArgumentTypeError("concurrency levels must be positive integers")
+    return levels
+
+
+def main(argv=None):
+    """主函数：启动替身服务，逐个目标和并发级别运行，写出结果"""
+    parser = argparse.ArgumentParser(description="在本地替身服务上对生成流水线做基准测试")
+    parser.add_argument("--target", choices=TARGETS + ("all",), default="all",
+                        help="测试 /generate 接口、gen_all 批量流水线或两者（默认 all）")
+    parser.add_argument("--concurrency", type=parse_levels, default=[1, 4, 8],
+                        help="逗号分隔的并发级别（默认 1,4,8）")
+    parser.add_argument("--requests", type=int, default=32, help="每轮的请求数（默认 32）")
+    parser.add_argument("--variants", type=int, default=1, help="每个请求的变体数")
+    parser.add_argument("--poll-interval", type=float, default=0.02, help="轮询任务状态的间隔（秒）")
+    parser.add_argument("--output", default="bench_results.json", help="结果 JSON 文件")
+    parser.add_argument("--baseline", help="用于比较的上一次结果 JSON 文件")
+    parser.add_argument("--max-regression", type=float, default=0.2,
+                        help="允许的吞吐量下降 / p95 延迟上升比例（默认 0.2）")
+    parser.add_argument("--keep-workdir", action="store_true", help="保留临时目录中生成的图像")
+    parser.add_argument("--verbose", action="store_true", help="显示被测代码的输出")
+    add_stub_arguments(parser)
+    args = parser.parse_args(argv)
+
+    targets = TARGETS if args.target == "all" else (args.target,)
+    workdir = Path(tempfile.mkdtemp(prefix="pixelart-bench-"))
+    stub_process, urls = start_stubs(args)
+    print(f"🤖 替身服务: {urls['lm_studio']} , {urls['draw_things']}")
+    print(f"📁 临时目录: {workdir}")
+    configure_environment(urls, workdir, max(args.concurrency))
+
+    api_server = None
+    runs = []
+    try:
+        context = {"urls": urls, "workdir": workdir}
+        if "api" in targets:
+            api_server, context["api_url"] = start_api_server(args.verbose)
+        for target in targets:
+            for concurrency in args.concurrency:
+                print(f"⏱️  {target} 并发 {concurrency}，{args.requests} 个请求...")
+                quiet = open(os.devnull, "w") if not args.verbose else None
+                with contextlib.redirect_stdout(quiet) if quiet else contextlib.nullcontext():
+                    run = run_level(target, concurrency, args, context)
+                if quiet:
+                    quiet.close()
+                runs.append(run)
+                latency = run["latency_ms"]
+                print(f"   ✅ {run['succeeded']} 成功 / {run['failed']} 失败，"
+                      f"{run['throughput_rps']} 请求/秒，p50 {latency['p50']} ms，"
+                      f"p95 {latency['p95']} ms，p99 {latency['p99']} ms，"
+                      f"RSS {run['memory_mb']['rss_end']} MB")
+    finally:
+        if api_server is not None:
+            api_server.shutdown()
+        stub_process.terminate()
+        stub_process.wait(timeout=10)
+        if not args.keep_workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "git_revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": {
+            name: value for name, value in vars(args).items()
+            if name not in ("output", "baseline", "keep_workdir", "verbose")
+        },
+        "runs": runs,
+    }
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            report["regressions"] = find_regressions(runs, json.load(f), args.max_regression)
+        for regression in report["regressions"]:
+            print(f"⚠️  退化: {regression['target']} 并发 {regression['concurrency']} "
+                  f"{regression['metric']} {regression['baseline']} -> {regression['current']} "
+                  f"({regression['change']:+.0%})")
+        exit_code = 1 if report["regressions"] else 0
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"📊 结果已写入 {args.output}")
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+"""
+LM Studio 和 Draw Things 的本地替身服务，用于基准测试和压测
+
+- LM Studio：POST /v1/chat/completions（支持 stream=true 的 SSE 输出），返回 "正向 ||| 反向" 格式的提示词
+- Draw Things：POST /sdapi/v1/txt2img 返回 base64 PNG（按 batch_size 返回多张），
+  GET /sdapi/v1/progress 和 GET / 供进度轮询和健康检查使用
+
+每个服务的延迟、抖动（正态分布标准差）、失败率都可以配置；图像是预先编码好的随机像素画，
+后处理（网格检测、调色板量化）会像处理真实输出一样做完整的工作。
+GET /_stub/stats 返回请求数和注入的失败数。
+
+单独运行：python bench/stub_servers.py --llm-port 1234 --draw-things-port 7860
+启动后第一行输出两个服务地址的 JSON，供 run_bench.py 读取。
+"""
+
+import re
+import sys
+import json
+import time
+import base64
+import random
+import argparse
+import threading
+from dataclasses import dataclass
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+# 每种尺寸预先生成的不同图像数量，响应时轮流使用
+IMAGE_VARIETY = 8
+# 替身图像的原生像素尺寸与输出尺寸之比（与常见的像素画生成结果一致）
+PIXEL_SCALE = 8
+
+
+@dataclass
+class StubBehavior:
+    """一个替身服务的响应行为"""
+    latency: float = 0.0
+    jitter: float = 0.0
+    failure_rate: float = 0.0
+
+    def delay(self) -> float:
+        return max(0.0, random.gauss(self.latency, self.jitter)) if self.jitter else self.latency
+
+    def should_fail(self) -> bool:
+        return self.failure_rate > 0 and random.random() < self.failure_rate
+
+
+@lru_cache(maxsize=64)
+def stub_png(width: int, height: int, variant: int = 0) -> bytes:
+    """
+    生成一张白色背景上的随机像素画精灵（放大 PIXEL_SCALE 倍后编码为 PNG）
+    """
+    rng = np.random.default_rng(variant * 7919 + width * 31 + height)
+    cells_x, cells_y = max(1, width // PIXEL_SCALE), max(1, height // PIXEL_SCALE)
+    palette = rng.integers(0, 200, size=(12, 3), dtype=np.uint8)
+    sprite = palette[rng.integers(0, len(palette), size=(cells_y, cells_x))]
+    # 四周留出白色背景
+    border_y, border_x = cells_y // 6, cells_x // 6
+    sprite[:border_y], sprite[cells_y - border_y:] = 255, 255
+    sprite[:, :border_x], sprite[:, cells_x - border_x:] = 255, 255
+    pixels = sprite.repeat(PIXEL_SCALE, axis=0).repeat(PIXEL_SCALE, axis=1)
+    canvas = np.full((height, width, 3), 255, dtype=np.uint8)
+    canvas[:pixels.shape[0], :pixels.shape[1]] = pixels[:height, :width]
+    buffer = BytesIO()
+    Image.fromarray(canvas).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+@lru_cache(maxsize=64)
+def stub_png_base64(width: int, height: int, variant: int = 0) -> str:
+    return base64.b64encode(stub_png(width, height, variant)).decode("ascii")
+
+
+class _StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, handler, behavior: StubBehavior, **options):
+        super().__init__(address, handler)
+        self.behavior = behavior
+        self.options = options
+        self.requests = 0
+        self.failures = 0
+        self._stats_lock = threading.Lock()
+
+    def count(self, failed: bool):
+        with self._stats_lock:
+            self.requests += 1
+            self.failures += int(failed)
+
+    def stats(self):
+        with self._stats_lock:
+            return {"requests": self.requests, "failures": self.failures}
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        try:
+            return json.loads(body or b"{}")
+        except ValueError:
+            return {}
+
+    def _send_json(self, status: int, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _simulate(self) -> bool:
+        """按配置等待并决定本次是否注入失败；失败时已写出 500 响应"""
+        behavior = self.server.behavior
+        time.sleep(behavior.delay())
+        failed = behavior.should_fail()
+        self.server.count(failed)
+        if failed:
+            self._send_json(500, {"error": "injected stub failure"})
+        return not failed
+
+    def do_GET(self):
+        if self.path == "/_stub/stats":
+            self._send_json(200, self.server.stats())
+        else:
+            self._send_json(404, {"error": "not found"})
+
+
+class LMStudioStubHandler(_StubHandler):
+    """模拟 LM Studio 的 OpenAI 兼容接口"""
+
+    def do_POST(self):
+        if self.path != "/v1/chat/completions":
+            self._send_json(404, {"error": "not found"})
+            return
+        data = self._read_json()
+        if not self._simulate():
+            return
+
+        user_message = next((m.get("content", "") for m in reversed(data.get("messages") or [])
+                             if m.get("role") == "user"), "")
+        match = re.search(r"game asset: (.*?)\. Positive prompt", user_message)
+        subject = match.group(1) if match else "game item"
+        content = (f"pixel art {subject}, 16-bit sprite, white background, no shadows, no borders"
+                   f" ||| blurry, photorealistic, shadows, borders, text")
+
+        if data.get("stream"):
+            self._stream(content)
+        else:
+            self._send_json(200, {
+                "object": "chat.completion",
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content},
+                             "finish_reason": "stop"}],
+            })
+
+    def _stream(self, content: str):
+        """以 SSE 逐词输出，然后输出 [DONE] 并关闭连接"""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        token_delay = self.server.options.get("token_delay", 0.0)
+        try:
+            for token in re.findall(r"\S+\s*", content):
+                chunk = {"choices": [{"index": 0, "delta": {"content": token}}]}
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+                if token_delay:
+                    time.sleep(token_delay)
+            self.wfile.write(b"data: [DONE]\n\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端拿到完整的两段提示词后会提前断开
+            pass
+
+
+class DrawThingsStubHandler(_StubHandler):
+    """模拟 Draw Things 的 A1111 兼容接口"""
+
+    def do_GET(self):
+        if self.path == "/":
+            self._send_json(200, {"status": "ok"})
+        elif self.path == "/sdapi/v1/progress":
+            self._send_json(200, {"progress": 0.5, "current_image": None})
+        else:
+            super().do_GET()
+
+    def do_POST(self):
+        if self.path != "/sdapi/v1/txt2img":
+            self._send_json(404, {"error": "not found"})
+            return
+        data = self._read_json()
+        if not self._simulate():
+            return
+
+        image_size = self.server.options.get("image_size") or 0
+        width = image_size or int(data.get("width") or 512)
+        height = image_size or int(data.get("height") or 512)
+        batch_size = max(1, int(data.get("batch_size") or 1))
+        images = [stub_png_base64(width, height, random.randrange(IMAGE_VARIETY)) for _ in range(batch_size)]
+        self._send_json(200, {"images": images, "parameters": data, "info": ""})
+
+
+def start_stub_servers(llm: StubBehavior = None, draw_things: StubBehavior = None, image_size: int = 0,
+                       token_delay: float = 0.0, host: str = "127.0.0.1", llm_port: int = 0,
+                       draw_things_port: int = 0):
+    """
+    在后台线程中启动两个替身服务（端口为 0 时自动选择空闲端口）
+
+    Returns:
+        tuple: (LM Studio 服务, Draw Things 服务)，用 .url 取地址，用 .shutdown() 停止
+    """
+    servers = (
+        _StubServer((host, llm_port), LMStudioStubHandler, llm or StubBehavior(), token_delay=token_delay),
+        _StubServer((host, draw_things_port), DrawThingsStubHandler, draw_things or StubBehavior(),
+                    image_size=image_size),
+    )
+    for server in servers:
+        threading.Thread(target=server.serve_forever, name="stub-server", daemon=True).start()
+    return servers
+
+
+def add_stub_arguments(parser: argparse.ArgumentParser):
+    """替身服务的行为参数（run_bench.py 原样转发给子进程）"""
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="LLM 响应延迟（秒，默认 0.2）")
+    parser.add_argument("--llm-jitter", type=float, default=0.05, help="LLM 延迟的标准差（秒）")
+    parser.add_argument("--llm-failure-rate", type=float, default=0.0, help="LLM 返回 500 的比例")
+    parser.add_argument("--token-delay", type=float, default=0.0, help="流式输出时每个词之间的延迟（秒）")
+    parser.add_argument("--image-latency", type=float, default=1.0, help="图像生成延迟（秒，默认 1.0）")
+    parser.add_argument("--image-jitter", type=float, default=0.2, help="图像生成延迟的标准差（秒）")
+    parser.add_argument("--image-failure-rate", type=float, default=0.0, help="图像生成返回 500 的比例")
+    parser.add_argument("--image-size", type=int, default=0,
+                        help="返回图像的边长（像素，默认使用请求中的 width/height）")
+
+
+def main(argv=None):
+    """主函数：启动替身服务直到 Ctrl+C"""
+    parser = argparse.ArgumentParser(description="启动 LM Studio 和 Draw Things 的本地替身服务")
+    parser.add_argument("--host", default="127.0.0.1", help="监听地址")
+    parser.add_argument("--llm-port", type=int, default=0, help="LM Studio 替身端口（0 = 自动）")
+    parser.add_argument("--draw-things-port", type=int, default=0, help="Draw Things 替身端口（0 = 自动）")
+    add_stub_arguments(parser)
+    args = parser.parse_args(argv)
+
+    llm, draw_things = start_stub_servers(
+        StubBehavior(args.llm_latency, args.llm_jitter, args.llm_failure_rate),
+        StubBehavior(args.image_latency, args.image_jitter, args.image_failure_rate),
+        image_size=args.image_size, token_delay=args.token_delay,
+        host=args.host, llm_port=args.llm_port, draw_things_port=args.draw_things_port,
+    )
+    print(json.dumps({"lm_studio": llm.url, "draw_things": f"{draw_things.url}/sdapi/v1/txt2img"}), flush=True)
+    print(f"🤖 LM Studio 替身: {llm.url}", file=sys.stderr)
+    print(f"🎨 Draw Things 替身: {draw_things.url}", file=sys.stderr)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for server in (llm, draw_things):
+            server.shutdown()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
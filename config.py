@@ -12,17 +12,101 @@ class Config:
     # API settings
     LM_STUDIO_BASE_URL = os.environ.get('LM_STUDIO_BASE_URL') or 'http://localhost:1234'
     LM_STUDIO_MODEL = os.environ.get('LM_STUDIO_MODEL') or 'qwen2.5-coder-7b-instruct-mlx'
+    # Stream completions and stop reading once both prompts are complete; 0 tokens = no budget
+    LM_STUDIO_STREAM = (os.environ.get('LM_STUDIO_STREAM') or 'false').lower() in ('1', 'true', 'yes')
+    LM_STUDIO_MAX_TOKENS = int(os.environ.get('LM_STUDIO_MAX_TOKENS') or 0)
+    # Circuit breaker: after N consecutive failures, use the template prompt without contacting
+    # LM Studio for RESET seconds, then let one probe request through (0 failures = disabled)
+    LM_STUDIO_BREAKER_THRESHOLD = int(os.environ.get('LM_STUDIO_BREAKER_THRESHOLD') or 3)
+    LM_STUDIO_BREAKER_RESET = float(os.environ.get('LM_STUDIO_BREAKER_RESET') or 30)
     DRAW_THINGS_API_URL = os.environ.get('DRAW_THINGS_API_URL') or 'http://localhost:7860/sdapi/v1/txt2img'
     
+    # Draw Things backends: comma-separated URLs, each optionally suffixed with "|<max concurrency>".
+    # Falls back to DRAW_THINGS_API_URL when empty.
+    DRAW_THINGS_API_URLS = os.environ.get('DRAW_THINGS_API_URLS') or ''
+    DRAW_THINGS_MAX_CONCURRENCY = int(os.environ.get('DRAW_THINGS_MAX_CONCURRENCY') or 1)
+    DRAW_THINGS_FAILURE_THRESHOLD = int(os.environ.get('DRAW_THINGS_FAILURE_THRESHOLD') or 2)
+    DRAW_THINGS_HEALTH_INTERVAL = float(os.environ.get('DRAW_THINGS_HEALTH_INTERVAL') or 15)
+    DRAW_THINGS_HEALTH_PATH = os.environ.get('DRAW_THINGS_HEALTH_PATH') or '/'
+    # Poll /sdapi/v1/progress every N seconds while rendering for preview events (0 = off)
+    DRAW_THINGS_PREVIEW_INTERVAL = float(os.environ.get('DRAW_THINGS_PREVIEW_INTERVAL') or 0)
+    
+    # Backend HTTP client settings (timeouts in seconds)
+    LM_STUDIO_CONNECT_TIMEOUT = float(os.environ.get('LM_STUDIO_CONNECT_TIMEOUT') or 5)
+    LM_STUDIO_READ_TIMEOUT = float(os.environ.get('LM_STUDIO_READ_TIMEOUT') or 120)
+    DRAW_THINGS_CONNECT_TIMEOUT = float(os.environ.get('DRAW_THINGS_CONNECT_TIMEOUT') or 5)
+    DRAW_THINGS_READ_TIMEOUT = float(os.environ.get('DRAW_THINGS_READ_TIMEOUT') or 300)
+    BACKEND_MAX_RETRIES = int(os.environ.get('BACKEND_MAX_RETRIES') or 2)
+    BACKEND_BACKOFF_BASE = float(os.environ.get('BACKEND_BACKOFF_BASE') or 0.5)
+    BACKEND_BACKOFF_MAX = float(os.environ.get('BACKEND_BACKOFF_MAX') or 8)
+    BACKEND_POOL_SIZE = int(os.environ.get('BACKEND_POOL_SIZE') or 8)
+    BACKEND_GZIP = (os.environ.get('BACKEND_GZIP') or 'true').lower() in ('1', 'true', 'yes')
+    
+    # Prompt cache settings (TTL in seconds, 0 = never expire; empty path = memory only)
+    PROMPT_CACHE_SIZE = int(os.environ.get('PROMPT_CACHE_SIZE') or 1024)
+    PROMPT_CACHE_TTL = float(os.environ.get('PROMPT_CACHE_TTL') or 7 * 24 * 3600)
+    PROMPT_CACHE_PATH = os.environ.get('PROMPT_CACHE_PATH') or ''
+    # Newest rows kept in the SQLite store; expired and older rows are deleted (0 = unlimited)
+    PROMPT_CACHE_STORE_SIZE = int(os.environ.get('PROMPT_CACHE_STORE_SIZE') or 100000)
+    
     # Image generation settings
     DEFAULT_STEPS = int(os.environ.get('DEFAULT_STEPS') or 8)
     DEFAULT_CFG = float(os.environ.get('DEFAULT_CFG') or 10.0)
     DEFAULT_WIDTH = int(os.environ.get('DEFAULT_WIDTH') or 512)
     DEFAULT_HEIGHT = int(os.environ.get('DEFAULT_HEIGHT') or 512)
+    MAX_VARIANTS = int(os.environ.get('MAX_VARIANTS') or 4)
+    
+    # PNGs from Draw Things are written as-is; optionally recompress them in the background
+    SAVE_RECOMPRESS = (os.environ.get('SAVE_RECOMPRESS') or 'false').lower() in ('1', 'true', 'yes')
+    
+    # Post-processing (all opt-in, it runs on the job worker): save the detected
+    # native-resolution sprite next to each image
+    SAVE_NATIVE_SPRITE = (os.environ.get('SAVE_NATIVE_SPRITE') or 'false').lower() in ('1', 'true', 'yes')
+    # Turn the white background connected to the image border into alpha and crop to the content
+    REMOVE_BACKGROUND = (os.environ.get('REMOVE_BACKGROUND') or 'false').lower() in ('1', 'true', 'yes')
+    BACKGROUND_TOLERANCE = int(os.environ.get('BACKGROUND_TOLERANCE') or 24)
+    # Quantize each image to an indexed-colour PNG with at most N colours (0 = disabled),
+    # optionally snapping to a shared project palette file (.hex, .gpl or an image)
+    PALETTE_COLORS = int(os.environ.get('PALETTE_COLORS') or 0)
+    PALETTE_PATH = os.environ.get('PALETTE_PATH') or ''
+    
+    # Derived renditions served by /images/<filename>?scale=&max_size=&format=
+    DERIVED_CACHE_DIR = os.environ.get('DERIVED_CACHE_DIR') or 'derived_cache'
+    DERIVED_CACHE_MAX_BYTES = int(os.environ.get('DERIVED_CACHE_MAX_BYTES') or 256 * 1024 ** 2)
+    DERIVED_MEMORY_CACHE_BYTES = int(os.environ.get('DERIVED_MEMORY_CACHE_BYTES') or 32 * 1024 ** 2)
+    TRANSFORM_WORKERS = int(os.environ.get('TRANSFORM_WORKERS') or 4)
+    
+    # Texture atlas packing (max_size must be a power of two)
+    ATLAS_DIR = os.environ.get('ATLAS_DIR') or 'atlases'
+    ATLAS_MAX_SIZE = int(os.environ.get('ATLAS_MAX_SIZE') or 2048)
+    ATLAS_PADDING = int(os.environ.get('ATLAS_PADDING') or 2)
+    
+    # Image result cache for pinned-seed requests (0 bytes = disabled)
+    IMAGE_CACHE_DIR = os.environ.get('IMAGE_CACHE_DIR') or 'image_cache'
+    IMAGE_CACHE_MAX_BYTES = int(os.environ.get('IMAGE_CACHE_MAX_BYTES') or 1024 ** 3)
+    
+    # Coalesce identical in-flight requests (normalized prompt, negative prompt and parameters):
+    # off, prompt (share the LLM expansion only) or pipeline (share the whole generation)
+    COALESCE_MODE = (os.environ.get('COALESCE_MODE') or 'pipeline').lower()
+    
+    # Job queue settings
+    JOB_WORKERS = int(os.environ.get('JOB_WORKERS') or 2)
+    JOB_HISTORY_LIMIT = int(os.environ.get('JOB_HISTORY_LIMIT') or 1000)
+    # Admission control: queued jobs beyond these limits get 429 + Retry-After (0 = unlimited)
+    JOB_QUEUE_LIMIT = int(os.environ.get('JOB_QUEUE_LIMIT') or 64)
+    JOB_CLIENT_QUEUE_LIMIT = int(os.environ.get('JOB_CLIENT_QUEUE_LIMIT') or 16)
+    # Weighted fair queuing: "class:weight" priority classes (the first is the default) and
+    # optional "api-key:weight" shares for clients sending X-API-Key (others weigh 1).
+    # Only keys listed in API_KEY_WEIGHTS are trusted; other clients are identified by IP
+    JOB_PRIORITY_WEIGHTS = os.environ.get('JOB_PRIORITY_WEIGHTS') or 'interactive:4,batch:1'
+    API_KEY_WEIGHTS = os.environ.get('API_KEY_WEIGHTS') or ''
+    # Optional "api-key:class" priority classes for trusted keys (others get the default class)
+    API_KEY_PRIORITIES = os.environ.get('API_KEY_PRIORITIES') or ''
     
     # File paths
     GENERATED_IMAGES_DIR = os.environ.get('GENERATED_IMAGES_DIR') or 'generated_images'
     PROMPT_TEMPLATE_PATH = os.environ.get('PROMPT_TEMPLATE_PATH') or os.path.join('utils', 'prompt.tpl')
+    IMAGE_INDEX_PATH = os.environ.get('IMAGE_INDEX_PATH') or 'image_index.db'
     
     # Create directories if they don't exist
     @staticmethod
@@ -22,11 +22,23 @@ def client():
         yield client
 
 
+@pytest.fixture
+def image_index(tmp_path, monkeypatch):
+    """Point the shared image index at a temporary database."""
+    import image_index as image_index_module
+    index = image_index_module.ImageIndex(str(tmp_path / 'index.db'))
+    monkeypatch.setattr(image_index_module, '_default_index', index)
+    return index
+
+
 def test_index_page(client):
     """Test that the index page loads successfully."""
     response = client.get('/')
     assert response.status_code == 200
     assert b'Pixel Art Generator' in response.data
+    # The variants input is limited to what the API accepts
+    from config import Config
+    assert f'max="{Config.MAX_VARIANTS}"'.encode() in response.data
 
 
 def test_generate_endpoint_exists(client):
@@ -35,4 +47,433 @@ def test_generate_endpoint_exists(client):
     # but we can test that the endpoint exists and returns the right error for missing data
     response = client.post('/generate', json={})
     # Should return 400 for missing prompt, or 500 for generation failure
-    assert response.status_code in [400, 500]
\ No newline at end of file
+    assert response.status_code in [400, 500]
+
+def _wait_for_job(client, job_id, timeout=5):
+    """Poll the job status endpoint until the job has finished."""
+    import time
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        data = client.get(f'/jobs/{job_id}').get_json()
+        if data['status'] in ('succeeded', 'failed', 'cancelled'):
+            return data
+        time.sleep(0.01)
+    raise AssertionError(f'Job {job_id} did not finish in time')
+
+
+def test_generate_returns_job_id(client, monkeypatch):
+    """Test that /generate queues a job and the result is available via /jobs."""
+    from api import main
+
+    def fake_generation(job, user_description, negative_requirements='', seed=-1, variants=1):
+        job.set_stage('prompt')
+        return {'image_filename': 'fake.png', 'positive_prompt': user_description}
+
+    monkeypatch.setattr(main, 'run_generation', fake_generation)
+    response = client.post('/generate', json={'prompt': 'sword icon'})
+    assert response.status_code == 202
+    job_id = response.get_json()['job_id']
+
+    data = _wait_for_job(client, job_id)
+    assert data['status'] == 'succeeded'
+    assert data['result']['positive_prompt'] == 'sword icon'
+
+
+def test_cancel_job(client, monkeypatch):
+    """Test that a running job stops at its next stage once cancelled."""
+    import threading
+    from api import main
+
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow_generation(job, user_description, negative_requirements='', seed=-1, variants=1):
+        job.set_stage('prompt')
+        started.set()
+        release.wait(5)
+        job.set_stage('image')
+        return {}
+
+    monkeypatch.setattr(main, 'run_generation', slow_generation)
+    job_id = client.post('/generate', json={'prompt': 'health potion'}).get_json()['job_id']
+    assert started.wait(5)
+
+    response = client.delete(f'/jobs/{job_id}')
+    assert response.status_code == 200
+    assert response.get_json()['cancel_requested'] is True
+    release.set()
+
+    assert _wait_for_job(client, job_id)['status'] == 'cancelled'
+    assert client.delete(f'/jobs/{job_id}').status_code == 409
+    assert client.get('/jobs/unknown').status_code == 404
+    assert client.post('/generate', json={'prompt': 'sword', 'variants': 99}).status_code == 400
+    assert client.post('/generate', json={'prompt': 'sword', 'variants': 0}).status_code == 400
+
+
+def test_run_generation_uses_in_memory_record(client, monkeypatch, tmp_path, image_index):
+    """Test that a generation job reports the prompts and the exact image it produced."""
+    from PIL import Image
+    from api import main
+    from api.jobs import Job
+    import gen_prompt
+    import gen_images
+
+    monkeypatch.setattr(main, 'IMAGES_DIR', str(tmp_path))
+    # Post-processing is opt-in
+    monkeypatch.setattr(main.Config, 'SAVE_NATIVE_SPRITE', True)
+    monkeypatch.setattr(main.Config, 'PALETTE_COLORS', 16)
+    monkeypatch.setattr(gen_prompt, 'generate_stable_diffusion_prompt',
+                        lambda description, negative='': (f'pixel art, {description}', 'blurry'))
+    monkeypatch.setattr(gen_images, 'call_draw_things_api_batch',
+                        lambda batch_size=1, **kwargs: [Image.new('RGB', (8, 8), 'white')] * batch_size)
+
+    result = main.run_generation(Job(None), 'sword icon', variants=3)
+    assert result['positive_prompt'] == 'pixel art, sword icon'
+    assert result['negative_prompt'] == 'blurry'
+    # Files land in a shard directory derived from their ID
+    from image_store import resolve
+    assert resolve(tmp_path, result['image_filename']).parent.parent.parent == tmp_path
+    assert set(result['timings']) == {'prompt', 'image', 'save', 'postprocess', 'total'}
+    assert len({variant['image_filename'] for variant in result['variants']}) == 3
+    # A flat image has no pixel grid, so only the indexed-colour copy is derived from it
+    assert all(set(variant['renditions']) == {'indexed'} for variant in result['variants'])
+    assert not os.path.exists('prompt.json')
+    assert image_index.get(result['image_filename'])['positive'] == 'pixel art, sword icon'
+
+
+def test_list_images_paginates_and_filters(client, image_index):
+    """Test keyset pagination and prompt filtering on /images."""
+    for i in range(5):
+        subject = 'sword' if i % 2 == 0 else 'potion'
+        image_index.add(f'image_{i}.png', record={'positive': f'pixel art {subject} icon'})
+
+    first = client.get('/images?limit=2').get_json()
+    assert [image['filename'] for image in first['images']] == ['image_4.png', 'image_3.png']
+    second = client.get(f"/images?limit=2&cursor={first['next_cursor']}").get_json()
+    assert [image['filename'] for image in second['images']] == ['image_2.png', 'image_1.png']
+
+    swords = client.get('/images?q=sword').get_json()
+    assert [image['filename'] for image in swords['images']] == ['image_4.png', 'image_2.png', 'image_0.png']
+    assert swords['next_cursor'] is None
+    assert client.get('/images?cursor=abc').status_code == 400
+
+
+def test_job_events_stream(client, monkeypatch):
+    """Test that job progress is streamed as server-sent events ending with the final state."""
+    from api import main
+
+    def fake_generation(job, user_description, negative_requirements='', seed=-1, variants=1):
+        job.set_stage('prompt')
+        job.emit('prompt_expanded', positive='pixel art', negative='blurry', seconds=0.1)
+        return {'image_filename': 'fake.png'}
+
+    monkeypatch.setattr(main, 'run_generation', fake_generation)
+    job_id = client.post('/generate', json={'prompt': 'sword icon'}).get_json()['job_id']
+
+    response = client.get(f'/jobs/{job_id}/events')
+    assert response.mimetype == 'text/event-stream'
+    body = response.get_data(as_text=True)
+    events = [line.split(': ', 1)[1] for line in body.splitlines() if line.startswith('event: ')]
+    assert events == ['queued', 'running', 'stage', 'prompt_expanded', 'succeeded']
+    assert '"image_filename": "fake.png"' in body
+
+    resumed = client.get(f'/jobs/{job_id}/events', headers={'Last-Event-ID': '3'}).get_data(as_text=True)
+    assert [line for line in resumed.splitlines() if line.startswith('event: ')] == ['event: succeeded']
+
+    # Reconnecting with the id of the final event ends the stream straight away
+    last_id = body.strip().split('\n\n')[-1].splitlines()[0].split(': ', 1)[1]
+    finished = client.get(f'/jobs/{job_id}/events', headers={'Last-Event-ID': last_id})
+    assert finished.get_data(as_text=True) == ''
+
+
+def test_atlas_job_packs_generated_images(client, monkeypatch, tmp_path):
+    """Test that /atlases packs images into an atlas served with its frame map."""
+    from PIL import Image
+    from api import main
+
+    images_dir = tmp_path / 'images'
+    images_dir.mkdir()
+    for index, color in enumerate(['red', 'green', 'blue']):
+        Image.new('RGBA', (32, 24), color).save(images_dir / f'sprite_{index}.png')
+    monkeypatch.setattr(main, 'IMAGES_DIR', str(images_dir))
+    monkeypatch.setattr(main, 'ATLAS_DIR', str(tmp_path / 'atlases'))
+
+    assert client.post('/atlases', json={'filenames': ['../secret.png']}).status_code == 400
+    assert client.post('/atlases', json={'filenames': ['missing.png']}).status_code == 404
+    assert client.post('/atlases', json={'max_size': 1000}).status_code == 400
+
+    response = client.post('/atlases', json={'padding': 1})
+    assert response.status_code == 202
+    data = _wait_for_job(client, response.get_json()['job_id'])
+    assert data['status'] == 'succeeded'
+    atlas = data['result']['atlases'][0]
+    assert atlas['count'] == 3
+    # Two padded 32px sprites do not fit side by side in 64px, so the atlas grows to 128x64
+    assert (atlas['width'], atlas['height']) == (128, 64)
+
+    frames = client.get(atlas['frames_url']).get_json()['frames']
+    assert set(frames) == {'sprite_0.png', 'sprite_1.png', 'sprite_2.png'}
+    assert client.get(atlas['image_url']).status_code == 200
+
+
+def test_images_are_served_immutable_with_etag(client, monkeypatch, tmp_path):
+    """Test that images carry a content-hash ETag and revalidate with 304."""
+    from PIL import Image
+    from api import main
+
+    Image.new('RGB', (8, 8), 'white').save(tmp_path / 'sprite.png')
+    monkeypatch.setattr(main, 'IMAGES_DIR', str(tmp_path))
+
+    response = client.get('/images/sprite.png')
+    assert response.status_code == 200
+    etag = response.headers['ETag']
+    cache_control = response.headers['Cache-Control']
+    assert 'immutable' in cache_control and 'max-age=31536000' in cache_control
+    assert 'no-cache' not in cache_control
+
+    assert client.get('/images/sprite.png', headers={'If-None-Match': etag}).status_code == 304
+    partial = client.get('/images/sprite.png', headers={'Range': 'bytes=0-3'})
+    assert partial.status_code == 206
+    assert partial.data == b'\x89PNG'
+    assert client.get('/images/missing.png').status_code == 404
+
+    # The same content under another name gets the same validator
+    Image.new('RGB', (8, 8), 'white').save(tmp_path / 'copy.png')
+    assert client.get('/images/copy.png').headers['ETag'] == etag
+
+
+def test_image_transforms_are_cached(client, monkeypatch, tmp_path):
+    """Test that /images renditions use nearest-neighbour scaling and are served from cache."""
+    from io import BytesIO
+    from PIL import Image
+    from api import main
+    import image_transform
+
+    sprite = Image.new('RGB', (8, 8), 'white')
+    sprite.putpixel((0, 0), (255, 0, 0))
+    sprite.save(tmp_path / 'sprite.png')
+    monkeypatch.setattr(main, 'IMAGES_DIR', str(tmp_path))
+    cache = image_transform.DerivedImageCache(str(tmp_path / 'derived'), max_bytes=1024 ** 2,
+                                              memory_bytes=1024 ** 2, workers=2)
+    monkeypatch.setattr(image_transform, '_default_cache', cache)
+
+    response = client.get('/images/sprite.png?scale=4')
+    assert response.status_code == 200
+    upscaled = Image.open(BytesIO(response.data)).convert('RGB')
+    assert upscaled.size == (32, 32)
+    # Nearest neighbour keeps the red pixel a hard-edged 4x4 block
+    assert upscaled.getpixel((3, 3)) == (255, 0, 0)
+    assert upscaled.getpixel((4, 4)) == (255, 255, 255)
+    assert 'immutable' in response.headers['Cache-Control'] and 'no-cache' not in response.headers['Cache-Control']
+
+    assert client.get('/images/sprite.png?scale=4').data == response.data
+    assert cache.stats()['misses'] == 1 and cache.stats()['memory_hits'] == 1
+    assert client.get('/images/sprite.png?scale=4',
+                      headers={'If-None-Match': response.headers['ETag']}).status_code == 304
+
+    thumbnail = client.get('/images/sprite.png?max_size=4&format=webp')
+    assert thumbnail.mimetype == 'image/webp'
+    assert Image.open(BytesIO(thumbnail.data)).size == (4, 4)
+    # Each rendition is stored on disk under its own format's extension
+    assert sorted(path.suffix for path in (tmp_path / 'derived').glob('*/*')) == ['.png', '.webp']
+    reloaded = image_transform.DerivedImageCache(str(tmp_path / 'derived'), max_bytes=1024 ** 2, workers=1)
+    assert reloaded.disk.stats()['entries'] == 2
+
+    assert client.get('/images/sprite.png?scale=100').status_code == 400
+    assert client.get('/images/sprite.png?format=gif').status_code == 400
+
+
+def test_metrics_endpoint_reports_stage_latency_and_errors(client, monkeypatch, tmp_path, image_index):
+    """Test that /metrics exposes stage histograms, error causes and generated bytes."""
+    from PIL import Image
+    from api import main
+    import gen_prompt
+    import gen_images
+    import metrics
+    from api.jobs import Job
+
+    monkeypatch.setattr(main, 'IMAGES_DIR', str(tmp_path))
+    monkeypatch.setattr(gen_prompt, 'generate_stable_diffusion_prompt',
+                        lambda description, negative='': ('pixel art', 'blurry'))
+    monkeypatch.setattr(gen_images, 'call_draw_things_api_batch',
+                        lambda batch_size=1, **kwargs: [Image.new('RGB', (8, 8), 'white')] * batch_size)
+    saves = metrics.STAGE_SECONDS.count(stage='save')
+    images = metrics.IMAGES_GENERATED.value()
+    main.run_generation(Job(None), 'sword icon', variants=2)
+    metrics.record_error('image', 'timeout')
+
+    assert metrics.STAGE_SECONDS.count(stage='save') == saves + 2
+    assert metrics.IMAGES_GENERATED.value() == images + 2
+
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.content_type.startswith('text/plain; version=0.0.4')
+    body = response.get_data(as_text=True)
+    assert '# TYPE pixelart_stage_duration_seconds histogram' in body
+    assert 'pixelart_stage_duration_seconds_bucket{stage="save",le="+Inf"}' in body
+    assert 'pixelart_stage_errors_total{stage="image",cause="timeout"}' in body
+    assert 'pixelart_stage_in_flight{stage="save"} 0' in body
+    assert 'pixelart_image_bytes_generated_total' in body
+    assert 'pixelart_jobs{status="queued"}' in body
+
+
+def test_duplicate_jobs_are_coalesced_at_submit():
+    """Test that identical jobs attach to the in-flight one without taking a worker."""
+    import threading
+    import time
+    from api.jobs import JobQueue
+
+    queue = JobQueue(workers=2)
+    calls = []
+    releases = [threading.Event(), threading.Event()]
+
+    def generate(job, name):
+        calls.append(job.id)
+        release = releases[len(calls) - 1]
+        job.set_stage('image')
+        if not release.wait(5):
+            raise AssertionError('not released')
+        job.check_cancelled()
+        return {'image_filename': f'{name}-{len(calls)}.png'}
+
+    jobs = [queue.submit(generate, 'sword', coalesce_key='sword') for _ in range(6)]
+    other = queue.submit(lambda job: 'other')
+    deadline = time.time() + 5
+    while other.status != 'succeeded' and time.time() < deadline:
+        time.sleep(0.01)
+    # The duplicates hold no worker, so an unrelated job still runs straight away
+    assert other.status == 'succeeded'
+    assert len(calls) == 1
+    assert [job.status for job in jobs] == ['running'] * 6
+    assert jobs[1].to_dict()['coalesced_with'] == jobs[0].id and jobs[1].stage == 'image'
+
+    # Cancelling a duplicate leaves the others alone; cancelling the leader hands over to the next
+    queue.cancel(jobs[5].id)
+    queue.cancel(jobs[0].id)
+    releases[0].set()
+    while len(calls) < 2 and time.time() < deadline:
+        time.sleep(0.01)
+    assert calls[1] == jobs[1].id
+    releases[1].set()
+    while not all(job.finished for job in jobs) and time.time() < deadline:
+        time.sleep(0.01)
+
+    assert [job.status for job in jobs] == ['cancelled', 'succeeded', 'succeeded', 'succeeded', 'succeeded',
+                                            'cancelled']
+    assert {job.result['image_filename'] for job in jobs[1:5]} == {'sword-2.png'}
+    assert [job.result.get('coalesced', False) for job in jobs[1:5]] == [False, True, True, True]
+    assert [event['event'] for event in jobs[2].events][-1] == 'succeeded'
+    assert 'coalesced' in [event['event'] for event in jobs[2].events]
+
+    # Once the job has finished, an identical submission runs again
+    again = queue.submit(generate, 'sword', coalesce_key='sword')
+    assert again.leader is None
+
+
+def test_generate_coalesces_identical_requests(client, monkeypatch):
+    """Test that /generate attaches a normalized duplicate request to the queued job."""
+    import threading
+    from api import main
+    from api.jobs import JobQueue
+
+    release = threading.Event()
+    monkeypatch.setattr(main, 'job_queue', JobQueue(workers=1))
+    monkeypatch.setattr(main, 'run_generation', lambda job, *args: release.wait(5) and {'image_filename': 'a.png'})
+    try:
+        first = client.post('/generate', json={'prompt': 'Sword  icon'}).get_json()['job_id']
+        second = client.post('/generate', json={'prompt': 'sword icon'}).get_json()['job_id']
+        third = client.post('/generate', json={'prompt': 'sword icon', 'seed': 3}).get_json()['job_id']
+        assert client.get(f'/jobs/{second}').get_json()['coalesced_with'] == first
+        assert client.get(f'/jobs/{third}').get_json()['coalesced_with'] is None
+    finally:
+        release.set()
+    assert _wait_for_job(client, second)['result'] == {'image_filename': 'a.png', 'coalesced': True}
+
+
+def test_job_queue_weighted_fair_order():
+    """Test that a bulk client only gets its share and batch work yields to interactive work."""
+    import threading
+    import time
+    from api.jobs import JobQueue
+
+    queue = JobQueue(workers=1)
+    order = []
+    release = threading.Event()
+    blocker = queue.submit(lambda job: release.wait(5), client='blocker')
+    while blocker.status != 'running':
+        time.sleep(0.01)
+
+    def record(job, name):
+        order.append(name)
+
+    jobs = [queue.submit(record, 'batch', client='ip:c', priority='batch')]
+    jobs += [queue.submit(record, f'bulk{i}', client='ip:a') for i in range(3)]
+    jobs.append(queue.submit(record, 'single', client='ip:b'))
+    assert queue.depths() == {'interactive': 4, 'batch': 1}
+    assert queue.position(jobs[-1]) == 1
+
+    release.set()
+    deadline = time.time() + 5
+    while len(order) < 5 and time.time() < deadline:
+        time.sleep(0.01)
+    assert order == ['bulk0', 'single', 'bulk1', 'bulk2', 'batch']
+    assert queue.stats()['depth'] == 0
+
+
+def test_job_fails_when_start_hook_raises():
+    """Test that a failing on_start hook fails the job instead of leaving it running."""
+    import time
+    from api.jobs import JobQueue
+
+    queue = JobQueue(workers=1)
+    queue.on_start = lambda job: 1 / 0
+    job = queue.submit(lambda job: 'done')
+    deadline = time.time() + 5
+    while not job.finished and time.time() < deadline:
+        time.sleep(0.01)
+    assert job.status == 'failed' and job.events[-1]['event'] == 'failed'
+
+    # The worker survives and keeps serving the queue
+    queue.on_start = None
+    job = queue.submit(lambda job: 'done')
+    while not job.finished and time.time() < deadline:
+        time.sleep(0.01)
+    assert job.result == 'done'
+
+
+def test_generate_rejects_when_queue_is_full(client, monkeypatch):
+    """Test that admission control answers 429 with Retry-After once the queue is full."""
+    import threading
+    import time
+    from api import main
+    from api.jobs import JobQueue
+
+    release = threading.Event()
+    monkeypatch.setattr(main, 'job_queue', JobQueue(workers=1, max_pending=2, max_pending_per_client=1))
+    monkeypatch.setattr(main, 'run_generation', lambda job, *args: release.wait(5) and {})
+    monkeypatch.setattr(main, 'API_KEY_WEIGHTS', {'key:team': 1.0})
+    monkeypatch.setattr(main, 'API_KEY_PRIORITIES', {'key:team': 'batch'})
+    try:
+        running = client.post('/generate', json={'prompt': 'sword'}).get_json()['job_id']
+        while main.job_queue.get(running).status != 'running':
+            time.sleep(0.01)
+
+        assert client.post('/generate', json={'prompt': 'shield'}).status_code == 202
+        response = client.post('/generate', json={'prompt': 'potion'})
+        assert response.status_code == 429
+        assert int(response.headers['Retry-After']) >= 1
+
+        # A configured API key is its own client, in the class configured for it
+        response = client.post('/generate', json={'prompt': 'potion'}, headers={'X-API-Key': 'team'})
+        assert response.status_code == 202
+        status = client.get(response.get_json()['status_url']).get_json()
+        assert status['priority'] == 'batch' and status['queue_position'] == 1
+        # An unknown key is still identified by IP, and callers cannot pick their own priority
+        assert client.post('/generate', json={'prompt': 'gem'}, headers={'X-API-Key': 'other'}).status_code == 429
+        assert client.post('/generate', json={'prompt': 'gem', 'priority': 'batch'},
+                           headers={'X-Priority': 'batch'}).status_code == 429
+
+        stats = client.get('/queue').get_json()
+        assert stats['depth'] == 2 and stats['depth_by_priority'] == {'interactive': 1, 'batch': 1}
+    finally:
+        release.set()
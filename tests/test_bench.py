@@ -0,0 +1,93 @@
+import pytest
+import sys
+import os
+import json
+import base64
+import subprocess
+from io import BytesIO
+
+import requests
+
+# Add the bench and utils directories to the path so we can import the harness modules
+project_root = os.path.join(os.path.dirname(__file__), '..')
+sys.path.insert(0, project_root)
+sys.path.insert(0, os.path.join(project_root, 'utils'))
+sys.path.insert(0, os.path.join(project_root, 'bench'))
+
+from PIL import Image
+
+import run_bench
+import stub_servers
+
+
+@pytest.fixture
+def stubs():
+    """Start both stand-in services on free ports."""
+    servers = stub_servers.start_stub_servers(
+        draw_things=stub_servers.StubBehavior(failure_rate=0.0), image_size=64)
+    yield servers
+    for server in servers:
+        server.shutdown()
+
+
+def test_stub_servers_mimic_backends(stubs):
+    """Test that the stubs answer in the LM Studio and Draw Things response formats."""
+    llm, draw_things = stubs
+    response = requests.post(f'{llm.url}/v1/chat/completions', json={
+        'messages': [{'role': 'user', 'content': 'for this pixel art game asset: iron sword. Positive prompt must'}]
+    })
+    content = response.json()['choices'][0]['message']['content']
+    assert 'iron sword' in content and '|||' in content
+
+    response = requests.post(f'{draw_things.url}/sdapi/v1/txt2img', json={'width': 512, 'batch_size': 2})
+    images = response.json()['images']
+    assert len(images) == 2
+    assert Image.open(BytesIO(base64.b64decode(images[0]))).size == (64, 64)
+    assert requests.get(f'{draw_things.url}/_stub/stats').json() == {'requests': 1, 'failures': 0}
+
+
+def test_stub_failure_injection():
+    """Test that a failure rate of 1 turns every backend call into a 500."""
+    llm, draw_things = stub_servers.start_stub_servers(llm=stub_servers.StubBehavior(failure_rate=1.0))
+    try:
+        response = requests.post(f'{llm.url}/v1/chat/completions', json={'messages': []})
+        assert response.status_code == 500
+        assert requests.get(f'{llm.url}/_stub/stats').json() == {'requests': 1, 'failures': 1}
+    finally:
+        llm.shutdown()
+        draw_things.shutdown()
+
+
+def test_percentiles_and_regressions():
+    """Test the latency percentiles and the baseline comparison."""
+    assert run_bench.percentile([0.1, 0.2, 0.3, 0.4, 0.5], 50) == pytest.approx(0.3)
+    assert run_bench.percentile([1.0], 99) == 1.0
+    assert run_bench.percentile([], 50) is None
+
+    baseline = {'runs': [{'target': 'api', 'concurrency': 4, 'throughput_rps': 10.0,
+                          'latency_ms': {'p95': 100.0}}]}
+    current = [{'target': 'api', 'concurrency': 4, 'throughput_rps': 7.0, 'latency_ms': {'p95': 110.0}}]
+    regressions = run_bench.find_regressions(current, baseline, threshold=0.2)
+    assert [regression['metric'] for regression in regressions] == ['throughput_rps']
+
+
+def test_benchmark_run_writes_results(tmp_path):
+    """Test a small end-to-end run against the stubs for both targets."""
+    output = tmp_path / 'results.json'
+    completed = subprocess.run(
+        [sys.executable, os.path.join(project_root, 'bench', 'run_bench.py'),
+         '--requests', '3', '--concurrency', '1,2', '--image-size', '64',
+         '--llm-latency', '0', '--llm-jitter', '0', '--image-latency', '0', '--image-jitter', '0',
+         '--output', str(output)],
+        cwd=tmp_path, capture_output=True, text=True, timeout=120
+    )
+    assert completed.returncode == 0, completed.stderr
+
+    report = json.loads(output.read_text())
+    assert [(run['target'], run['concurrency']) for run in report['runs']] == [
+        ('api', 1), ('api', 2), ('batch', 1), ('batch', 2)]
+    for run in report['runs']:
+        assert run['succeeded'] == 3 and run['failed'] == 0
+        assert run['latency_ms']['p99'] >= run['latency_ms']['p50'] > 0
+        assert run['backend_calls']['draw_things']['requests'] == 3
+        assert run['memory_mb']['rss_end'] > 0
@@ -0,0 +1,85 @@
+import pytest
+import sys
+import os
+import json
+
+# Add the utils directory to the path so we can import the generation scripts
+project_root = os.path.join(os.path.dirname(__file__), '..')
+sys.path.insert(0, project_root)
+sys.path.insert(0, os.path.join(project_root, 'utils'))
+
+from PIL import Image
+
+import gen_all
+import gen_images
+import gen_prompt
+
+
+@pytest.fixture
+def fake_backends(monkeypatch, tmp_path):
+    """Stub out the LLM and Draw Things calls and save images to a temporary directory."""
+    rendered = []
+
+    def fake_render(batch_size=1, **kwargs):
+        rendered.append(kwargs['prompt'])
+        return [Image.new('RGB', (8, 8), 'white')] * batch_size
+
+    saved = iter(range(1000))
+    monkeypatch.setattr(gen_prompt, 'generate_stable_diffusion_prompt',
+                        lambda description, negative='': (f'pixel art, {description}', negative))
+    monkeypatch.setattr(gen_images, 'call_draw_things_api_batch', fake_render)
+    monkeypatch.setattr(gen_images, 'save_image',
+                        lambda img, **kwargs: tmp_path / f'image_{next(saved)}.png')
+    return rendered
+
+
+def test_batch_manifest_resumes_from_checkpoint(fake_backends, tmp_path):
+    """Test that a batch run processes JSONL/CSV manifests and skips checkpointed items."""
+    manifest = tmp_path / 'assets.jsonl'
+    manifest.write_text('\n'.join(json.dumps({'id': name, 'prompt': name}) for name in ('sword', 'shield', 'potion')))
+    checkpoint = tmp_path / 'assets.checkpoint.jsonl'
+    checkpoint.write_text(json.dumps({'id': 'sword', 'image': 'done.png'}) + '\n{"id": "shie')
+
+    progress = gen_all.run_batch(str(manifest), str(checkpoint), prompt_workers=2, image_workers=1)
+    assert (progress.skipped, progress.done, progress.failed) == (1, 2, 0)
+    assert sorted(fake_backends) == ['pixel art, potion', 'pixel art, shield']
+
+    assert gen_all.run_batch(str(manifest), str(checkpoint)).done == 0
+
+    csv_manifest = tmp_path / 'assets.csv'
+    csv_manifest.write_text('description,negative,seed\nhealth potion,text,7\n')
+    assert gen_all.load_manifest(str(csv_manifest)) == [
+        {'id': '1', 'prompt': 'health potion', 'negative_prompt': 'text', 'seed': 7, 'variants': 1}
+    ]
+
+
+def test_batch_manifest_skips_invalid_rows(tmp_path):
+    """Test that malformed rows are skipped instead of aborting the whole manifest."""
+    manifest = tmp_path / 'assets.jsonl'
+    manifest.write_text('\n'.join([
+        json.dumps({'id': 'sword', 'prompt': 'sword', 'seed': 'abc'}),
+        '{not json',
+        json.dumps({'id': 'shield', 'prompt': 'shield', 'variants': gen_all.MAX_VARIANTS + 1}),
+        json.dumps({'id': 'bow', 'prompt': 'bow', 'variants': 'two'}),
+        json.dumps({'id': 'potion', 'prompt': 'potion', 'seed': -5, 'variants': 2}),
+    ]))
+    assert gen_all.load_manifest(str(manifest)) == [
+        {'id': 'potion', 'prompt': 'potion', 'negative_prompt': '', 'seed': -1, 'variants': 2}
+    ]
+
+
+def test_batch_runs_postprocessing(fake_backends, tmp_path, monkeypatch):
+    """Test that batch items get the same renditions as /generate."""
+    import pipeline
+
+    def fake_native(image_path, img):
+        return image_path.with_name(f'{image_path.stem}_native.png')
+
+    monkeypatch.setattr(pipeline, 'default_postprocessors', lambda: [('native', fake_native)])
+    manifest = tmp_path / 'assets.jsonl'
+    manifest.write_text(json.dumps({'id': 'sword', 'prompt': 'sword'}))
+    checkpoint = tmp_path / 'assets.checkpoint.jsonl'
+
+    assert gen_all.run_batch(str(manifest), str(checkpoint)).done == 1
+    entry = json.loads(checkpoint.read_text())
+    assert entry['renditions'] == [{'native': entry['images'][0].replace('.png', '_native.png')}]
@@ -0,0 +1,284 @@
+import pytest
+import sys
+import os
+import base64
+from io import BytesIO
+
+# Add the utils directory to the path so we can import the generation scripts
+project_root = os.path.join(os.path.dirname(__file__), '..')
+sys.path.insert(0, project_root)
+sys.path.insert(0, os.path.join(project_root, 'utils'))
+
+from PIL import Image
+
+import requests
+
+import gen_images
+import image_cache
+from image_cache import ImageResultCache, payload_hash
+
+
+def _png_bytes(color='white', size=(8, 8)):
+    buffer = BytesIO()
+    Image.new('RGB', size, color).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+class FakeResponse:
+    status_code = 200
+
+    def __init__(self, images):
+        self._images = images
+        self.text = ''
+
+    def json(self):
+        return {'images': [base64.b64encode(data).decode('ascii') for data in self._images]}
+
+
+@pytest.fixture
+def draw_things_calls(monkeypatch, tmp_path):
+    """Replace the Draw Things call with a stub and use a temporary image cache."""
+    calls = []
+
+    def fake_post(url, json=None, **kwargs):
+        calls.append(json)
+        return FakeResponse([_png_bytes()] * json.get('batch_size', 1))
+
+    monkeypatch.setattr(gen_images.get_draw_things_client(), 'post', fake_post)
+    monkeypatch.setattr(image_cache, '_default_cache', ImageResultCache(str(tmp_path / 'cache'), 10 ** 6))
+    return calls
+
+
+def test_pinned_seed_is_served_from_image_cache(draw_things_calls):
+    """Test that a repeated pinned-seed request does not call Draw Things again."""
+    args = dict(prompt='pixel art sword', negative_prompt='blurry', steps=8, cfg=10)
+    assert gen_images.call_draw_things_api(seed=42, **args).size == (8, 8)
+    assert gen_images.call_draw_things_api(seed=42, **args).size == (8, 8)
+    assert len(draw_things_calls) == 1
+
+    gen_images.call_draw_things_api(seed=-1, **args)
+    gen_images.call_draw_things_api(seed=-1, **args)
+    assert len(draw_things_calls) == 3
+
+
+def test_variants_come_from_one_request(draw_things_calls, tmp_path, monkeypatch):
+    """Test that N variants use one txt2img call and are saved to distinct files."""
+    import image_index
+    monkeypatch.setattr(image_index, '_default_index', image_index.ImageIndex(str(tmp_path / 'index.db')))
+    args = dict(prompt='pixel art shield', negative_prompt='blurry', steps=8, cfg=10, seed=7)
+    images = gen_images.call_draw_things_api_batch(batch_size=3, **args)
+    assert len(images) == 3
+    assert draw_things_calls[0]['batch_size'] == 3
+    assert 'batch_size' not in gen_images.build_txt2img_payload('p', 'n', 8, 10)
+
+    assert len(gen_images.call_draw_things_api_batch(batch_size=3, **args)) == 3
+    assert len(draw_things_calls) == 1
+
+    paths = {gen_images.save_image(img, str(tmp_path)) for img in images}
+    assert len(paths) == 3 and all(path.exists() for path in paths)
+
+    # Saving the same cached images again reuses the files and index rows
+    cached = gen_images.call_draw_things_api_batch(batch_size=3, **args)
+    assert {gen_images.save_image(img, str(tmp_path)) for img in cached} == paths
+    assert len(image_index.get_image_index().list()[0]) == 3
+
+
+def test_reused_images_keep_their_renditions(draw_things_calls, tmp_path, monkeypatch):
+    """Test that a cache hit reuses the saved file and its renditions instead of rewriting them."""
+    import image_index
+    from pipeline import GenerationPipeline, GenerationRecord, GenerationRequest
+    monkeypatch.setattr(image_index, '_default_index', image_index.ImageIndex(str(tmp_path / 'index.db')))
+
+    calls = []
+
+    def fake_native(image_path, img):
+        calls.append(image_path)
+        native_path = image_path.with_name(f'{image_path.stem}_native.png')
+        img.save(native_path)
+        return native_path
+
+    pipeline = GenerationPipeline(str(tmp_path), postprocessors=[('native', fake_native)])
+    request = GenerationRequest('sword', seed=7)
+    record = GenerationRecord('pixel art sword', 'blurry')
+    results = []
+    for _ in range(2):
+        images = pipeline.render(request, record)
+        paths = pipeline.save(images, request, record)
+        results.append((paths, pipeline.postprocess(images, paths)))
+
+    assert results[0] == results[1]
+    assert len(calls) == 1 and len(draw_things_calls) == 1
+
+
+def test_image_cache_evicts_by_total_bytes(tmp_path):
+    """Test that the image cache stays under its byte budget, evicting LRU entries."""
+    data = _png_bytes()
+    cache = ImageResultCache(str(tmp_path), max_bytes=len(data) * 2)
+    for key in ('a' * 64, 'b' * 64, 'c' * 64):
+        cache.put(key, data)
+    assert cache.get('a' * 64) is None
+    assert cache.get('c' * 64) == data
+    assert cache.stats()['total_bytes'] <= len(data) * 2
+    assert ImageResultCache(str(tmp_path), max_bytes=len(data) * 2).stats()['entries'] == 2
+    assert payload_hash({'a': 1, 'b': 2}) == payload_hash({'b': 2, 'a': 1})
+
+
+def test_backend_client_retries_connection_errors_and_5xx(monkeypatch):
+    """Test that the pooled backend client retries transient failures with backoff."""
+    from backend_client import BackendClient
+
+    client = BackendClient('test', max_retries=2, backoff_base=0)
+    outcomes = [requests.exceptions.ConnectionError('refused'), 503, 200]
+    seen = []
+
+    def fake_request(method, url, **kwargs):
+        seen.append(kwargs['timeout'])
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        response = requests.Response()
+        response.status_code = outcome
+        response.raw = BytesIO(b'')
+        return response
+
+    monkeypatch.setattr(client.session, 'request', fake_request)
+    assert client.post('http://backend/api').status_code == 200
+    assert seen == [client.timeout] * 3
+
+    outcomes.extend([requests.exceptions.ConnectionError('refused')] * 3)
+    with pytest.raises(requests.exceptions.ConnectionError):
+        client.post('http://backend/api')
+
+
+class FakeClient:
+    """Backend client stub whose behaviour is chosen per backend URL."""
+    connect_timeout = 1
+
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+        self.calls = []
+
+    def post(self, url, **kwargs):
+        self.calls.append(url)
+        if url in self.failing:
+            raise requests.exceptions.ConnectionError('refused')
+        response = requests.Response()
+        response.status_code = 200
+        return response
+
+
+def test_scheduler_prefers_least_loaded_and_fails_over():
+    """Test least-loaded dispatch, failover and unhealthy marking across backends."""
+    backends = gen_images.parse_backend_urls('http://a/txt2img|2, http://b/txt2img')
+    assert backends == [('http://a/txt2img', 2), ('http://b/txt2img', 1)]
+
+    client = FakeClient(failing={'http://a/txt2img'})
+    scheduler = gen_images.DrawThingsScheduler(backends, failure_threshold=1, health_interval=0, client=client)
+
+    busy = scheduler.acquire()
+    assert busy.url == 'http://a/txt2img'
+    assert scheduler.acquire().url == 'http://b/txt2img'
+    scheduler.release(scheduler.backends[1], True, 0.1)
+    scheduler.release(busy, True, 0.1)
+
+    assert scheduler.post({}).status_code == 200
+    assert client.calls == ['http://a/txt2img', 'http://b/txt2img']
+    stats = {backend['url']: backend for backend in scheduler.stats()}
+    assert stats['http://a/txt2img']['healthy'] is False
+    assert stats['http://b/txt2img']['in_flight'] == 0
+
+    client.calls.clear()
+    scheduler.post({})
+    assert client.calls == ['http://b/txt2img']
+
+
+def test_scheduler_fails_over_without_retrying_each_backend(monkeypatch):
+    """Test that a dead backend is tried once, without backoff, before the next one."""
+    import backend_client
+
+    client = backend_client.BackendClient('test', max_retries=2, backoff_base=10)
+    calls = []
+
+    def fake_request(method, url, **kwargs):
+        calls.append(url)
+        if url == 'http://a/txt2img':
+            raise requests.exceptions.ConnectionError('refused')
+        response = requests.Response()
+        response.status_code = 200
+        return response
+
+    monkeypatch.setattr(client.session, 'request', fake_request)
+    monkeypatch.setattr(backend_client.time, 'sleep', lambda seconds: calls.append('sleep'))
+    backends = [('http://a/txt2img', 2), ('http://b/txt2img', 1)]
+    scheduler = gen_images.DrawThingsScheduler(backends, health_interval=0, client=client)
+    assert scheduler.post({}).status_code == 200
+    assert calls == ['http://a/txt2img', 'http://b/txt2img']
+
+    # With a single backend there is nothing to fail over to, so the client still retries
+    calls.clear()
+    scheduler = gen_images.DrawThingsScheduler(backends[:1], health_interval=0, client=client)
+    with pytest.raises(requests.exceptions.ConnectionError):
+        scheduler.post({})
+    assert calls == ['http://a/txt2img', 'sleep'] * 2 + ['http://a/txt2img']
+
+
+def test_png_bytes_are_written_without_reencoding(tmp_path, monkeypatch):
+    """Test that PNGs from the backend are saved byte-for-byte and only decoded on demand."""
+    import image_index
+    monkeypatch.setattr(image_index, '_default_index', image_index.ImageIndex(str(tmp_path / 'index.db')))
+    data = _png_bytes('red', size=(12, 10))
+    image = gen_images.GeneratedImage(data)
+
+    path = gen_images.save_image(image, str(tmp_path), seed=1)
+    assert path.read_bytes() == data
+    assert image._image is None
+    assert image_index.get_image_index().get(path.name)['width'] == 12
+
+    assert gen_images.decode_image(image).getpixel((0, 0)) == (255, 0, 0)
+    saved = gen_images.recompress_png(path)
+    assert saved >= 0
+    assert Image.open(path).convert('RGB').getpixel((0, 0)) == (255, 0, 0)
+    assert image_index.get_image_index().get(path.name)['bytes'] == path.stat().st_size
+
+
+def test_image_ids_are_unique_time_ordered_and_sharded(tmp_path, monkeypatch):
+    """Test that IDs never collide within a millisecond and map straight to shard paths."""
+    import image_index
+    import image_store
+    index = image_index.ImageIndex(str(tmp_path / 'index.db'))
+    monkeypatch.setattr(image_index, '_default_index', index)
+
+    ids = [image_store.new_image_id(timestamp=1700000000.0) for _ in range(1000)]
+    assert len(set(ids)) == 1000 and ids == sorted(ids)
+    assert image_store.new_image_id(timestamp=1700000001.0) > ids[-1]
+    assert image_store.id_timestamp(ids[0]) == 1700000000.0
+
+    path = gen_images.save_image(gen_images.GeneratedImage(_png_bytes()), str(tmp_path))
+    image_id = path.stem
+    assert path == tmp_path / image_id[-2:] / image_id[-4:-2] / f'{image_id}.png'
+    assert image_store.resolve(tmp_path, image_id) == path
+    assert image_store.resolve(tmp_path, f'{image_id}.png') == path
+    assert image_store.resolve(tmp_path, '../index.db') is None
+
+
+def test_migrate_flat_directory(tmp_path):
+    """Test that legacy flat files and their renditions move into the sharded layout."""
+    import image_index
+    import image_store
+    index = image_index.ImageIndex(str(tmp_path / 'index.db'))
+    images_dir = tmp_path / 'images'
+    images_dir.mkdir()
+    (images_dir / 'generated_20240101_120000.png').write_bytes(_png_bytes())
+    (images_dir / 'generated_20240101_120000_native.png').write_bytes(_png_bytes(size=(2, 2)))
+    index.add('generated_20240101_120000.png', record={'positive': 'sword'})
+
+    assert image_store.migrate_flat_directory(images_dir, dry_run=True)
+    assert (images_dir / 'generated_20240101_120000.png').exists()
+
+    mapping = image_store.migrate_flat_directory(images_dir, index=index)
+    new_name = mapping['generated_20240101_120000.png']
+    assert mapping['generated_20240101_120000_native.png'] == new_name.replace('.png', '_native.png')
+    assert not list(images_dir.glob('*.png'))
+    assert image_store.resolve(images_dir, new_name).exists()
+    assert image_store.resolve(images_dir, mapping['generated_20240101_120000_native.png']).exists()
+    assert index.get(new_name)['positive'] == 'sword'
@@ -0,0 +1,227 @@
+import pytest
+import sys
+import os
+
+# Add the utils directory to the path so we can import the generation scripts
+project_root = os.path.join(os.path.dirname(__file__), '..')
+sys.path.insert(0, project_root)
+sys.path.insert(0, os.path.join(project_root, 'utils'))
+
+import gen_prompt
+import prompt_cache
+from prompt_cache import PromptCache
+
+
+class FakeResponse:
+    status_code = 200
+
+    def __init__(self, content):
+        self._content = content
+        self.text = content
+
+    def json(self):
+        return {'choices': [{'message': {'content': self._content}}]}
+
+
+@pytest.fixture
+def llm_calls(monkeypatch):
+    """Replace the LM Studio call with a stub that records each request."""
+    calls = []
+
+    def fake_post(url, **kwargs):
+        calls.append(url)
+        return FakeResponse('pixel art sword icon, white background ||| blurry, text')
+
+    monkeypatch.setattr(gen_prompt.get_lm_studio_client(), 'post', fake_post)
+    monkeypatch.setattr(prompt_cache, '_default_cache', PromptCache(max_entries=8, ttl=0, store_path=''))
+    return calls
+
+
+def test_prompt_cache_skips_repeat_llm_calls(llm_calls):
+    """Test that a repeated description is served from the prompt cache."""
+    first = gen_prompt.generate_stable_diffusion_prompt('Sword  Icon')
+    second = gen_prompt.generate_stable_diffusion_prompt('sword icon')
+    assert first == second
+    assert len(llm_calls) == 1
+    assert prompt_cache.get_prompt_cache().stats()['hits'] == 1
+
+
+def test_prompt_cache_lru_ttl_and_persistence(tmp_path):
+    """Test LRU eviction, expiry and reloading entries from the backing store."""
+    store = str(tmp_path / 'prompts.db')
+    cache = PromptCache(max_entries=2, ttl=0, store_path='')
+    for key in ('a', 'b', 'c'):
+        cache.put(key, (key, 'neg'))
+    assert cache.get('a') is None
+    assert cache.get('c') == ('c', 'neg')
+
+    expired = PromptCache(max_entries=2, ttl=0.001, store_path='')
+    expired._remember('old', ('old', 'neg', 0))
+    assert expired.get('old') is None
+
+    PromptCache(store_path=store).put('persisted', ('pos', 'neg'))
+    assert PromptCache(store_path=store).get('persisted') == ('pos', 'neg')
+
+
+def test_prompt_cache_store_is_pruned(tmp_path):
+    """Test that expired rows and rows beyond the store limit are deleted from SQLite."""
+    import sqlite3
+    store = str(tmp_path / 'prompts.db')
+    cache = PromptCache(ttl=60, store_path=store, store_max_entries=3)
+    cache._save('stale', ('old', 'neg', 0))
+    assert cache.get('stale') is None
+    for key in 'abcde':
+        cache.put(key, (key, 'neg'))
+    cache._save('stale', ('old', 'neg', 0))
+
+    assert cache.prune() == 3
+    rows = sqlite3.connect(store).execute('SELECT key FROM prompt_cache ORDER BY key').fetchall()
+    assert rows == [('c',), ('d',), ('e',)]
+
+
+class FakeStreamResponse:
+    """SSE response stub that records how many chunks were consumed."""
+    status_code = 200
+
+    def __init__(self, deltas):
+        self.deltas = deltas
+        self.consumed = 0
+        self.closed = False
+
+    def iter_lines(self, decode_unicode=False):
+        import json
+        for delta in self.deltas:
+            self.consumed += 1
+            yield 'data: ' + json.dumps({'choices': [{'delta': {'content': delta}}]})
+            yield ''
+        yield 'data: [DONE]'
+
+    def close(self):
+        self.closed = True
+
+
+def test_streamed_completion_stops_once_prompts_are_complete():
+    """Test that streaming stops reading after the negative prompt ends."""
+    deltas = ['Thought: use ', 'pixel art.\n', 'pixel art sword', ' ||| ', 'blurry, text', ' |||',
+              'Explanation: ', 'this prompt ', 'is great']
+    response = FakeStreamResponse(deltas)
+
+    content = gen_prompt.read_streamed_completion(response)
+    assert content == 'Thought: use pixel art.\npixel art sword ||| blurry, text '
+    assert response.consumed == 6
+    assert response.closed
+
+    budget = FakeStreamResponse(['pixel ', 'art ', 'sword ', 'icon'])
+    assert gen_prompt.read_streamed_completion(budget, max_tokens=2) == 'pixel art '
+    assert gen_prompt.find_prompts_end('pixel art ||| ') is None
+
+
+@pytest.mark.parametrize('deltas', [
+    ['pixel sword\n', '||| blurry\n', 'shadows'],
+    ['pixel sword ||| ', '\nblurry, photo'],
+])
+def test_streamed_completion_keeps_multiline_negative_prompt(monkeypatch, deltas):
+    """Test that a negative prompt spanning lines is read whole, as without streaming."""
+    from config import Config
+
+    response = FakeStreamResponse(deltas)
+    assert gen_prompt.read_streamed_completion(response) == ''.join(deltas)
+    assert response.consumed == len(deltas)
+
+    prompts = {}
+    for stream in (False, True):
+        monkeypatch.setattr(Config, 'LM_STUDIO_STREAM', stream)
+        monkeypatch.setattr(gen_prompt.get_lm_studio_client(), 'post', lambda url, stream=False, **kwargs:
+                            FakeStreamResponse(deltas) if stream else FakeResponse(''.join(deltas)))
+        prompts[stream] = gen_prompt.generate_stable_diffusion_prompt('sword', use_cache=False)
+    assert prompts[True] == prompts[False]
+
+
+def test_circuit_breaker_falls_back_without_calling_llm(monkeypatch):
+    """Test that the breaker opens after repeated failures, skips the LLM and closes after a good probe."""
+    import requests
+    import backend_client
+
+    now = [0.0]
+    breaker = backend_client.CircuitBreaker('LM Studio', failure_threshold=2, reset_timeout=30,
+                                            clock=lambda: now[0])
+    monkeypatch.setattr(backend_client, '_lm_studio_breaker', breaker)
+    monkeypatch.setattr(prompt_cache, '_default_cache', PromptCache(max_entries=8, ttl=0, store_path=''))
+
+    calls = []
+    healthy = [False]
+
+    def fake_post(url, **kwargs):
+        calls.append(url)
+        if not healthy[0]:
+            raise requests.exceptions.ConnectionError('refused')
+        return FakeResponse('pixel art sword icon, white background ||| blurry, text')
+
+    monkeypatch.setattr(gen_prompt.get_lm_studio_client(), 'post', fake_post)
+
+    for description in ('sword', 'shield'):
+        gen_prompt.generate_stable_diffusion_prompt(description)
+    assert breaker.state == 'open'
+
+    positive, _ = gen_prompt.generate_stable_diffusion_prompt('potion', 'text')
+    assert len(calls) == 2
+    assert positive == gen_prompt.fallback_prompts('potion', 'text')[0]
+    assert breaker.stats()['short_circuits'] == 1
+
+    # After the reset timeout a single probe goes through and closes the breaker
+    now[0] = 31
+    healthy[0] = True
+    assert breaker.state == 'half_open'
+    positive, _ = gen_prompt.generate_stable_diffusion_prompt('potion')
+    assert len(calls) == 3
+    assert positive.startswith('pixel art sword icon')
+    assert breaker.state == 'closed'
+
+
+def test_circuit_breaker_half_open_allows_one_probe():
+    """Test that a half-open breaker admits one probe and reopens if it fails."""
+    import backend_client
+
+    now = [0.0]
+    breaker = backend_client.CircuitBreaker('test', failure_threshold=1, reset_timeout=10, clock=lambda: now[0])
+    breaker.record_failure()
+    assert not breaker.allow_request()
+
+    now[0] = 10
+    assert breaker.allow_request()
+    assert not breaker.allow_request()
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    assert breaker.stats()['retry_in'] == 10
+
+
+def test_concurrent_identical_prompts_share_one_llm_call(monkeypatch):
+    """Test that the pipeline coalesces prompt expansion for identical in-flight descriptions."""
+    import threading
+    import pipeline
+    from metrics import COALESCED_REQUESTS
+
+    calls = []
+    release = threading.Event()
+
+    def slow_prompt(description, negative=''):
+        calls.append(description)
+        release.wait(5)
+        return f'pixel art, {description}', 'blurry'
+
+    monkeypatch.setattr(gen_prompt, 'generate_stable_diffusion_prompt', slow_prompt)
+    stage = pipeline.GenerationPipeline(postprocessors=[])
+    coalesced = COALESCED_REQUESTS.value(stage='prompt')
+    records = []
+    threads = [threading.Thread(target=lambda d=d: records.append(stage.expand_prompt(pipeline.GenerationRequest(d))))
+               for d in ('Iron Sword', 'iron sword ')]
+    for thread in threads:
+        thread.start()
+    while COALESCED_REQUESTS.value(stage='prompt') == coalesced:
+        pass
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert len(calls) == 1
+    assert [record.positive for record in records] == ['pixel art, Iron Sword'] * 2
@@ -0,0 +1,158 @@
+import json
+import sys
+import os
+
+# Add the utils directory to the path so we can import the post-processing scripts
+project_root = os.path.join(os.path.dirname(__file__), '..')
+sys.path.insert(0, project_root)
+sys.path.insert(0, os.path.join(project_root, 'utils'))
+
+import numpy as np
+import pytest
+from PIL import Image, ImageFilter
+
+import atlas
+import background
+import palette
+import pixel_grid
+
+
+def _upscaled_sprite(size=32, cell=12, offset=5, seed=0):
+    """A random sprite upscaled with nearest neighbour, shifted, noisy and slightly blurred"""
+    rng = np.random.default_rng(seed)
+    palette = rng.integers(0, 256, (6, 3))
+    sprite = palette[rng.integers(0, 6, (size, size))].astype(np.uint8)
+    big = np.kron(sprite, np.ones((cell, cell, 1), dtype=np.uint8))
+    big = np.pad(big, ((offset, 0), (offset, 0), (0, 0)), mode='edge')
+    big = np.clip(big.astype(int) + rng.integers(-6, 7, big.shape), 0, 255).astype(np.uint8)
+    return sprite, Image.fromarray(big).filter(ImageFilter.GaussianBlur(0.7))
+
+
+def test_detects_grid_and_recovers_native_sprite(tmp_path):
+    sprite, img = _upscaled_sprite()
+
+    grid = pixel_grid.detect_grid(img)
+    assert (grid.cell_size, grid.offset_x, grid.offset_y) == (12, 5, 5)
+    assert (grid.cols, grid.rows) == (32, 32)
+
+    image_path = tmp_path / 'generated.png'
+    img.save(image_path)
+    native_path = pixel_grid.save_native_sprite(image_path, img)
+    assert native_path == tmp_path / 'generated_native.png'
+    native = np.asarray(Image.open(native_path)).astype(int)
+    assert native.shape == sprite.shape
+    assert np.abs(native - sprite).max() <= 8
+
+
+def test_noise_has_no_grid(tmp_path):
+    noise = np.random.default_rng(1).integers(0, 256, (256, 256, 3)).astype(np.uint8)
+    image_path = tmp_path / 'noise.png'
+    assert pixel_grid.save_native_sprite(image_path, Image.fromarray(noise)) is None
+    assert not (tmp_path / 'noise_native.png').exists()
+
+
+def test_quantize_writes_indexed_png(tmp_path):
+    _, img = _upscaled_sprite(cell=8, offset=0)
+    image_path = tmp_path / 'generated.png'
+    img.save(image_path)
+
+    indexed_path = palette.save_indexed_image(image_path, img, n_colors=6)
+    indexed = Image.open(indexed_path)
+    assert indexed_path.name == 'generated_indexed.png'
+    assert indexed.mode == 'P'
+    assert len(indexed.getcolors()) <= 6
+    assert indexed_path.stat().st_size < image_path.stat().st_size
+
+
+def test_shared_palette_is_used_across_a_directory(tmp_path):
+    for seed in range(3):
+        _upscaled_sprite(cell=8, offset=0, seed=seed)[1].save(tmp_path / f'sprite_{seed}.png')
+    palette_path = tmp_path / 'project.hex'
+    palette_path.write_text('#000000\n#ffffff\nff0000\n', encoding='utf-8')
+    shared = palette.load_palette(str(palette_path))
+
+    results = palette.quantize_directory(tmp_path, tmp_path / 'out', palette=shared, workers=2)
+    assert len(results) == 3
+    for _, output_path, _, _ in results:
+        colors = {color for _, color in Image.open(output_path).convert('RGB').getcolors()}
+        assert colors <= {(0, 0, 0), (255, 255, 255), (255, 0, 0)}
+
+
+def test_transparent_pixels_keep_a_reserved_index():
+    rgba = np.zeros((16, 16, 4), dtype=np.uint8)
+    rgba[4:12, 4:12] = (200, 40, 40, 255)
+    indexed = palette.quantize_image(Image.fromarray(rgba), n_colors=4)
+    assert indexed.info['transparency'] == 0
+    assert np.asarray(indexed)[0, 0] == 0
+    assert np.asarray(indexed.convert('RGBA'))[8, 8].tolist() == [200, 40, 40, 255]
+
+
+def test_palette_size_is_bounded(monkeypatch):
+    import pipeline
+
+    colorful = np.random.default_rng(0).integers(0, 256, (32, 32, 3), dtype=np.uint8)
+    with pytest.raises(ValueError):
+        palette.quantize_image(Image.fromarray(colorful), palette=np.random.default_rng(1).integers(0, 256, (300, 3)))
+
+    monkeypatch.setattr(pipeline.Config, 'PALETTE_COLORS', 1000)
+    monkeypatch.setattr(pipeline.Config, 'PALETTE_PATH', '')
+    (name, quantize), = [step for step in pipeline.default_postprocessors() if step[0] == 'indexed']
+    assert quantize.keywords['n_colors'] == palette.MAX_COLORS
+
+
+def test_background_becomes_alpha_and_is_cropped(tmp_path):
+    pixels = np.full((64, 64, 3), 250, dtype=np.uint8)
+    pixels[16:48, 8:40] = (30, 30, 30)
+    pixels[24:40, 16:32] = 255  # white highlight enclosed by the outline must stay opaque
+    image_path = tmp_path / 'generated.png'
+    Image.fromarray(pixels).save(image_path)
+
+    results = background.process_directory(tmp_path, workers=1)
+    assert results == [(str(image_path), str(tmp_path / 'generated_alpha.png'))]
+    sprite = Image.open(tmp_path / 'generated_alpha.png')
+    assert sprite.mode == 'RGBA'
+    assert sprite.size == (32, 32)
+    alpha = np.asarray(sprite)[..., 3]
+    assert alpha.min() == 255
+
+
+def test_flood_fill_only_reaches_border_connected_pixels():
+    mask = np.array([
+        [1, 1, 1, 1, 1],
+        [1, 0, 0, 0, 1],
+        [1, 0, 1, 0, 1],
+        [1, 0, 0, 0, 0],
+        [1, 1, 1, 0, 1],
+    ], dtype=bool)
+    reached = background.flood_fill_from_border(mask)
+    expected = mask.copy()
+    expected[2, 2] = False  # enclosed, so it is not background
+    assert reached.tolist() == expected.tolist()
+
+
+def test_atlas_packs_trimmed_sprites_without_overlap(tmp_path):
+
+    paths = []
+    for index in range(20):
+        rgba = np.zeros((40, 40, 4), dtype=np.uint8)
+        rgba[5:5 + 10 + index, 3:33] = (index * 10, 100, 200, 255)
+        path = tmp_path / f'sprite_{index}.png'
+        Image.fromarray(rgba).save(path)
+        paths.append(path)
+
+    results = atlas.pack_atlases(paths, tmp_path / 'out', max_size=128, padding=2, trim=True)
+    assert sum(result['count'] for result in results) == 20
+    assert len(results) > 1
+
+    for result in results:
+        width, height = result['size']
+        assert width & (width - 1) == 0 and height & (height - 1) == 0
+        frames = json.loads(result['frames'].read_text())['frames']
+        occupied = np.zeros((height, width), dtype=int)
+        for name, frame in frames.items():
+            rect = frame['frame']
+            index = int(name.split('_')[1].split('.')[0])
+            assert frame['trimmed'] and frame['sourceSize'] == {'w': 40, 'h': 40}
+            assert frame['spriteSourceSize'] == {'x': 3, 'y': 5, 'w': 30, 'h': 10 + index}
+            occupied[rect['y']:rect['y'] + rect['h'], rect['x']:rect['x'] + rect['w']] += 1
+        assert occupied.max() == 1
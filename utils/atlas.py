@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+"""
+把生成的精灵打包成一张或多张 2 的幂尺寸的纹理图集，并输出 JSON 帧表
+
+游戏引擎逐个加载 GENERATED_IMAGES_DIR 中的 PNG 时，每个素材都要打开一次文件、绑定一次纹理。
+这里用 skyline（bottom-left）装箱算法把精灵排进图集，支持间距（padding）和裁剪透明边（trim），
+帧表使用 TexturePacker 的 JSON hash 格式，常见引擎（Phaser、PixiJS 等）都能直接读取。
+"""
+
+import sys
+import json
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from PIL import Image
+
+from image_store import DERIVED_SUFFIXES
+
+
+@dataclass
+class Sprite:
+    """待打包的精灵：源文件、原始尺寸和裁剪后保留的区域"""
+    name: str
+    path: Path
+    source_size: Tuple[int, int]
+    # 裁剪后保留的区域 (left, top, right, bottom)，未裁剪时为整张图
+    bbox: Tuple[int, int, int, int]
+
+    @property
+    def width(self) -> int:
+        return self.bbox[2] - self.bbox[0]
+
+    @property
+    def height(self) -> int:
+        return self.bbox[3] - self.bbox[1]
+
+    @property
+    def trimmed(self) -> bool:
+        return self.bbox != (0, 0) + self.source_size
+
+
+class SkylinePacker:
+    """
+    Skyline bottom-left 装箱
+
+    用一条由水平线段组成的"天际线"记录已占用区域的上沿，每个矩形放在能让其底边最低的位置。
+    每次插入只需遍历天际线线段，比 MaxRects 维护空闲矩形列表快得多，适合上千个精灵。
+    """
+
+    def __init__(self, width: int, height: int):
+        self.width = width
+        self.height = height
+        # 每个线段为 [x, y, width]
+        self.skyline = [[0, 0, width]]
+
+    def _fit(self, index: int, width: int, height: int) -> Optional[int]:
+        """矩形左边对齐第 index 个线段时的 y 坐标；放不下时返回 None"""
+        x = self.skyline[index][0]
+        if x + width > self.width:
+            return None
+        y = 0
+        remaining = width
+        while remaining > 0:
+            y = max(y, self.skyline[index][1])
+            if y + height > self.height:
+                return None
+            remaining -= self.skyline[index][2]
+            index += 1
+        return y
+
+    def insert(self, width: int, height: int) -> Optional[Tuple[int, int]]:
+        """放入一个矩形，返回左上角坐标；放不下时返回 None"""
+        best = None
+        for index in range(len(self.skyline)):
+            y = self._fit(index, width, height)
+            if y is None:
+                continue
+            # 底边最低优先，其次选更窄的线段以减少碎片
+            key = (y + height, self.skyline[index][2])
+            if best is None or key < best[0]:
+                best = (key, index, self.skyline[index][0], y)
+        if best is None:
+            return None
+        _, index, x, y = best
+        self._add_level(index, x, y + height, width)
+        return x, y
+
+    def _add_level(self, index: int, x: int, y: int, width: int):
+        self.skyline.insert(index, [x, y, width])
+        right = x + width
+        # 截掉被新线段覆盖的部分
+        i = index + 1
+        while i < len(self.skyline):
+            node = self.skyline[i]
+            if node[0] >= right:
+                break
+            shrink = right - node[0]
+            if node[2] <= shrink:
+                del self.skyline[i]
+                continue
+            node[0] += shrink
+            node[2] -= shrink
+            break
+        # 合并高度相同的相邻线段
+        i = 0
+        while i < len(self.skyline) - 1:
+            if self.skyline[i][1] == self.skyline[i + 1][1]:
+                self.skyline[i][2] += self.skyline[i + 1][2]
+                del self.skyline[i + 1]
+            else:
+                i += 1
+
+
+def _pack_into(sprites: List[Sprite], width: int, height: int, padding: int):
+    """
+    尽量把精灵放进一张 width x height 的图集
+
+    每个矩形按 (w + padding, h + padding) 放进 (width - padding, height - padding) 的箱子，
+    最终坐标再偏移 padding，这样精灵之间以及精灵与图集边缘之间都留有 padding 像素。
+
+    Returns:
+        tuple: (已放置的 {name: (x, y)}, 未放下的精灵列表)
+    """
+    packer = SkylinePacker(width - padding, height - padding)
+    placed = {}
+    rejected = []
+    for sprite in sprites:
+        position = packer.insert(sprite.width + padding, sprite.height + padding)
+        if position is None:
+            rejected.append(sprite)
+        else:
+            placed[sprite.name] = (position[0] + padding, position[1] + padding)
+    return placed, rejected
+
+
+def _power_of_two_sizes(min_side: int, max_size: int) -> List[Tuple[int, int]]:
+    """按面积从小到大排列的候选图集尺寸（宽高都是 2 的幂，宽不小于高且最多为高的两倍）"""
+    side = 1
+    while side < min_side:
+        side *= 2
+    sides = []
+    while side <= max_size:
+        sides.append(side)
+        side *= 2
+    sizes = [(w, h) for w in sides for h in sides if h <= w <= 2 * h]
+    return sorted(sizes, key=lambda size: (size[0] * size[1], size[0]))
+
+
+def plan_atlases(sprites: List[Sprite], max_size: int = 2048, padding: int = 2) -> List[Dict]:
+    """
+    把精灵分配到一张或多张图集
+
+    每张图集先尝试能放下全部剩余精灵的最小 2 的幂尺寸；最大尺寸也放不下时，
+    按最大尺寸装满一张，剩下的精灵进入下一张图集。
+
+    Returns:
+        list: 每张图集的 {"size": (w, h), "placements": {name: (x, y)}}
+    """
+    for sprite in sprites:
+        if sprite.width + 2 * padding > max_size or sprite.height + 2 * padding > max_size:
+            raise ValueError(f"精灵 {sprite.name} ({sprite.width}x{sprite.height}) 超过图集最大尺寸 {max_size}")
+
+    # 高度优先降序排列，skyline 装箱的利用率最好
+    remaining = sorted(sprites, key=lambda sprite: (sprite.height, sprite.width), reverse=True)
+    atlases = []
+    while remaining:
+        area = sum((sprite.width + padding) * (sprite.height + padding) for sprite in remaining)
+        min_side = max(max(sprite.width, sprite.height) for sprite in remaining) + 2 * padding
+        for width, height in _power_of_two_sizes(min_side, max_size):
+            if width * height < area:
+                continue
+            placed, rejected = _pack_into(remaining, width, height, padding)
+            if not rejected:
+                break
+        else:
+            width = height = max_size
+            placed, rejected = _pack_into(remaining, width, height, padding)
+        atlases.append({"size": (width, height), "placements": placed})
+        remaining = rejected
+    return atlases
+
+
+def _measure(path: Path, trim: bool) -> Sprite:
+    """读取精灵尺寸，需要裁剪时计算不透明像素的包围盒（不保留像素数据）"""
+    with Image.open(path) as img:
+        size = img.size
+        bbox = (0, 0) + size
+        if trim and (img.mode in ("RGBA", "LA") or "transparency" in img.info):
+            alpha_bbox = img.convert("RGBA").getchannel("A").getbbox()
+            if alpha_bbox:
+                bbox = alpha_bbox
+    return Sprite(name=path.name, path=path, source_size=size, bbox=bbox)
+
+
+def load_sprites(paths, trim: bool = False, workers: int = 8) -> List[Sprite]:
+    """并行读取一组精灵的尺寸信息"""
+    paths = [Path(path) for path in paths]
+    names = [path.name for path in paths]
+    if len(set(names)) != len(names):
+        raise ValueError("精灵文件名必须唯一，帧表以文件名为键")
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(lambda path: _measure(path, trim), paths))
+
+
+def collect_images(images_dir, rendition: str = None) -> List[Path]:
+    """
+    列出目录（包括分片子目录）中的精灵文件
+
+    Args:
+        images_dir: 图像目录
+        rendition: 派生文件类型（native、alpha、indexed）；为空时使用原图
+    """
+    images_dir = Path(images_dir)
+    if rendition:
+        return sorted(images_dir.rglob(f"*_{rendition}.png"))
+    return sorted(path for path in images_dir.rglob("*.png") if not path.stem.endswith(DERIVED_SUFFIXES))
+
+
+def frame_map(sprites: Dict[str, Sprite], placements: Dict[str, Tuple[int, int]],
+              image_name: str, size: Tuple[int, int]) -> Dict:
+    """生成一张图集的 TexturePacker JSON hash 帧表"""
+    frames = {}
+    for name, (x, y) in sorted(placements.items()):
+        sprite = sprites[name]
+        frames[name] = {
+            "frame": {"x": x, "y": y, "w": sprite.width, "h": sprite.height},
+            "rotated": False,
+            "trimmed": sprite.trimmed,
+            "spriteSourceSize": {"x": sprite.bbox[0], "y": sprite.bbox[1], "w": sprite.width, "h": sprite.height},
+            "sourceSize": {"w": sprite.source_size[0], "h": sprite.source_size[1]},
+        }
+    return {
+        "frames": frames,
+        "meta": {
+            "app": "pixel-art-generator",
+            "image": image_name,
+            "format": "RGBA8888",
+            "size": {"w": size[0], "h": size[1]},
+            "scale": "1",
+        },
+    }
+
+
+def pack_atlases(paths, output_dir, name: str = "atlas", max_size: int = 2048,
+                 padding: int = 2, trim: bool = False) -> List[Dict]:
+    """
+    把一组精灵打包成图集并写入 output_dir
+
+    Args:
+        paths: 精灵文件路径
+        output_dir: 输出目录
+        name: 输出文件名前缀，生成 <name>_0.png / <name>_0.json ...
+        max_size: 图集最大边长（2 的幂）
+        padding: 精灵之间及与边缘之间的间距
+        trim: 是否裁掉精灵四周的透明像素
+
+    Returns:
+        list: 每张图集的 {"image": png 路径, "frames": json 路径, "size": (w, h), "count": 精灵数}
+    """
+    sprites = load_sprites(paths, trim)
+    if not sprites:
+        raise ValueError("没有可打包的精灵")
+    by_name = {sprite.name: sprite for sprite in sprites}
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    results = []
+    for index, plan in enumerate(plan_atlases(sprites, max_size, padding)):
+        image_path = output_dir / f"{name}_{index}.png"
+        frames_path = output_dir / f"{name}_{index}.json"
+        atlas = Image.new("RGBA", plan["size"], (0, 0, 0, 0))
+        # 逐个打开并粘贴，同一时间只有一张精灵的像素在内存中
+        for sprite_name, position in plan["placements"].items():
+            sprite = by_name[sprite_name]
+            with Image.open(sprite.path) as img:
+                atlas.paste(img.convert("RGBA").crop(sprite.bbox), position)
+        atlas.save(image_path, format="PNG", optimize=True)
+        with open(frames_path, "w", encoding="utf-8") as f:
+            json.dump(frame_map(by_name, plan["placements"], image_path.name, plan["size"]), f, indent=2)
+        results.append({
+            "image": image_path,
+            "frames": frames_path,
+            "size": plan["size"],
+            "count": len(plan["placements"]),
+        })
+    return results
+
+
+def main(argv=None):
+    """主函数：把目录或文件列表中的精灵打包成图集"""
+    parser = argparse.ArgumentParser(description="把生成的精灵打包成纹理图集")
+    parser.add_argument("inputs", nargs="*", default=["generated_images"], help="精灵目录或 PNG 文件")
+    parser.add_argument("--output-dir", default="atlases", help="输出目录（默认 atlases）")
+    parser.add_argument("--name", default="atlas", help="输出文件名前缀（默认 atlas）")
+    parser.add_argument("--rendition", choices=["native", "alpha", "indexed"],
+                        help="打包目录中的某种派生文件，而不是原图")
+    parser.add_argument("--max-size", type=int, default=2048, help="图集最大边长（默认 2048）")
+    parser.add_argument("--padding", type=int, default=2, help="精灵间距（默认 2）")
+    parser.add_argument("--trim", action="store_true", help="裁掉精灵四周的透明像素")
+    args = parser.parse_args(argv)
+
+    if args.max_size & (args.max_size - 1):
+        parser.error("--max-size 必须是 2 的幂")
+
+    paths = []
+    for item in args.inputs:
+        item = Path(item)
+        paths.extend(collect_images(item, args.rendition) if item.is_dir() else [item])
+
+    try:
+        results = pack_atlases(paths, args.output_dir, args.name, args.max_size, args.padding, args.trim)
+    except ValueError as e:
+        print(f"❌ {e}")
+        return 1
+    for result in results:
+        width, height = result["size"]
+        print(f"🧩 {result['image']} ({width}x{height}): {result['count']} 个精灵, 帧表 {result['frames']}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
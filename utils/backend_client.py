@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+"""
+LM Studio 与 Draw Things 共用的 HTTP 客户端层：连接池复用、
+分别配置的连接/读取超时，以及带抖动退避的有限重试
+"""
+
+import os
+import sys
+import time
+import random
+import threading
+import inspect
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Get the project root directory to import config
+current_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parent_dir = os.path.dirname(current_dir)
+if parent_dir not in sys.path:
+    sys.path.insert(0, parent_dir)
+
+try:
+    from config import Config
+except ImportError:
+    Config = None
+
+
+def _setting(name, default):
+    return getattr(Config, name, default) if Config is not None else default
+
+
+class BackendClient:
+    """
+    面向单个后端服务的 HTTP 客户端
+
+    所有线程共享同一个 requests.Session，连接由 urllib3 连接池保持 keep-alive，
+    建立连接的开销只在每个池连接上支付一次。连接失败和 5xx 响应按指数退避
+    （full jitter）重试；读取超时不重试，避免一次慢生成被重复提交。
+    """
+
+    RETRY_STATUS_CODES = (500, 502, 503, 504)
+
+    def __init__(self, name: str, connect_timeout: float = 5.0, read_timeout: float = 60.0,
+                 max_retries: int = 2, backoff_base: float = 0.5, backoff_max: float = 8.0,
+                 pool_size: int = 8, gzip: bool = True):
+        self.name = name
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max(0, int(max_retries))
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers["Accept-Encoding"] = "gzip, deflate" if gzip else "identity"
+
+    @property
+    def timeout(self):
+        return (self.connect_timeout, self.read_timeout)
+
+    def backoff(self, attempt: int) -> float:
+        """第 attempt 次重试前的等待时间（秒）"""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def request(self, method: str, url: str, retries: int = None, **kwargs) -> requests.Response:
+        """
+        发送请求，连接错误和 5xx 响应会自动重试
+
+        Args:
+            retries: 本次请求的重试次数，默认使用 max_retries；调用方自己切换后端时传 0
+
+        Returns:
+            requests.Response: 最后一次尝试的响应
+
+        Raises:
+            requests.exceptions.RequestException: 重试耗尽后仍无法连接，或读取超时
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        max_retries = self.max_retries if retries is None else max(0, int(retries))
+        for attempt in range(max_retries + 1):
+            last_attempt = attempt == max_retries
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except requests.exceptions.ConnectionError as e:
+                if last_attempt:
+                    raise
+                print(f"⚠️  {self.name} 连接失败，准备重试 ({attempt + 1}/{max_retries}): {e}")
+            else:
+                if response.status_code not in self.RETRY_STATUS_CODES or last_attempt:
+                    return response
+                print(f"⚠️  {self.name} 返回 {response.status_code}，准备重试 ({attempt + 1}/{max_retries})")
+                response.close()
+            time.sleep(self.backoff(attempt))
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def _get_client(name: str, connect_timeout: float, read_timeout: float) -> BackendClient:
+    with _clients_lock:
+        client = _clients.get(name)
+        if client is None:
+            client = BackendClient(
+                name,
+                connect_timeout=connect_timeout,
+                read_timeout=read_timeout,
+                max_retries=_setting("BACKEND_MAX_RETRIES", 2),
+                backoff_base=_setting("BACKEND_BACKOFF_BASE", 0.5),
+                backoff_max=_setting("BACKEND_BACKOFF_MAX", 8.0),
+                pool_size=_setting("BACKEND_POOL_SIZE", 8),
+                gzip=_setting("BACKEND_GZIP", True),
+            )
+            _clients[name] = client
+        return client
+
+
+def get_lm_studio_client() -> BackendClient:
+    """获取进程内共享的 LM Studio 客户端"""
+    return _get_client(
+        "LM Studio",
+        _setting("LM_STUDIO_CONNECT_TIMEOUT", 5.0),
+        _setting("LM_STUDIO_READ_TIMEOUT", 120.0),
+    )
+
+
+def get_draw_things_client() -> BackendClient:
+    """获取进程内共享的 Draw Things 客户端"""
+    return _get_client(
+        "Draw Things",
+        _setting("DRAW_THINGS_CONNECT_TIMEOUT", 5.0),
+        _setting("DRAW_THINGS_READ_TIMEOUT", 300.0),
+    )
+
+
+class CircuitBreaker:
+    """
+    后端熔断器
+
+    连续失败 failure_threshold 次后打开：此后的请求不再访问后端，由调用方立即走降级逻辑。
+    打开 reset_timeout 秒后进入半开状态，放行一个探测请求；探测成功则关闭，失败则重新打开。
+    failure_threshold 为 0 时熔断器始终关闭。
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+    # 用于指标输出的状态编号
+    STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(self, name: str, failure_threshold: int = 3, reset_timeout: float = 30.0,
+                 clock=time.monotonic):
+        self.name = name
+        self.failure_threshold = max(0, int(failure_threshold))
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = None
+        self._probe_started_at = None
+        self._trips = 0
+        self._short_circuits = 0
+        self._lock = threading.Lock()
+        self._publish_state()
+
+    def _publish_state(self):
+        from metrics import CIRCUIT_STATE
+        CIRCUIT_STATE.set(self.STATE_VALUES[self._state], backend=self.name)
+
+    def _transition(self, state: str):
+        """切换状态（调用方需持有锁）"""
+        if state != self._state:
+            print(f"🔌 {self.name} 熔断器: {self._state} -> {state}")
+            self._state = state
+            self._publish_state()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == self.OPEN and self._clock() - self._opened_at >= self.reset_timeout:
+                return self.HALF_OPEN
+            return self._state
+
+    def allow_request(self) -> bool:
+        """
+        判断本次请求是否可以访问后端；返回 False 时调用方应立即降级
+        """
+        from metrics import CIRCUIT_SHORT_CIRCUITS
+
+        with self._lock:
+            now = self._clock()
+            if self._state == self.OPEN and now - self._opened_at >= self.reset_timeout:
+                self._transition(self.HALF_OPEN)
+                self._probe_started_at = None
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.HALF_OPEN:
+                # 同一时间只放行一个探测请求；探测迟迟没有结果时允许下一个
+                if self._probe_started_at is None or now - self._probe_started_at >= self.reset_timeout:
+                    self._probe_started_at = now
+                    return True
+            self._short_circuits += 1
+        CIRCUIT_SHORT_CIRCUITS.inc(backend=self.name)
+        return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._probe_started_at = None
+            self._transition(self.CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probe_started_at = None
+            if self.failure_threshold and (self._state == self.HALF_OPEN
+                                           or self._failures >= self.failure_threshold):
+                if self._state != self.OPEN:
+                    self._trips += 1
+                self._opened_at = self._clock()
+                self._transition(self.OPEN)
+
+    def stats(self) -> dict:
+        state = self.state
+        with self._lock:
+            retry_in = None
+            if self._state == self.OPEN and state == self.OPEN:
+                retry_in = round(max(0.0, self.reset_timeout - (self._clock() - self._opened_at)), 3)
+            return {
+                "name": self.name,
+                "state": state,
+                "consecutive_failures": self._failures,
+                "failure_threshold": self.failure_threshold,
+                "reset_timeout": self.reset_timeout,
+                "retry_in": retry_in,
+                "trips": self._trips,
+                "short_circuits": self._short_circuits,
+            }
+
+
+_lm_studio_breaker = None
+
+
+def get_lm_studio_breaker() -> CircuitBreaker:
+    """获取进程内共享的 LM Studio 熔断器"""
+    global _lm_studio_breaker
+    with _clients_lock:
+        if _lm_studio_breaker is None:
+            _lm_studio_breaker = CircuitBreaker(
+                "LM Studio",
+                failure_threshold=_setting("LM_STUDIO_BREAKER_THRESHOLD", 3),
+                reset_timeout=_setting("LM_STUDIO_BREAKER_RESET", 30.0),
+            )
+        return _lm_studio_breaker
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+把生成图像的纯白背景转换为透明通道
+
+提示词统一要求纯白背景（见 gen_prompt.py 的系统提示词和 "white background" 后缀）。
+这里从图像边缘出发，对接近白色的像素做连通填充（只有与边缘连通的白色才算背景，
+精灵内部的白色高光会保留），把背景写入 alpha 通道，再裁剪到内容的包围盒并保存为 RGBA PNG。
+"""
+
+import sys
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import List, Optional
+
+import numpy as np
+from PIL import Image
+
+from image_store import DERIVED_SUFFIXES
+
+# 每个通道与纯白（255）的差值不超过该值时视为背景色
+DEFAULT_TOLERANCE = 24
+
+
+def _run_ids(mask: np.ndarray) -> np.ndarray:
+    """给每一行中连续为 True 的像素段编号（从 1 开始，False 处的编号无意义）"""
+    previous = np.zeros_like(mask)
+    previous[:, 1:] = mask[:, :-1]
+    starts = mask & ~previous
+    return np.cumsum(starts.ravel()).reshape(mask.shape)
+
+
+def flood_fill_from_border(mask: np.ndarray) -> np.ndarray:
+    """
+    求 mask 中与图像边缘四连通的区域
+
+    向量化实现：预先给每一行、每一列的连续段编号，然后交替做"整行段传播"和"整列段传播"——
+    一段中只要有一个像素被触达，整段都被触达。迭代次数取决于连通路径的拐弯次数，而不是长度。
+    """
+    row_ids = _run_ids(mask)
+    col_ids = _run_ids(mask.T).T
+
+    reached = np.zeros_like(mask)
+    reached[0, :] = mask[0, :]
+    reached[-1, :] = mask[-1, :]
+    reached[:, 0] |= mask[:, 0]
+    reached[:, -1] |= mask[:, -1]
+
+    count = int(reached.sum())
+    while True:
+        for ids in (row_ids, col_ids):
+            hit = np.zeros(int(ids.max()) + 1, dtype=bool)
+            hit[ids[reached]] = True
+            reached = mask & hit[ids]
+        new_count = int(reached.sum())
+        if new_count == count:
+            return reached
+        count = new_count
+
+
+def remove_background(img: Image.Image, tolerance: int = DEFAULT_TOLERANCE,
+                      crop: bool = True, padding: int = 0) -> Optional[Image.Image]:
+    """
+    把与边缘连通的白色背景变为透明
+
+    Args:
+        img: 原始图像
+        tolerance: 每个通道与 255 的最大差值
+        crop: 是否裁剪到内容包围盒
+        padding: 裁剪时在包围盒四周保留的透明像素
+
+    Returns:
+        PIL.Image: RGBA 图像；整张图都是背景时返回 None
+    """
+    rgba = np.array(img.convert("RGBA"))
+    white = (rgba[..., :3] >= 255 - tolerance).all(axis=2)
+    background = flood_fill_from_border(white)
+    rgba[background, 3] = 0
+
+    opaque_rows = np.flatnonzero(rgba[..., 3].any(axis=1))
+    if len(opaque_rows) == 0:
+        return None
+    result = Image.fromarray(rgba)
+    if crop:
+        opaque_cols = np.flatnonzero(rgba[..., 3].any(axis=0))
+        height, width = background.shape
+        result = result.crop((
+            max(0, opaque_cols[0] - padding),
+            max(0, opaque_rows[0] - padding),
+            min(width, opaque_cols[-1] + 1 + padding),
+            min(height, opaque_rows[-1] + 1 + padding),
+        ))
+    return result
+
+
+def save_transparent_image(image_path, img: Image.Image = None, tolerance: int = DEFAULT_TOLERANCE,
+                           crop: bool = True, padding: int = 0, output_path=None) -> Optional[Path]:
+    """
+    去除背景并保存为 RGBA PNG（默认保存到原图旁边：<文件名>_alpha.png）
+
+    Returns:
+        Path: 输出路径；整张图都是背景时返回 None
+    """
+    image_path = Path(image_path)
+    if img is None:
+        img = Image.open(image_path)
+    result = remove_background(img, tolerance, crop, padding)
+    if result is None:
+        return None
+    output_path = Path(output_path) if output_path else image_path.with_name(f"{image_path.stem}_alpha.png")
+    result.save(output_path, format="PNG", optimize=True)
+    return output_path
+
+
+def _process_file(args):
+    """进程池任务：处理单个文件，返回 (源文件, 输出文件或 None)"""
+    image_path, output_path, tolerance, crop, padding = args
+    output_path = save_transparent_image(image_path, tolerance=tolerance, crop=crop,
+                                         padding=padding, output_path=output_path)
+    return str(image_path), str(output_path) if output_path else None
+
+
+def process_directory(input_dir, output_dir=None, tolerance: int = DEFAULT_TOLERANCE, crop: bool = True,
+                      padding: int = 0, workers: int = None) -> List[tuple]:
+    """
+    用多个进程为目录中的所有 PNG 去除背景（跳过后处理生成的派生文件）
+
+    Returns:
+        list: 每个文件的 (源文件, 输出文件或 None)
+    """
+    input_dir = Path(input_dir)
+    if output_dir:
+        output_dir = Path(output_dir)
+        output_dir.mkdir(parents=True, exist_ok=True)
+    tasks = [
+        (image_path, output_dir / image_path.name if output_dir else None, tolerance, crop, padding)
+        for image_path in sorted(input_dir.rglob("*.png"))
+        if not image_path.stem.endswith(DERIVED_SUFFIXES)
+    ]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(_process_file, tasks, chunksize=4))
+
+
+def main(argv=None):
+    """主函数：批量去除目录中图像的白色背景"""
+    parser = argparse.ArgumentParser(description="把生成图像的白色背景转换为透明通道")
+    parser.add_argument("input_dir", nargs="?", default="generated_images", help="包含 PNG 的目录")
+    parser.add_argument("--output-dir", help="输出目录（默认保存到原图旁边，后缀 _alpha）")
+    parser.add_argument("--tolerance", type=int, default=DEFAULT_TOLERANCE,
+                        help=f"每个通道与纯白的最大差值（默认 {DEFAULT_TOLERANCE}）")
+    parser.add_argument("--padding", type=int, default=0, help="裁剪时保留的透明边距（像素）")
+    parser.add_argument("--no-crop", action="store_true", help="不裁剪到内容包围盒")
+    parser.add_argument("--workers", type=int, help="进程数（默认 CPU 核数）")
+    args = parser.parse_args(argv)
+
+    results = process_directory(args.input_dir, args.output_dir, args.tolerance,
+                                not args.no_crop, args.padding, args.workers)
+    done = sum(1 for _, output_path in results if output_path)
+    print(f"✅ 已处理 {done}/{len(results)} 张图像")
+    for image_path, output_path in results:
+        if output_path is None:
+            print(f"⚠️  {image_path} 没有可保留的内容")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
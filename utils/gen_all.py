@@ -1,78 +1,255 @@
 #!/usr/bin/env python3
 """
-综合脚本：接收用户输入，调用 gen_prompt.py 生成提示词，然后调用 gen_images.py 生成图像
+综合脚本：接收用户输入，在同一进程内生成提示词并调用 Draw Things 生成图像
+
+批量模式：python gen_all.py --batch manifest.jsonl [--prompt-workers 2] [--image-workers 1]
 """
 
-import subprocess
 import sys
 import os
+import csv
 import json
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+from pipeline import GenerationPipeline, GenerationRequest
+
+try:
+    from config import Config
+    MAX_VARIANTS = Config.MAX_VARIANTS
+except ImportError:
+    # Fallback to defaults if config is not available
+    MAX_VARIANTS = 4
 
-def run_gen_prompt(user_description: str, negative_requirements: str = ""):
+
+class BatchCheckpoint:
     """
-    运行 gen_prompt.py 生成 prompt.json 文件
+    批量生成的进度检查点（JSONL 文件，每完成一项追加一行）
+    
+    中断后重新运行同一个清单时，已完成的条目会被跳过。
+    """
+    
+    def __init__(self, path: str):
+        self.path = Path(path)
+        self.completed = set()
+        self._lock = threading.Lock()
+        if self.path.exists():
+            data = self.path.read_bytes()
+            # 中断时可能留下写了一半的最后一行，截掉它，后续追加才不会与之拼接
+            if data and not data.endswith(b"\n"):
+                data = data[:data.rfind(b"\n") + 1]
+                with open(self.path, 'r+b') as f:
+                    f.truncate(len(data))
+            for line in data.decode('utf-8').splitlines():
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    self.completed.add(str(json.loads(line)["id"]))
+                except (ValueError, KeyError):
+                    continue
+    
+    def mark_done(self, item_id: str, result: dict):
+        """记录一项已完成，并立即刷新到磁盘"""
+        with self._lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps({"id": item_id, **result}, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self.completed.add(item_id)
+
+
+class BatchProgress:
+    """线程安全的批量进度统计与输出"""
+    
+    def __init__(self, total: int, skipped: int = 0):
+        self.total = total
+        self.skipped = skipped
+        self.done = 0
+        self.failed = 0
+        self.latencies = []
+        self.start_time = time.time()
+        self._lock = threading.Lock()
+    
+    def report(self, item_id: str, ok: bool, message: str = "", seconds: float = None):
+        """记录一项的结果；seconds 为该项从进入流水线到完成的耗时（只统计成功项）"""
+        with self._lock:
+            if ok:
+                self.done += 1
+                if seconds is not None:
+                    self.latencies.append(seconds)
+            else:
+                self.failed += 1
+            finished = self.done + self.failed
+            elapsed = time.time() - self.start_time
+            eta = elapsed / finished * (self.total - finished) if finished else 0
+            icon = "✅" if ok else "❌"
+            print(f"[{finished}/{self.total}] {icon} {item_id} {message} "
+                  f"(已用 {elapsed:.1f}s, 预计剩余 {eta:.1f}s)")
+
+
+def load_manifest(manifest_path: str):
+    """
+    读取批量生成清单（JSONL 或 CSV）
+    
+    每一项需要包含 prompt（或 description）字段，可选 negative_prompt（或 negative）、
+    seed、variants 和 id 字段；没有 id 时使用行号。
+    与 /generate 接口的校验相同：seed 必须是整数（负数表示随机），variants 必须在
+    1 到 MAX_VARIANTS 之间。不合法的行会被跳过并提示，不影响其余条目。
     
     Args:
-        user_description: 用户对图像的描述
-        negative_requirements: 用户指定的负面要求
+        manifest_path: 清单文件路径，.csv 按 CSV 解析，其余按 JSONL 解析
         
     Returns:
-        bool: 是否成功生成 prompt.json
+        list: [{"id", "prompt", "negative_prompt", "seed", "variants"}, ...]
     """
-    print("🎨 正在生成提示词...")
-    
-    try:
-        if negative_requirements:
-            cmd = [sys.executable, "gen_prompt.py", user_description, negative_requirements]
-        else:
-            cmd = [sys.executable, "gen_prompt.py", user_description]
-        
-        result = subprocess.run(cmd, capture_output=True, text=True, cwd=os.path.dirname(__file__))
-        
-        if result.returncode == 0:
-            print("✅ 提示词生成成功！")
-            # Print the output from gen_prompt for user to see
-            print(result.stdout)
-            return True
+    rows = []
+    with open(manifest_path, 'r', encoding='utf-8', newline='') as f:
+        if manifest_path.lower().endswith('.csv'):
+            rows = [row for row in csv.DictReader(f)]
         else:
-            print(f"❌ 提示词生成失败: {result.stderr}")
-            return False
-            
-    except Exception as e:
-        print(f"❌ 运行 gen_prompt.py 时出错: {e}")
-        return False
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    row = None
+                rows.append(row if isinstance(row, dict) else None)
+    
+    items = []
+    for number, row in enumerate(rows, start=1):
+        if row is None:
+            print(f"⚠️  跳过第 {number} 项：不是合法的 JSON 对象")
+            continue
+        prompt = str(row.get("prompt") or row.get("description") or "").strip()
+        if not prompt:
+            print(f"⚠️  跳过第 {number} 项：缺少 prompt")
+            continue
+        seed = row.get("seed")
+        try:
+            seed = int(seed) if seed not in (None, "") else -1
+        except (TypeError, ValueError):
+            print(f"⚠️  跳过第 {number} 项：seed 不是整数 ({seed!r})")
+            continue
+        variants = row.get("variants")
+        try:
+            variants = int(variants or 1)
+        except (TypeError, ValueError):
+            variants = None
+        if variants is None or not 1 <= variants <= MAX_VARIANTS:
+            print(f"⚠️  跳过第 {number} 项：variants 必须是 1 到 {MAX_VARIANTS} 之间的整数 "
+                  f"({row.get('variants')!r})")
+            continue
+        items.append({
+            "id": str(row.get("id") or number),
+            "prompt": prompt,
+            "negative_prompt": str(row.get("negative_prompt") or row.get("negative") or "").strip(),
+            "seed": max(seed, -1),
+            "variants": variants,
+        })
+    return items
 
 
-def run_gen_images():
+def run_batch(manifest_path: str, checkpoint_path: str = None,
+              prompt_workers: int = 2, image_workers: int = 1):
     """
-    运行 gen_images.py 生成图像
+    批量生成：提示词扩展与图像生成两个阶段流水线执行
+    
+    第 N 张图在 Draw Things 上渲染时，LLM 已经在扩展第 N+1 项的提示词。
+    每个阶段有独立的并发上限，两阶段之间排队的条目数量也有上限。
     
+    Args:
+        manifest_path: 清单文件路径（JSONL 或 CSV）
+        checkpoint_path: 检查点文件路径，默认为 <清单>.checkpoint.jsonl
+        prompt_workers: 提示词阶段的并发数
+        image_workers: 图像阶段的并发数
+        
     Returns:
-        bool: 是否成功生成图像
+        BatchProgress: 本次运行的进度统计
     """
-    print("🖼️ 正在生成图像...")
+    pipeline = GenerationPipeline()
+    checkpoint = BatchCheckpoint(checkpoint_path or f"{manifest_path}.checkpoint.jsonl")
+    items = load_manifest(manifest_path)
+    pending = [item for item in items if item["id"] not in checkpoint.completed]
+    progress = BatchProgress(len(pending), skipped=len(items) - len(pending))
+    
+    print(f"📦 共 {len(items)} 项，已完成 {progress.skipped} 项，本次处理 {len(pending)} 项")
+    
+    # 限制已进入流水线但尚未完成的条目数，避免提示词阶段远远跑在图像阶段前面
+    in_flight = threading.BoundedSemaphore(prompt_workers + image_workers * 2)
+    prompt_pool = ThreadPoolExecutor(max_workers=prompt_workers, thread_name_prefix="batch-prompt")
+    image_pool = ThreadPoolExecutor(max_workers=image_workers, thread_name_prefix="batch-image")
+    
+    def image_stage(item_id, request, record, started):
+        try:
+            images = pipeline.render(request, record)
+            paths = pipeline.save(images, request, record)
+            # 与 /generate 相同：保存后生成派生文件（原生分辨率精灵、索引色、透明背景）
+            renditions = pipeline.postprocess(images, paths)
+            filepaths = [str(path) for path in paths]
+            checkpoint.mark_done(item_id, {
+                "images": filepaths,
+                "renditions": [{name: str(path) for name, path in derived.items()} for derived in renditions],
+            })
+            progress.report(item_id, True, ", ".join(filepaths), time.perf_counter() - started)
+        except Exception as e:
+            progress.report(item_id, False, str(e))
+        finally:
+            in_flight.release()
+    
+    def prompt_stage(item_id, request, started):
+        try:
+            record = pipeline.expand_prompt(request)
+        except Exception as e:
+            progress.report(item_id, False, str(e))
+            in_flight.release()
+            return
+        image_pool.submit(image_stage, item_id, request, record, started)
     
     try:
-        cmd = [sys.executable, "gen_images.py"]
-        result = subprocess.run(cmd, capture_output=True, text=True, cwd=os.path.dirname(__file__))
-        
-        if result.returncode == 0:
-            print("✅ 图像生成成功！")
-            print(result.stdout)
-            return True
-        else:
-            print(f"❌ 图像生成失败: {result.stderr}")
-            return False
-            
-    except Exception as e:
-        print(f"❌ 运行 gen_images.py 时出错: {e}")
-        return False
+        for item in pending:
+            request = GenerationRequest(item["prompt"], item["negative_prompt"], item["seed"], item["variants"])
+            in_flight.acquire()
+            prompt_pool.submit(prompt_stage, item["id"], request, time.perf_counter())
+        # 提示词阶段全部结束后，所有图像任务都已提交
+        prompt_pool.shutdown(wait=True)
+        image_pool.shutdown(wait=True)
+    except KeyboardInterrupt:
+        print("\n⏹️  已中断，进度已保存，重新运行相同命令即可继续。")
+        prompt_pool.shutdown(wait=False, cancel_futures=True)
+        image_pool.shutdown(wait=False, cancel_futures=True)
+        raise
+    
+    elapsed = time.time() - progress.start_time
+    print(f"\n🎉 批量生成结束：成功 {progress.done} 项，失败 {progress.failed} 项，耗时 {elapsed:.1f}s")
+    return progress
+
+
+def main_batch(argv):
+    """批量模式入口"""
+    parser = argparse.ArgumentParser(description="批量生成像素艺术图像")
+    parser.add_argument("--batch", required=True, metavar="MANIFEST", help="JSONL 或 CSV 清单文件")
+    parser.add_argument("--checkpoint", help="检查点文件（默认 <清单>.checkpoint.jsonl）")
+    parser.add_argument("--prompt-workers", type=int, default=2, help="提示词阶段并发数")
+    parser.add_argument("--image-workers", type=int, default=1, help="图像阶段并发数")
+    args = parser.parse_args(argv)
+    
+    progress = run_batch(args.batch, args.checkpoint, args.prompt_workers, args.image_workers)
+    if progress.failed:
+        sys.exit(1)
 
 
 def main():
     """主函数"""
+    if "--batch" in sys.argv[1:]:
+        main_batch(sys.argv[1:])
+        return
+    
     print("=" * 60)
     print("🎨 综合生成工具：生成像素艺术图像")
     print("=" * 60)
@@ -92,34 +269,40 @@ def main():
     if negative_requirements:
         print(f"🚫 不希望出现: {negative_requirements}")
     
+    pipeline = GenerationPipeline()
+    request = GenerationRequest(user_description, negative_requirements)
+    
     # 步骤1: 生成提示词
-    if not run_gen_prompt(user_description, negative_requirements):
-        print("❌ 提示词生成失败，程序退出。")
+    print("🎨 正在生成提示词...")
+    try:
+        start = time.perf_counter()
+        record = pipeline.expand_prompt(request)
+        prompt_seconds = time.perf_counter() - start
+    except Exception as e:
+        print(f"❌ 提示词生成失败，程序退出: {e}")
         sys.exit(1)
     
-    # 检查是否生成了 prompt.json
-    prompt_file = Path("prompt.json")
-    if not prompt_file.exists():
-        print("❌ 未生成 prompt.json 文件，程序退出。")
-        sys.exit(1)
+    print(f"\n📋 生成的正面提示词:\n{record.positive}")
+    print(f"\n📋 生成的负面提示词:\n{record.negative}")
+    print(f"⚙️  生成参数: 步数={record.steps}, CFG={record.cfg}")
     
-    # 读取并显示生成的提示词
+    # 步骤2: 生成图像
+    print("🖼️ 正在生成图像...")
     try:
-        with open(prompt_file, 'r', encoding='utf-8') as f:
-            prompt_data = json.load(f)
-        
-        print(f"\n📋 生成的正面提示词:\n{prompt_data.get('positive', '')}")
-        print(f"\n📋 生成的负面提示词:\n{prompt_data.get('negative', '')}")
-        print(f"⚙️  生成参数: 步数={prompt_data.get('steps', 8)}, CFG={prompt_data.get('cfg', 10)}")
+        start = time.perf_counter()
+        images = pipeline.render(request, record)
+        paths = pipeline.save(images, request, record)
+        filepath = paths[0]
+        image_seconds = time.perf_counter() - start
+        renditions = pipeline.postprocess(images, paths)[0]
     except Exception as e:
-        print(f"⚠️  读取 prompt.json 时出错: {e}")
-    
-    # 步骤2: 生成图像
-    if not run_gen_images():
-        print("❌ 图像生成失败，程序退出。")
+        print(f"❌ 图像生成失败，程序退出: {e}")
         sys.exit(1)
     
-    print("\n🎉 所有步骤完成！图像已保存到 generated_images 目录。")
+    print(f"⏱️  耗时: 提示词 {prompt_seconds:.2f}s, 图像 {image_seconds:.2f}s")
+    print(f"\n🎉 所有步骤完成！图像已保存到: {filepath}")
+    for name, path in renditions.items():
+        print(f"   {name}: {path}")
 
 
 if __name__ == "__main__":
@@ -13,6 +13,10 @@ from pathlib import Path
 import os
 import sys
 import inspect
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
 
 # Get the project root directory to import config
 current_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
@@ -23,10 +27,87 @@ try:
     from config import Config
     GENERATED_IMAGES_DIR = Config.GENERATED_IMAGES_DIR
     DRAW_THINGS_API_URL = getattr(Config, 'DRAW_THINGS_API_URL', 'http://localhost:7860/sdapi/v1/txt2img')
+    DRAW_THINGS_API_URLS = getattr(Config, 'DRAW_THINGS_API_URLS', '')
+    DRAW_THINGS_MAX_CONCURRENCY = getattr(Config, 'DRAW_THINGS_MAX_CONCURRENCY', 1)
+    DRAW_THINGS_FAILURE_THRESHOLD = getattr(Config, 'DRAW_THINGS_FAILURE_THRESHOLD', 2)
+    DRAW_THINGS_HEALTH_INTERVAL = getattr(Config, 'DRAW_THINGS_HEALTH_INTERVAL', 15.0)
+    DRAW_THINGS_HEALTH_PATH = getattr(Config, 'DRAW_THINGS_HEALTH_PATH', '/')
+    DRAW_THINGS_PREVIEW_INTERVAL = getattr(Config, 'DRAW_THINGS_PREVIEW_INTERVAL', 0)
+    SAVE_RECOMPRESS = getattr(Config, 'SAVE_RECOMPRESS', False)
 except ImportError:
     # Fallback to defaults if config is not available
     GENERATED_IMAGES_DIR = "generated_images"
     DRAW_THINGS_API_URL = 'http://localhost:7860/sdapi/v1/txt2img'
+    DRAW_THINGS_API_URLS = ''
+    DRAW_THINGS_MAX_CONCURRENCY = 1
+    DRAW_THINGS_FAILURE_THRESHOLD = 2
+    DRAW_THINGS_HEALTH_INTERVAL = 15.0
+    DRAW_THINGS_HEALTH_PATH = '/'
+    DRAW_THINGS_PREVIEW_INTERVAL = 0
+    SAVE_RECOMPRESS = False
+
+from image_index import get_image_index
+from image_cache import get_image_cache, payload_hash
+from backend_client import get_draw_things_client
+from image_store import image_path, new_image_id, resolve
+from metrics import CACHE_HITS, IMAGE_BYTES, IMAGES_GENERATED, record_error, timed, track
+
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+class GeneratedImage:
+    """
+    后端返回的已编码图像
+
+    保留 Draw Things 返回的原始字节：保存时直接写盘，不经过 PIL 解码和重新编码；
+    只有真正需要像素的阶段（例如后处理）访问 image 时才解码，并且只解码一次。
+    cache_key 是图像结果缓存中的键（固定 seed 的请求才有），保存时用来复用已写入的文件；
+    复用时 save_image 把 reused 置为 True，后处理据此跳过已经存在的派生文件。
+    """
+
+    def __init__(self, data: bytes, cache_key: str = None):
+        self.data = data
+        self.cache_key = cache_key
+        self.reused = False
+        self._image = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_png(self) -> bool:
+        return self.data[:8] == PNG_SIGNATURE
+
+    @property
+    def size(self):
+        """图像尺寸；PNG 直接读取 IHDR 头，无需解码"""
+        if self.is_png and len(self.data) >= 24:
+            return struct.unpack(">II", self.data[16:24])
+        return self.image.size
+
+    @property
+    def width(self) -> int:
+        return self.size[0]
+
+    @property
+    def height(self) -> int:
+        return self.size[1]
+
+    @property
+    def image(self) -> Image.Image:
+        """解码后的 PIL 图像（首次访问时解码）"""
+        if self._image is None:
+            with self._lock:
+                if self._image is None:
+                    with track("png_decode"):
+                        img = Image.open(BytesIO(self.data))
+                        img.load()
+                    self._image = img
+        return self._image
+
+
+def decode_image(img) -> Image.Image:
+    """返回 PIL 图像：GeneratedImage 按需解码，PIL 图像原样返回"""
+    return img.image if isinstance(img, GeneratedImage) else img
 
 
 def load_prompt_from_json(json_file_path: str = "prompt.json"):
@@ -50,27 +131,15 @@ def load_prompt_from_json(json_file_path: str = "prompt.json"):
     return positive_prompt, negative_prompt, steps, cfg
 
 
-def call_draw_things_api(prompt: str, negative_prompt: str, steps: int, cfg: float, 
-                         width: int = 512, height: int = 512, seed: int = -1):
+def build_txt2img_payload(prompt: str, negative_prompt: str, steps: int, cfg: float,
+                          width: int = 512, height: int = 512, seed: int = -1, batch_size: int = 1):
     """
-    调用 Draw Things API 生成图像
+    构建 Draw Things txt2img 请求参数
     
-    Args:
-        prompt: 正向提示词
-        negative_prompt: 负向提示词
-        steps: 生成步数
-        cfg: CFG 值
-        width: 图像宽度
-        height: 图像高度
-        seed: 随机种子
-        
     Returns:
-        PIL.Image: 生成的图像对象，如果失败则返回 None
+        dict: 完整的请求参数（提示词、步数、CFG、尺寸、采样器、LoRA、种子，
+              以及多变体时的 batch_size / n_iter）
     """
-    # Draw Things API 地址
-    api_url = DRAW_THINGS_API_URL
-    
-    # 构建请求参数
     payload = {
         "prompt": prompt,
         "negative_prompt": negative_prompt,
@@ -93,70 +162,546 @@ def call_draw_things_api(prompt: str, negative_prompt: str, steps: int, cfg: flo
             }
         ],
     }
+    # 单张图像时不写入这两个字段，保持与已有缓存键一致
+    if batch_size > 1:
+        payload["batch_size"] = batch_size
+        payload["n_iter"] = 1
+    return payload
+
+
+def parse_backend_urls(spec: str, default_url: str = None, default_concurrency: int = 1):
+    """
+    解析 Draw Things 后端列表
+    
+    Args:
+        spec: 逗号分隔的后端地址，每个地址可用 "|N" 后缀指定并发上限，
+              例如 "http://gpu1:7860/sdapi/v1/txt2img|2,http://gpu2:7860/sdapi/v1/txt2img"
+        default_url: spec 为空时使用的单个后端地址
+        default_concurrency: 未指定并发上限时的默认值
+        
+    Returns:
+        list: [(url, max_concurrency), ...]
+    """
+    backends = []
+    for entry in (spec or "").split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        url, _, concurrency = entry.partition("|")
+        backends.append((url.strip(), int(concurrency) if concurrency.strip() else default_concurrency))
+    if not backends and default_url:
+        backends.append((default_url, default_concurrency))
+    return backends
+
+
+class DrawThingsBackend:
+    """单个 Draw Things 后端的状态与统计信息"""
+    
+    def __init__(self, url: str, max_concurrency: int = 1):
+        self.url = url
+        self.max_concurrency = max(1, int(max_concurrency))
+        parsed = urlparse(url)
+        self.origin = f"{parsed.scheme}://{parsed.netloc}"
+        self.in_flight = 0
+        self.healthy = True
+        self.consecutive_failures = 0
+        self.requests = 0
+        self.errors = 0
+        self.total_latency = 0.0
+        self.last_latency = None
+        self.last_error = None
+    
+    @property
+    def load(self) -> float:
+        return self.in_flight / self.max_concurrency
+    
+    @property
+    def average_latency(self) -> float:
+        completed = self.requests - self.errors
+        return self.total_latency / completed if completed else 0.0
+    
+    def stats(self) -> dict:
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "in_flight": self.in_flight,
+            "max_concurrency": self.max_concurrency,
+            "requests": self.requests,
+            "errors": self.errors,
+            "consecutive_failures": self.consecutive_failures,
+            "average_latency": self.average_latency,
+            "last_latency": self.last_latency,
+            "last_error": self.last_error,
+        }
+
+
+class DrawThingsScheduler:
+    """
+    在多个 Draw Things 后端之间分发 txt2img 请求
+    
+    每个请求发送到负载（in_flight / 并发上限）最低的健康后端；所有健康后端都满载时
+    在此等待。请求失败（连接错误或 5xx）会换一个后端重试，连续失败达到阈值的后端
+    被标记为不健康，直到后台健康探测再次成功。没有任何健康后端时，仍会尝试不健康的
+    后端，避免只有一台机器时永久不可用。
+    """
+    
+    def __init__(self, backends, failure_threshold: int = 2, health_interval: float = 15.0,
+                 health_path: str = "/", client=None):
+        self.backends = [DrawThingsBackend(url, concurrency) for url, concurrency in backends]
+        self.failure_threshold = max(1, int(failure_threshold))
+        self.health_interval = health_interval
+        self.health_path = health_path
+        self.client = client or get_draw_things_client()
+        self._cond = threading.Condition()
+        self._health_thread = None
+    
+    def acquire(self, exclude=()):
+        """
+        选出一个后端并占用一个并发名额
+        
+        Returns:
+            DrawThingsBackend: 选中的后端；所有后端都已尝试过时返回 None
+        """
+        self._ensure_health_checks()
+        with self._cond:
+            while True:
+                remaining = [b for b in self.backends if b not in exclude]
+                if not remaining:
+                    return None
+                candidates = [b for b in remaining if b.healthy] or remaining
+                available = [b for b in candidates if b.in_flight < b.max_concurrency]
+                if available:
+                    backend = min(available, key=lambda b: (b.load, b.average_latency))
+                    backend.in_flight += 1
+                    return backend
+                self._cond.wait()
+    
+    def release(self, backend: DrawThingsBackend, ok: bool, latency: float, error: str = None):
+        """归还并发名额并记录本次请求的结果"""
+        with self._cond:
+            backend.in_flight -= 1
+            backend.requests += 1
+            if ok:
+                backend.total_latency += latency
+                backend.last_latency = latency
+                backend.consecutive_failures = 0
+                backend.healthy = True
+            else:
+                backend.errors += 1
+                backend.last_error = error
+                backend.consecutive_failures += 1
+                if backend.consecutive_failures >= self.failure_threshold:
+                    if backend.healthy:
+                        print(f"⚠️  Draw Things 后端不健康: {backend.url}")
+                    backend.healthy = False
+            self._cond.notify_all()
+    
+    def post(self, payload: dict, on_dispatch=None, **kwargs):
+        """
+        把 txt2img 请求发送到最合适的后端，失败时换下一个后端
+        
+        有多个后端时，每次尝试都不在同一个后端上重试：坏掉的后端不会先耗尽重试和退避
+        再轮到下一个后端，跨后端的重试由这里的循环负责。只有一个后端时保留客户端的重试。
+        
+        Args:
+            payload: txt2img 请求参数
+            on_dispatch: 每次把请求发给某个后端之前调用 on_dispatch(backend)
+        
+        Returns:
+            requests.Response: 成功的响应，或最后一个后端的失败响应
+            
+        Raises:
+            requests.exceptions.RequestException: 所有后端都无法连接
+        """
+        tried = []
+        last_response = None
+        last_error = None
+        retries = 0 if len(self.backends) > 1 else None
+        while True:
+            backend = self.acquire(exclude=tried)
+            if backend is None:
+                break
+            tried.append(backend)
+            if on_dispatch is not None:
+                on_dispatch(backend)
+            start = time.time()
+            try:
+                response = self.client.post(backend.url, json=payload, retries=retries, **kwargs)
+            except requests.exceptions.Timeout as e:
+                # 读取超时说明后端仍在生成，换机器重试只会重复占用 GPU
+                self.release(backend, False, time.time() - start, str(e))
+                raise
+            except requests.exceptions.RequestException as e:
+                self.release(backend, False, time.time() - start, str(e))
+                last_error = e
+                continue
+            if response.status_code >= 500:
+                self.release(backend, False, time.time() - start, f"HTTP {response.status_code}")
+                last_response = response
+                continue
+            self.release(backend, True, time.time() - start)
+            return response
+        
+        if last_response is not None:
+            return last_response
+        raise last_error or requests.exceptions.ConnectionError("No Draw Things backend configured")
+    
+    def probe(self):
+        """对所有后端做一次健康探测"""
+        for backend in self.backends:
+            try:
+                response = self.client.session.get(
+                    backend.origin + self.health_path,
+                    timeout=(self.client.connect_timeout, 5)
+                )
+                ok = response.status_code < 500
+                error = None if ok else f"HTTP {response.status_code}"
+            except requests.exceptions.RequestException as e:
+                ok, error = False, str(e)
+            with self._cond:
+                if ok:
+                    if not backend.healthy:
+                        print(f"✅ Draw Things 后端恢复: {backend.url}")
+                    backend.healthy = True
+                    backend.consecutive_failures = 0
+                else:
+                    backend.healthy = False
+                    backend.last_error = error
+                self._cond.notify_all()
+    
+    def stats(self) -> list:
+        with self._cond:
+            return [backend.stats() for backend in self.backends]
+    
+    def _ensure_health_checks(self):
+        if self.health_interval <= 0 or self._health_thread is not None:
+            return
+        with self._cond:
+            if self._health_thread is None:
+                self._health_thread = threading.Thread(
+                    target=self._health_loop, name="draw-things-health", daemon=True
+                )
+                self._health_thread.start()
+    
+    def _health_loop(self):
+        while True:
+            time.sleep(self.health_interval)
+            self.probe()
+
+
+class ProgressPoller:
+    """
+    在图像生成期间轮询后端的 /sdapi/v1/progress，转发进度和中间预览图
+    
+    同一后端同时处理多个请求时，进度接口反映的是该后端当前正在执行的任务。
+    """
+    
+    def __init__(self, backend: DrawThingsBackend, on_event, interval: float, client=None):
+        self.backend = backend
+        self.on_event = on_event
+        self.interval = interval
+        self.client = client or get_draw_things_client()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="draw-things-progress", daemon=True)
+    
+    def start(self):
+        self._thread.start()
+        return self
+    
+    def stop(self):
+        self._stop.set()
+    
+    def _run(self):
+        last_preview = None
+        while not self._stop.wait(self.interval):
+            try:
+                response = self.client.session.get(
+                    self.backend.origin + "/sdapi/v1/progress",
+                    timeout=(self.client.connect_timeout, 5)
+                )
+                if response.status_code != 200:
+                    continue
+                data = response.json()
+            except (requests.exceptions.RequestException, ValueError):
+                continue
+            if self._stop.is_set():
+                break
+            event = {"progress": data.get("progress")}
+            preview = data.get("current_image")
+            if preview and preview != last_preview:
+                event["preview"] = f"data:image/png;base64,{preview}"
+                last_preview = preview
+            self.on_event("progress", **event)
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler() -> DrawThingsScheduler:
+    """获取进程内共享的 Draw Things 调度器"""
+    global _scheduler
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                _scheduler = DrawThingsScheduler(
+                    parse_backend_urls(DRAW_THINGS_API_URLS, DRAW_THINGS_API_URL, DRAW_THINGS_MAX_CONCURRENCY),
+                    failure_threshold=DRAW_THINGS_FAILURE_THRESHOLD,
+                    health_interval=DRAW_THINGS_HEALTH_INTERVAL,
+                    health_path=DRAW_THINGS_HEALTH_PATH,
+                )
+    return _scheduler
+
+
+def call_draw_things_api_batch(prompt: str, negative_prompt: str, steps: int, cfg: float,
+                               width: int = 512, height: int = 512, seed: int = -1,
+                               batch_size: int = 1, use_cache: bool = True, on_event=None):
+    """
+    调用 Draw Things API，一次请求生成 batch_size 张变体图像
+    
+    请求通过 DrawThingsScheduler 分发到配置的多个后端之一。
+    固定 seed（seed >= 0）时结果是确定的：先按请求参数的哈希查找图像结果缓存，
+    全部变体都命中时直接返回缓存的图像，不再调用 Draw Things。
+    
+    Args:
+        prompt: 正向提示词
+        negative_prompt: 负向提示词
+        steps: 生成步数
+        cfg: CFG 值
+        width: 图像宽度
+        height: 图像高度
+        seed: 随机种子，-1 表示随机
+        batch_size: 变体数量，作为 txt2img 的 batch_size 传给后端
+        use_cache: 是否使用图像结果缓存
+        on_event: 进度事件回调 on_event(event, **data)：请求发往后端时收到 rendering，
+                  开启 DRAW_THINGS_PREVIEW_INTERVAL 时还会收到带预览图的 progress
+        
+    Returns:
+        list: 生成的 GeneratedImage 列表，失败时返回空列表
+    """
+    batch_size = max(1, int(batch_size))
+    
+    # 构建请求参数
+    payload = build_txt2img_payload(prompt, negative_prompt, steps, cfg, width, height, seed, batch_size)
+    
+    # 只有固定种子的请求才能复用结果
+    cache = get_image_cache() if use_cache and seed is not None and seed >= 0 else None
+    cache_keys = []
+    if cache is not None:
+        cache_key = payload_hash(payload)
+        cache_keys = [cache_key] if batch_size == 1 else [f"{cache_key}-{i}" for i in range(batch_size)]
+        cached = [cache.get(key) for key in cache_keys]
+        if all(data is not None for data in cached):
+            print(f"⚡ 图像缓存命中: {cache_key[:12]}")
+            CACHE_HITS.inc(cache="image")
+            if on_event is not None:
+                on_event("cache_hit")
+            return [GeneratedImage(data, key) for data, key in zip(cached, cache_keys)]
     
     print(f"🔄 正在生成图像...")
     print(f"📝 正向提示词: {prompt[:100]}...")
     print(f"📝 负向提示词: {negative_prompt[:100]}...")
-    print(f"⚙️  参数: 步数={steps}, CFG={cfg}, 尺寸={width}x{height}")
+    print(f"⚙️  参数: 步数={steps}, CFG={cfg}, 尺寸={width}x{height}, 变体数={batch_size}")
+    
+    client = get_draw_things_client()
+    pollers = []
+    
+    def on_dispatch(backend):
+        # 失败转移到新后端时，停止对上一个后端的进度轮询
+        for poller in pollers:
+            poller.stop()
+        if on_event is None:
+            return
+        on_event("rendering", backend=backend.url)
+        if DRAW_THINGS_PREVIEW_INTERVAL > 0:
+            pollers.append(ProgressPoller(backend, on_event, DRAW_THINGS_PREVIEW_INTERVAL, client).start())
     
     try:
-        response = requests.post(
-            api_url,
-            json=payload,
-            timeout=300  # 5分钟超时
-        )
+        # 由调度器选择负载最低的健康后端
+        try:
+            with track("image"):
+                response = get_scheduler().post(payload, on_dispatch=on_dispatch)
+        finally:
+            for poller in pollers:
+                poller.stop()
         
         if response.status_code == 200:
-            result = response.json()
+            with track("base64_decode"):
+                result = response.json()
+                # 只做 base64 解码，PNG 数据保持原样，需要像素时再解码
+                encoded_images = result.get("images") or []
+                decoded = [base64.b64decode(encoded) for encoded in encoded_images]
             
-            if "images" in result and len(result["images"]) > 0:
-                # 解码 base64 图片数据
-                img_data = base64.b64decode(result["images"][0])
-                img = Image.open(BytesIO(img_data))
+            if decoded:
+                images = []
+                for i, img_data in enumerate(decoded):
+                    cache_key = cache_keys[i] if i < len(cache_keys) else None
+                    images.append(GeneratedImage(img_data, cache_key))
+                    if cache_key is not None:
+                        cache.put(cache_key, img_data)
                 
-                print(f"✅ 图像生成成功！")
-                return img
+                print(f"✅ 图像生成成功！共 {len(images)} 张")
+                return images
             else:
                 print(f"❌ 响应中没有图片数据")
                 print(f"响应内容: {result}")
-                return None
+                record_error("image", "empty_response")
+                return []
         else:
             print(f"❌ API 请求失败: {response.status_code}")
+            record_error("image", f"http_{response.status_code}")
             print(f"错误信息: {response.text}")
-            return None
+            return []
             
     except requests.exceptions.Timeout:
-        print(f"❌ 请求超时（超过 300 秒）")
-        return None
+        print(f"❌ 请求超时（超过 {client.read_timeout:g} 秒）")
+        return []
     except Exception as e:
         print(f"❌ 生成失败: {e}")
+        return []
+
+
+def call_draw_things_api(prompt: str, negative_prompt: str, steps: int, cfg: float, 
+                         width: int = 512, height: int = 512, seed: int = -1,
+                         use_cache: bool = True, on_event=None):
+    """
+    调用 Draw Things API 生成单张图像，参数含义见 call_draw_things_api_batch
+    
+    Returns:
+        GeneratedImage: 生成的图像，如果失败则返回 None
+    """
+    images = call_draw_things_api_batch(
+        prompt, negative_prompt, steps, cfg, width, height, seed,
+        batch_size=1, use_cache=use_cache, on_event=on_event
+    )
+    return images[0] if images else None
+
+
+_recompressor = None
+_recompressor_lock = threading.Lock()
+
+
+def get_recompressor() -> ThreadPoolExecutor:
+    """获取后台重新压缩 PNG 的单线程执行器"""
+    global _recompressor
+    if _recompressor is None:
+        with _recompressor_lock:
+            if _recompressor is None:
+                _recompressor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="png-recompress")
+    return _recompressor
+
+
+def recompress_png(filepath) -> int:
+    """
+    用最高压缩率重新编码 PNG，变小时原子替换原文件并更新索引中的文件大小
+
+    像素内容不变，因此已缓存旧文件的客户端看到的图像也相同。
+
+    Returns:
+        int: 节省的字节数
+    """
+    filepath = Path(filepath)
+    original_size = filepath.stat().st_size
+    with Image.open(filepath) as img:
+        buffer = BytesIO()
+        img.save(buffer, format="PNG", optimize=True)
+    data = buffer.getvalue()
+    if len(data) >= original_size:
+        return 0
+    tmp_path = filepath.with_name(f".{filepath.name}.tmp")
+    tmp_path.write_bytes(data)
+    os.replace(tmp_path, filepath)
+    try:
+        get_image_index().update_bytes(filepath.name, len(data))
+    except Exception as e:
+        print(f"⚠️  更新图像索引失败: {e}")
+    return original_size - len(data)
+
+
+def find_saved_image(output_dir, cache_key: str):
+    """
+    按图像结果缓存的键查找已保存的图像
+
+    Returns:
+        Path: 已保存且仍存在的图像路径，没有时返回 None
+    """
+    try:
+        row = get_image_index().find_by_cache_key(cache_key)
+    except Exception as e:
+        print(f"⚠️  查询图像索引失败: {e}")
         return None
+    return resolve(output_dir, row["filename"]) if row else None
 
 
-def save_image(img: Image.Image, output_dir: str = None):
+@timed("save")
+def save_image(img, output_dir: str = None, record: dict = None, seed: int = None):
     """
-    保存图像到指定目录
+    保存图像到指定目录，并写入图像索引
+    
+    后端返回的 PNG（GeneratedImage）直接按原始字节写盘，不解码也不重新编码；
+    开启 SAVE_RECOMPRESS 时再在后台线程中重新压缩。
+    来自图像结果缓存的图像如果已经保存过（索引中有相同缓存键的记录且文件仍在），
+    直接返回已有的文件，不再写入新的副本和索引记录，并把 img.reused 置为 True。
     
     Args:
-        img: PIL 图像对象
+        img: GeneratedImage 或 PIL 图像对象
         output_dir: 输出目录
+        record: 生成参数记录（positive、negative、steps、cfg），会写入索引
+        seed: 生成时使用的随机种子
+        
+    Returns:
+        Path: 实际写入的图像文件路径
     """
     # Use config value if output_dir is not provided
     if output_dir is None:
         output_dir = GENERATED_IMAGES_DIR
     
-    # 创建输出目录
-    output_path = Path(output_dir)
-    output_path.mkdir(exist_ok=True)
+    cache_key = getattr(img, "cache_key", None)
+    if cache_key:
+        existing = find_saved_image(output_dir, cache_key)
+        if existing is not None:
+            print(f"♻️  复用已保存的图像: {existing}")
+            img.reused = True
+            return existing
     
-    # 生成带时间戳的文件名
-    timestamp = time.strftime("%Y%m%d_%H%M%S")
-    filename = f"generated_{timestamp}.png"
-    filepath = output_path / filename
+    # 每张图像分配按时间排序的唯一 ID，存放在由 ID 决定的分片目录中
+    image_id = new_image_id()
+    filepath = image_path(output_dir, image_id)
+    filename = filepath.name
+    filepath.parent.mkdir(parents=True, exist_ok=True)
+    # 以独占方式创建文件，即使 ID 意外重复也不会覆盖已有图像
+    f = open(filepath, "xb")
     
-    # 保存图像
-    img.save(filepath, format="PNG")
+    # 保存图像：已经是 PNG 的数据直接写入
+    passthrough = isinstance(img, GeneratedImage) and img.is_png
+    with f:
+        if passthrough:
+            f.write(img.data)
+        else:
+            decode_image(img).save(f, format="PNG")
     print(f"💾 图像已保存到: {filepath}")
+    byte_length = filepath.stat().st_size
+    IMAGES_GENERATED.inc()
+    IMAGE_BYTES.inc(byte_length)
+    
+    # 更新图像索引，列表接口无需再扫描目录
+    try:
+        get_image_index().add(
+            filename,
+            record=record,
+            seed=seed,
+            width=img.width,
+            height=img.height,
+            byte_length=byte_length,
+            cache_key=cache_key
+        )
+    except Exception as e:
+        print(f"⚠️  写入图像索引失败: {e}")
+    
+    if passthrough and SAVE_RECOMPRESS:
+        get_recompressor().submit(recompress_png, filepath)
+    
+    return filepath
 
 
 def main():
@@ -189,7 +734,8 @@ def main():
     
     if img:
         # 保存图像到配置的目录
-        save_image(img)
+        record = {"positive": positive_prompt, "negative": negative_prompt, "steps": steps, "cfg": cfg}
+        save_image(img, record=record)
         print("🎉 图像生成完成！")
     else:
         print("❌ 图像生成失败，请检查 Draw Things 是否正在运行并启用了 API")
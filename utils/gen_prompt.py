@@ -9,19 +9,22 @@
 import os
 import json
 import re
+import functools
 import requests
 from typing import Dict, Any
 import datetime
 
+from prompt_cache import PromptCache, get_prompt_cache
+from backend_client import get_lm_studio_breaker, get_lm_studio_client
+from metrics import CACHE_HITS, error_cause, record_error, timed
 
-def save_prompts_to_template(positive_prompt: str, negative_prompt: str, filename: str = "prompt.json"):
+
+def get_prompt_template_path() -> str:
     """
-    将生成的正向和负向提示词保存到模板文件中
+    获取提示词模板文件 (prompt.tpl) 的路径
     
-    Args:
-        positive_prompt: 正向提示词
-        negative_prompt: 负向提示词
-        filename: 保存的文件名
+    Returns:
+        str: 模板文件路径
     """
     # Import config to use configured template path
     import sys
@@ -31,8 +34,8 @@ def save_prompts_to_template(positive_prompt: str, negative_prompt: str, filenam
     # Get the project root directory to import config
     current_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
     parent_dir = os.path.dirname(current_dir)
-    grandparent_dir = os.path.dirname(parent_dir)
-    sys.path.insert(0, grandparent_dir)
+    if parent_dir not in sys.path:
+        sys.path.insert(0, parent_dir)
     
     try:
         from config import Config
@@ -44,16 +47,46 @@ def save_prompts_to_template(positive_prompt: str, negative_prompt: str, filenam
     # Ensure we have the right path if it's relative to project root
     if not os.path.isabs(template_path) and template_path.startswith('utils/'):
         template_path = os.path.join(os.path.dirname(current_dir), template_path)
+    return template_path
+
+
+@functools.lru_cache(maxsize=None)
+def _load_prompt_template(template_path: str) -> str:
     with open(template_path, 'r', encoding='utf-8') as f:
-        template_data = json.load(f)
+        return f.read()
+
+
+def build_prompt_record(positive_prompt: str, negative_prompt: str) -> Dict[str, Any]:
+    """
+    基于模板构建一次生成请求的参数记录（仅在内存中，不写文件）
+    
+    模板只读取一次并缓存，每次调用返回独立的字典，可在并发请求间安全使用。
+    
+    Args:
+        positive_prompt: 正向提示词
+        negative_prompt: 负向提示词
+        
+    Returns:
+        dict: 包含 positive、negative、steps、cfg 等字段的生成参数
+    """
+    record = json.loads(_load_prompt_template(get_prompt_template_path()))
     
     # 更新模板中的字段
-    template_data["positive"] = positive_prompt
-    template_data["negative"] = negative_prompt
+    record["positive"] = positive_prompt
+    record["negative"] = negative_prompt
+    return record
+
+
+def save_prompts_to_template(positive_prompt: str, negative_prompt: str, filename: str = "prompt.json"):
+    """
+    将生成的正向和负向提示词保存到模板文件中
     
-    # 生成带时间戳的文件名
-    # timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-    # output_filename = f"prompt_{timestamp}.json"
+    Args:
+        positive_prompt: 正向提示词
+        negative_prompt: 负向提示词
+        filename: 保存的文件名
+    """
+    template_data = build_prompt_record(positive_prompt, negative_prompt)
     
     # 保存到新的JSON文件
     with open(filename, 'w', encoding='utf-8') as f:
@@ -62,13 +95,113 @@ def save_prompts_to_template(positive_prompt: str, negative_prompt: str, filenam
     print(f"提示词已保存到: {filename}")
 
 
-def generate_stable_diffusion_prompt(user_description: str, negative_requirements: str = "") -> tuple[str, str]:
+def find_prompts_end(content: str):
+    """
+    判断流式输出中正向和负向提示词是否都已完整
+    
+    负向提示词位于 '|||' 之后，可以跨越多行；只有出现第二个 '|||' 时才能确定它已结束
+    （与非流式解析一致：两者都只保留前两段）。否则一直读到 [DONE] 或 token 预算用尽。
+    
+    Args:
+        content: 目前已收到的全部输出
+        
+    Returns:
+        int: 有效内容的结束位置（之后的内容可以丢弃）；尚未完整时返回 None
+    """
+    # 只看最后一个 "Thought:" 之后的内容，与解析逻辑保持一致
+    start = content.rfind("Thought:")
+    start = start + len("Thought:") if start >= 0 else 0
+    separator = content.find("|||", start)
+    if separator < 0:
+        return None
+    
+    end = content.find("|||", separator + len("|||"))
+    return end if end >= 0 else None
+
+
+def read_streamed_completion(response, max_tokens: int = 0) -> str:
+    """
+    逐块读取 /v1/chat/completions 的 SSE 流
+    
+    一旦 find_prompts_end 判断两段提示词都已完整，或者超出 token 预算，就关闭连接，
+    不再等待模型输出剩余的解释性内容。
+    
+    Args:
+        response: 以 stream=True 发出的请求的响应
+        max_tokens: token 预算（按收到的增量块计数），0 表示不限制
+        
+    Returns:
+        str: 截断后的生成内容
+    """
+    content = ""
+    tokens = 0
+    try:
+        for line in response.iter_lines(decode_unicode=True):
+            if not line or not line.startswith("data:"):
+                continue
+            payload = line[len("data:"):].strip()
+            if payload == "[DONE]":
+                break
+            try:
+                chunk = json.loads(payload)
+            except ValueError:
+                continue
+            choices = chunk.get("choices") or [{}]
+            delta = choices[0].get("delta", {}).get("content") or ""
+            if not delta:
+                continue
+            content += delta
+            tokens += 1
+            
+            end = find_prompts_end(content)
+            if end is not None:
+                return content[:end]
+            if max_tokens and tokens >= max_tokens:
+                print(f"⚠️  LLM 输出超出 token 预算 ({max_tokens})，提前截断")
+                break
+    finally:
+        response.close()
+    return content
+
+
+def fallback_prompts(user_description: str, negative_requirements: str = "") -> tuple[str, str]:
+    """
+    不经过 LLM、直接由模板拼出的提示词，用于 LM Studio 出错或熔断时降级
+    
+    Returns:
+        元组，包含正面提示词和负面提示词
+    """
+    positive_prompt = f"pixel art style, game asset, {user_description}, white background, no shadow, no border"
+    negative_prompt = "blurry, noisy, malformed text, watermark, logo, text, deformed, ugly, disfigured, bad eyes, crossed eyes, fused fingers, missing limbs, extra limbs, poorly drawn hands, poorly drawn feet, extra digits, fewer digits, gross proportions, signature, username, artist name"
+    
+    # Add user-specified negative requirements to the negative prompt
+    if negative_requirements:
+        negative_elements = [neg.strip() for neg in negative_requirements.split(',') if neg.strip()]
+        for element in negative_elements:
+            if element.lower() not in negative_prompt.lower():
+                negative_prompt += ", " + element
+    
+    # Add terms to ensure no borders and no shadows in the generated image
+    if 'border' not in negative_prompt.lower():
+        negative_prompt += ", border, frame, outline"
+    if 'shadow' not in negative_prompt.lower():
+        negative_prompt += ", shadow, shade, shading"
+    
+    return positive_prompt, negative_prompt
+
+
+@timed("prompt")
+def generate_stable_diffusion_prompt(user_description: str, negative_requirements: str = "",
+                                     use_cache: bool = True) -> tuple[str, str]:
     """
     调用 LM Studio 模型 zai-org/glm-4.6v-flash 生成 Stable Diffusion 提示词
     
+    成功的 LLM 结果会写入提示词缓存，相同的描述再次请求时直接返回缓存结果。
+    
     Args:
         user_description: 用户对图像的描述
         negative_requirements: 用户指定的负面要求
+        use_cache: 是否使用提示词缓存
         
     Returns:
         元组，包含优化后的正面提示词和负面提示词
@@ -88,10 +221,14 @@ def generate_stable_diffusion_prompt(user_description: str, negative_requirement
         from config import Config
         base_url = Config.LM_STUDIO_BASE_URL
         model_name = Config.LM_STUDIO_MODEL
+        stream = Config.LM_STUDIO_STREAM
+        max_tokens = Config.LM_STUDIO_MAX_TOKENS
     except ImportError:
         # Fallback to environment variables if config is not available
         base_url = os.getenv("LM_STUDIO_BASE_URL", "http://localhost:1234")
         model_name = os.getenv("LM_STUDIO_MODEL", "qwen2.5-coder-7b-instruct-mlx")
+        stream = os.getenv("LM_STUDIO_STREAM", "false").lower() in ("1", "true", "yes")
+        max_tokens = int(os.getenv("LM_STUDIO_MAX_TOKENS", "0"))
     
     # 构建系统提示，强调返回纯净的提示词
     system_prompt = (
@@ -103,6 +240,22 @@ def generate_stable_diffusion_prompt(user_description: str, negative_requirement
         "Negative prompt should include: blurry, noisy, malformed text, watermark, logo, text, deformed, ugly, disfigured, bad eyes, crossed eyes, fused fingers, missing limbs, extra limbs, poorly drawn hands, poorly drawn feet, extra digits, fewer digits, gross proportions, signature, username, artist name. "
     )
     
+    # 先查缓存，命中时跳过 LLM 调用
+    cache = get_prompt_cache() if use_cache else None
+    cache_key = PromptCache.make_key(user_description, negative_requirements, model_name, system_prompt)
+    if cache is not None:
+        cached = cache.get(cache_key)
+        if cached is not None:
+            print("⚡ 提示词缓存命中")
+            CACHE_HITS.inc(cache="prompt")
+            return cached
+    
+    # LM Studio 连续失败后熔断器打开，直接使用模板提示词，不再等待连接超时
+    breaker = get_lm_studio_breaker()
+    if not breaker.allow_request():
+        print("🔌 LM Studio 熔断中，使用模板提示词")
+        return fallback_prompts(user_description, negative_requirements)
+    
     # 用户输入的描述
     if negative_requirements:
         user_prompt = f"Generate a concise English Stable Diffusion positive prompt and negative prompt for this pixel art game asset: {user_description}. Positive prompt must have white background, no shadows, and no borders. Negative prompt must include these specific requirements: {negative_requirements}. Separate the positive and negative prompts with '|||'. Output ONLY the prompts, no explanations."
@@ -118,21 +271,32 @@ def generate_stable_diffusion_prompt(user_description: str, negative_requirement
         # "model": "zai-org/glm-4.6v-flash",
         "model": model_name,
         "temperature": 0.3,  # Even lower temperature for more deterministic output
-        "max_tokens": None,  # No limit on output length
-        "stream": False
+        "max_tokens": max_tokens or None,  # 0 = no limit on output length
+        "stream": stream
     }
     
     try:
         # 发送请求到 LM Studio
-        response = requests.post(
+        response = get_lm_studio_client().post(
             f"{base_url}/v1/chat/completions",
             headers={"Content-Type": "application/json"},
-            data=json.dumps(data)
+            data=json.dumps(data),
+            stream=stream
         )
         
+        # 5xx 说明后端本身出了问题，其余响应都说明后端可达
+        if response.status_code >= 500:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        
         if response.status_code == 200:
-            result = response.json()
-            generated_content = result['choices'][0]['message']['content'].strip()
+            if stream:
+                # 流式读取，两段提示词都完整后立即断开
+                generated_content = read_streamed_completion(response, max_tokens).strip()
+            else:
+                result = response.json()
+                generated_content = result['choices'][0]['message']['content'].strip()
             
             # Look for "Thought:" marker and extract content after it
             thought_split = generated_content.split("Thought:")
@@ -223,69 +387,19 @@ def generate_stable_diffusion_prompt(user_description: str, negative_requirement
                 else:
                     negative_prompt = "shadow, shade, shading"
             
+            if cache is not None:
+                cache.put(cache_key, (positive_prompt, negative_prompt))
             return positive_prompt, negative_prompt
         else:
             print(f"Error from LM Studio: {response.status_code}, {response.text}")
-            # 返回默认的正向和负向提示词
-            positive_prompt = f"pixel art style, game asset, {user_description}, white background, no shadow, no border"
-            negative_prompt = "blurry, noisy, malformed text, watermark, logo, text, deformed, ugly, disfigured, bad eyes, crossed eyes, fused fingers, missing limbs, extra limbs, poorly drawn hands, poorly drawn feet, extra digits, fewer digits, gross proportions, signature, username, artist name"
-            
-            # Add user-specified negative requirements to the negative prompt
-            if negative_requirements:
-                # Ensure the negative requirements are added to the negative prompt
-                negative_elements = [neg.strip() for neg in negative_requirements.split(',') if neg.strip()]
-                for element in negative_elements:
-                    if element.lower() not in negative_prompt.lower():
-                        if negative_prompt:
-                            negative_prompt += ", " + element
-                        else:
-                            negative_prompt = element
-            
-            # Add terms to ensure no borders and no shadows in the generated image
-            if 'border' not in negative_prompt.lower():
-                if negative_prompt:
-                    negative_prompt += ", border, frame, outline"
-                else:
-                    negative_prompt = "border, frame, outline"
-            
-            if 'shadow' not in negative_prompt.lower():
-                if negative_prompt:
-                    negative_prompt += ", shadow, shade, shading"
-                else:
-                    negative_prompt = "shadow, shade, shading"
-            
-            return positive_prompt, negative_prompt
+            record_error("prompt", f"http_{response.status_code}")
+            return fallback_prompts(user_description, negative_requirements)
     except requests.exceptions.RequestException as e:
         print(f"Error connecting to LM Studio: {e}")
+        record_error("prompt", error_cause(e))
+        breaker.record_failure()
         # 如果连接失败，返回一个基本的提示词
-        positive_prompt = f"pixel art style, game asset, {user_description}, white background, no shadow, no border"
-        negative_prompt = "blurry, noisy, malformed text, watermark, logo, text, deformed, ugly, disfigured, bad eyes, crossed eyes, fused fingers, missing limbs, extra limbs, poorly drawn hands, poorly drawn feet, extra digits, fewer digits, gross proportions, signature, username, artist name"
-        
-        # Add user-specified negative requirements to the negative prompt
-        if negative_requirements:
-            # Ensure the negative requirements are added to the negative prompt
-            negative_elements = [neg.strip() for neg in negative_requirements.split(',') if neg.strip()]
-            for element in negative_elements:
-                if element.lower() not in negative_prompt.lower():
-                    if negative_prompt:
-                        negative_prompt += ", " + element
-                    else:
-                        negative_prompt = element
-        
-        # Add terms to ensure no borders and no shadows in the generated image
-        if 'border' not in negative_prompt.lower():
-            if negative_prompt:
-                negative_prompt += ", border, frame, outline"
-            else:
-                negative_prompt = "border, frame, outline"
-        
-        if 'shadow' not in negative_prompt.lower():
-            if negative_prompt:
-                negative_prompt += ", shadow, shade, shading"
-            else:
-                negative_prompt = "shadow, shade, shading"
-        
-        return positive_prompt, negative_prompt
+        return fallback_prompts(user_description, negative_requirements)
 
 
 def main():
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+按内容寻址的图像结果缓存：以完整 txt2img 请求参数的哈希为键保存 PNG 数据，
+固定 seed 的重复请求无需再次调用 Draw Things
+"""
+
+import os
+import sys
+import json
+import hashlib
+import threading
+import inspect
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+# Get the project root directory to import config
+current_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parent_dir = os.path.dirname(current_dir)
+if parent_dir not in sys.path:
+    sys.path.insert(0, parent_dir)
+
+try:
+    from config import Config
+    IMAGE_CACHE_DIR = Config.IMAGE_CACHE_DIR
+    IMAGE_CACHE_MAX_BYTES = Config.IMAGE_CACHE_MAX_BYTES
+except ImportError:
+    # Fallback to defaults if config is not available
+    IMAGE_CACHE_DIR = "image_cache"
+    IMAGE_CACHE_MAX_BYTES = 1024 ** 3
+
+
+def payload_hash(payload: Dict[str, Any]) -> str:
+    """计算 txt2img 请求参数的规范化哈希（键顺序无关）"""
+    canonical = json.dumps(payload, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class ImageResultCache:
+    """
+    保存在磁盘上的图像结果缓存
+
+    文件按哈希前两位分目录存放（<cache_dir>/ab/abcdef....png）。启动时扫描一次目录，
+    之后在内存中维护 LRU 顺序和总字节数；总大小超过 max_bytes 时淘汰最久未使用的条目。
+    子类可以通过 FILE_PATTERNS、_path 和 _key 改变键与文件名的对应关系。
+    """
+
+    # 启动时扫描的缓存文件（相对于 cache_dir 的 glob 模式）
+    FILE_PATTERNS = ("*/*.png",)
+
+    def __init__(self, cache_dir: str = None, max_bytes: int = None):
+        self.cache_dir = Path(cache_dir or IMAGE_CACHE_DIR)
+        self.max_bytes = int(max_bytes if max_bytes is not None else IMAGE_CACHE_MAX_BYTES)
+        self.hits = 0
+        self.misses = 0
+        self.total_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._load_entries()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}.png"
+
+    def _key(self, path: Path) -> str:
+        return path.stem
+
+    def _load_entries(self):
+        if not self.enabled or not self.cache_dir.exists():
+            return
+        # 按修改时间排序，恢复上次运行时的近似 LRU 顺序
+        files = [path for pattern in self.FILE_PATTERNS for path in self.cache_dir.glob(pattern)]
+        for path in sorted(files, key=lambda p: p.stat().st_mtime):
+            size = path.stat().st_size
+            self._entries[self._key(path)] = size
+            self.total_bytes += size
+        self._evict()
+
+    def get(self, key: str) -> Optional[bytes]:
+        """
+        读取缓存的 PNG 数据
+
+        Returns:
+            bytes: PNG 数据，未命中时返回 None
+        """
+        if not self.enabled:
+            return None
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+        path = self._path(key)
+        try:
+            data = path.read_bytes()
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                size = self._entries.pop(key, None)
+                if size is not None:
+                    self.total_bytes -= size
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def put(self, key: str, data: bytes):
+        """写入一条缓存记录，必要时淘汰旧条目"""
+        if not self.enabled or len(data) > self.max_bytes:
+            return
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f"{path.name}.{threading.get_ident()}.tmp")
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.total_bytes -= previous
+            self._entries[key] = len(data)
+            self.total_bytes += len(data)
+            self._evict()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "total_bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                self._path(key).unlink()
+            except OSError:
+                pass
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_image_cache() -> ImageResultCache:
+    """获取进程内共享的图像结果缓存"""
+    global _default_cache
+    if _default_cache is None:
+        with _default_cache_lock:
+            if _default_cache is None:
+                _default_cache = ImageResultCache()
+    return _default_cache
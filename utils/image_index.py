@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+"""
+生成图像的持久化索引（SQLite），用于快速分页列出和检索已生成的图像，
+避免在请求路径上扫描 generated_images 目录
+"""
+
+import os
+import sys
+import sqlite3
+import threading
+import time
+import inspect
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+# Get the project root directory to import config
+current_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parent_dir = os.path.dirname(current_dir)
+if parent_dir not in sys.path:
+    sys.path.insert(0, parent_dir)
+
+try:
+    from config import Config
+    GENERATED_IMAGES_DIR = Config.GENERATED_IMAGES_DIR
+    IMAGE_INDEX_PATH = Config.IMAGE_INDEX_PATH
+except ImportError:
+    # Fallback to defaults if config is not available
+    GENERATED_IMAGES_DIR = "generated_images"
+    IMAGE_INDEX_PATH = "image_index.db"
+
+
+COLUMNS = ("id", "filename", "positive", "negative", "steps", "cfg", "seed",
+           "width", "height", "bytes", "created_at")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    filename TEXT NOT NULL UNIQUE,
+    positive TEXT NOT NULL DEFAULT '',
+    negative TEXT NOT NULL DEFAULT '',
+    steps INTEGER,
+    cfg REAL,
+    seed INTEGER,
+    width INTEGER,
+    height INTEGER,
+    bytes INTEGER,
+    created_at REAL NOT NULL,
+    cache_key TEXT
+);
+"""
+
+# 全文索引：使用外部内容表，通过触发器与 images 表保持同步
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS images_fts USING fts5(
+    positive, negative, content='images', content_rowid='id'
+);
+CREATE TRIGGER IF NOT EXISTS images_ai AFTER INSERT ON images BEGIN
+    INSERT INTO images_fts(rowid, positive, negative) VALUES (new.id, new.positive, new.negative);
+END;
+CREATE TRIGGER IF NOT EXISTS images_ad AFTER DELETE ON images BEGIN
+    INSERT INTO images_fts(images_fts, rowid, positive, negative) VALUES ('delete', old.id, old.positive, old.negative);
+END;
+CREATE TRIGGER IF NOT EXISTS images_au AFTER UPDATE ON images BEGIN
+    INSERT INTO images_fts(images_fts, rowid, positive, negative) VALUES ('delete', old.id, old.positive, old.negative);
+    INSERT INTO images_fts(rowid, positive, negative) VALUES (new.id, new.positive, new.negative);
+END;
+"""
+
+
+class ImageIndex:
+    """
+    已生成图像的 SQLite 索引
+
+    每个线程使用独立连接，数据库以 WAL 模式打开，读写可以并发进行。
+    列表查询使用基于 id 的键集分页（keyset pagination），
+    无论索引中有多少条记录，翻页的代价都保持不变。
+    """
+
+    def __init__(self, db_path: str = None):
+        self.db_path = db_path or IMAGE_INDEX_PATH
+        self._local = threading.local()
+        self.fts_enabled = False
+        self._init_schema()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            db_dir = os.path.dirname(os.path.abspath(self.db_path))
+            os.makedirs(db_dir, exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _init_schema(self):
+        conn = self._connect()
+        with conn:
+            conn.executescript(SCHEMA)
+            # 旧版本创建的数据库没有 cache_key 列
+            if "cache_key" not in {row["name"] for row in conn.execute("PRAGMA table_info(images)")}:
+                conn.execute("ALTER TABLE images ADD COLUMN cache_key TEXT")
+            conn.execute("CREATE INDEX IF NOT EXISTS images_cache_key ON images (cache_key)")
+            try:
+                conn.executescript(FTS_SCHEMA)
+                self.fts_enabled = True
+            except sqlite3.OperationalError:
+                # SQLite 未编译 FTS5 时退回到 LIKE 查询
+                self.fts_enabled = False
+
+    def add(self, filename: str, record: Dict[str, Any] = None, seed: int = None,
+            width: int = None, height: int = None, byte_length: int = None,
+            created_at: float = None, cache_key: str = None) -> int:
+        """
+        添加（或更新）一张图像的索引记录
+
+        Args:
+            filename: 相对于图像目录的文件名
+            record: 生成参数记录（positive、negative、steps、cfg 等）
+            seed: 随机种子
+            width: 图像宽度
+            height: 图像高度
+            byte_length: 文件字节数
+            created_at: 创建时间（Unix 时间戳），默认当前时间
+            cache_key: 图像结果缓存中的键（固定 seed 的图像），用于复用已保存的文件
+
+        Returns:
+            int: 记录 id
+        """
+        record = record or {}
+        values = (
+            filename,
+            record.get("positive", ""),
+            record.get("negative", ""),
+            record.get("steps"),
+            record.get("cfg"),
+            seed,
+            width,
+            height,
+            byte_length,
+            created_at if created_at is not None else time.time(),
+            cache_key,
+        )
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                "INSERT INTO images (filename, positive, negative, steps, cfg, seed, width, height, bytes, created_at, "
+                "cache_key) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(filename) DO UPDATE SET positive=excluded.positive, negative=excluded.negative, "
+                "steps=excluded.steps, cfg=excluded.cfg, seed=excluded.seed, width=excluded.width, "
+                "height=excluded.height, bytes=excluded.bytes, created_at=excluded.created_at, "
+                "cache_key=excluded.cache_key",
+                values,
+            )
+            row = conn.execute("SELECT id FROM images WHERE filename = ?", (filename,)).fetchone()
+        return row["id"]
+
+    def get(self, filename: str) -> Optional[Dict[str, Any]]:
+        """按文件名查找索引记录，不存在时返回 None"""
+        row = self._connect().execute(
+            f"SELECT {', '.join(COLUMNS)} FROM images WHERE filename = ?", (filename,)
+        ).fetchone()
+        return dict(row) if row else None
+
+    def find_by_cache_key(self, cache_key: str) -> Optional[Dict[str, Any]]:
+        """按图像结果缓存的键查找最新的一条记录，不存在时返回 None"""
+        row = self._connect().execute(
+            f"SELECT {', '.join(COLUMNS)} FROM images WHERE cache_key = ? ORDER BY id DESC LIMIT 1", (cache_key,)
+        ).fetchone()
+        return dict(row) if row else None
+
+    def rename(self, filename: str, new_filename: str) -> bool:
+        """修改记录的文件名（迁移目录布局时使用），保留其余元数据"""
+        conn = self._connect()
+        with conn:
+            cursor = conn.execute("UPDATE images SET filename = ? WHERE filename = ?", (new_filename, filename))
+        return cursor.rowcount > 0
+
+    def update_bytes(self, filename: str, byte_length: int) -> bool:
+        """更新图像文件大小（例如后台重新压缩之后）"""
+        conn = self._connect()
+        with conn:
+            cursor = conn.execute("UPDATE images SET bytes = ? WHERE filename = ?", (byte_length, filename))
+        return cursor.rowcount > 0
+
+    def remove(self, filename: str) -> bool:
+        """删除一条索引记录"""
+        conn = self._connect()
+        with conn:
+            cursor = conn.execute("DELETE FROM images WHERE filename = ?", (filename,))
+        return cursor.rowcount > 0
+
+    def list(self, limit: int = 50, cursor: int = None, query: str = None) -> Tuple[List[Dict[str, Any]], Optional[int]]:
+        """
+        按创建顺序倒序分页列出图像
+
+        Args:
+            limit: 每页数量
+            cursor: 上一页返回的游标（上一页最后一条记录的 id）
+            query: 可选的提示词过滤文本
+
+        Returns:
+            tuple: (记录列表, 下一页游标；没有更多数据时为 None)
+        """
+        limit = max(1, int(limit))
+        columns = ", ".join(f"images.{column}" for column in COLUMNS)
+        conditions = []
+        params: List[Any] = []
+        source = "images"
+
+        if query and query.strip():
+            if self.fts_enabled:
+                source = "images_fts JOIN images ON images.id = images_fts.rowid"
+                conditions.append("images_fts MATCH ?")
+                params.append(_fts_query(query))
+            else:
+                pattern = "%" + _escape_like(query.strip()) + "%"
+                conditions.append("(images.positive LIKE ? ESCAPE '\\' OR images.negative LIKE ? ESCAPE '\\')")
+                params.extend([pattern, pattern])
+
+        if cursor is not None:
+            conditions.append("images.id < ?")
+            params.append(int(cursor))
+
+        sql = f"SELECT {columns} FROM {source}"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY images.id DESC LIMIT ?"
+        params.append(limit + 1)
+
+        rows = [dict(row) for row in self._connect().execute(sql, params).fetchall()]
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = rows[-1]["id"]
+        return rows, next_cursor
+
+    def rebuild(self, images_dir: str = None) -> int:
+        """
+        扫描图像目录，把尚未索引的图像补录到索引中（用于已有的历史图像）
+
+        Returns:
+            int: 新增的记录数
+        """
+        from PIL import Image
+        from image_store import DERIVED_SUFFIXES, iter_images
+
+        images_dir = Path(images_dir or GENERATED_IMAGES_DIR)
+        added = 0
+        for path in sorted(iter_images(images_dir), key=lambda p: p.stat().st_mtime):
+            if path.stem.endswith(DERIVED_SUFFIXES) or self.get(path.name):
+                continue
+            stat = path.stat()
+            with Image.open(path) as img:
+                width, height = img.size
+            self.add(path.name, width=width, height=height,
+                     byte_length=stat.st_size, created_at=stat.st_mtime)
+            added += 1
+        return added
+
+
+def _fts_query(text: str) -> str:
+    """把用户输入转换为安全的 FTS5 查询：每个词按前缀匹配，词之间为 AND"""
+    terms = [term.replace('"', '""') for term in text.split()]
+    return " ".join(f'"{term}"*' for term in terms)
+
+
+def _escape_like(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+_default_index = None
+_default_index_lock = threading.Lock()
+
+
+def get_image_index() -> ImageIndex:
+    """获取进程内共享的默认图像索引"""
+    global _default_index
+    if _default_index is None:
+        with _default_index_lock:
+            if _default_index is None:
+                _default_index = ImageIndex(IMAGE_INDEX_PATH)
+    return _default_index
+
+
+def main():
+    """主函数：重建索引"""
+    images_dir = sys.argv[1] if len(sys.argv) > 1 else GENERATED_IMAGES_DIR
+    print(f"📥 正在索引 {images_dir} ...")
+    added = get_image_index().rebuild(images_dir)
+    print(f"✅ 新增 {added} 条索引记录")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""
+生成图像的磁盘布局：按时间排序的唯一 ID + 分片目录
+
+每张图像获得一个 26 位的 ULID 风格 ID（48 位毫秒时间戳 + 80 位随机数，Crockford base32 小写），
+同一毫秒内生成的 ID 单调递增，不会因为同一秒保存多张图而互相覆盖。
+文件按 ID 末尾的随机字符分两级目录存放：<images_dir>/<id[-2:]>/<id[-4:-2]>/<id>.png，
+共 1024 个分片目录，百万级图像时每个目录也只有约一千个文件。
+由 ID 可以直接算出路径，/images/<id> 无需扫描目录。
+"""
+
+import os
+import sys
+import json
+import time
+import secrets
+import inspect
+import argparse
+import threading
+from pathlib import Path
+from typing import Dict, Optional
+
+# Get the project root directory to import config
+current_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parent_dir = os.path.dirname(current_dir)
+if parent_dir not in sys.path:
+    sys.path.insert(0, parent_dir)
+
+try:
+    from config import Config
+    GENERATED_IMAGES_DIR = Config.GENERATED_IMAGES_DIR
+except ImportError:
+    # Fallback to defaults if config is not available
+    GENERATED_IMAGES_DIR = "generated_images"
+
+ALPHABET = "0123456789abcdefghjkmnpqrstvwxyz"
+ID_LENGTH = 26
+IMAGE_SUFFIXES = (".png", ".jpg", ".jpeg")
+# 后处理生成的派生文件后缀（<id>_native.png 等），与原图存放在同一分片目录中，
+# 遍历、索引和迁移原图时跳过它们
+DERIVED_SUFFIXES = ("_native", "_indexed", "_alpha")
+
+_last_ms = -1
+_last_random = 0
+_id_lock = threading.Lock()
+
+
+def new_image_id(timestamp: float = None) -> str:
+    """
+    生成按时间排序的唯一图像 ID
+
+    Args:
+        timestamp: 使用的时间（秒），默认为当前时间；迁移旧文件时传入文件的修改时间
+    """
+    global _last_ms, _last_random
+    ms = int((time.time() if timestamp is None else timestamp) * 1000)
+    with _id_lock:
+        if ms == _last_ms:
+            # 同一毫秒内递增随机部分，保证进程内严格单调
+            random_part = (_last_random + 1) & ((1 << 80) - 1)
+        else:
+            random_part = secrets.randbits(80)
+        _last_ms, _last_random = ms, random_part
+    value = (ms << 80) | random_part
+    chars = []
+    for _ in range(ID_LENGTH):
+        chars.append(ALPHABET[value & 31])
+        value >>= 5
+    return "".join(reversed(chars))
+
+
+def is_image_id(value: str) -> bool:
+    return len(value) == ID_LENGTH and all(char in ALPHABET for char in value)
+
+
+def id_timestamp(image_id: str) -> float:
+    """从 ID 中取出生成时间（秒）"""
+    value = 0
+    for char in image_id:
+        value = (value << 5) | ALPHABET.index(char)
+    return (value >> 80) / 1000
+
+
+def shard_dir(images_dir, image_id: str) -> Path:
+    """ID 对应的分片目录"""
+    return Path(images_dir) / image_id[-2:] / image_id[-4:-2]
+
+
+def image_path(images_dir, image_id: str, suffix: str = "", extension: str = ".png") -> Path:
+    """
+    ID 对应的文件路径
+
+    Args:
+        suffix: 派生文件后缀，例如 "_native"
+    """
+    return shard_dir(images_dir, image_id) / f"{image_id}{suffix}{extension}"
+
+
+def resolve(images_dir, name: str) -> Optional[Path]:
+    """
+    把 /images/<name> 中的名字解析为文件路径，不扫描目录
+
+    支持 "<id>"、"<id>.png"、"<id>_native.png" 等分片布局中的文件，
+    以及尚未迁移的平铺文件名（例如 generated_20240101_120000.png）。
+
+    Returns:
+        Path: 存在的文件路径；名字不合法或文件不存在时返回 None
+    """
+    if not name or "/" in name or "\\" in name or name.startswith("."):
+        return None
+    stem, extension = os.path.splitext(name)
+    image_id = stem.split("_", 1)[0]
+    if is_image_id(image_id):
+        path = shard_dir(images_dir, image_id) / (name if extension else f"{name}.png")
+    else:
+        path = Path(images_dir) / name
+    return path if path.is_file() else None
+
+
+def iter_images(images_dir):
+    """遍历目录（包括分片子目录）中的所有图像文件"""
+    for path in Path(images_dir).rglob("*"):
+        if path.suffix.lower() in IMAGE_SUFFIXES and path.is_file():
+            yield path
+
+
+def migrate_flat_directory(images_dir=None, dry_run: bool = False, index=None) -> Dict[str, str]:
+    """
+    把平铺目录中的旧图像迁移到分片布局
+
+    每张原图按修改时间分配新 ID，它的派生文件（<旧文件名>_native.png 等）随之改名移动，
+    图像索引中的记录同步改名并保留原有元数据。
+
+    Returns:
+        dict: 旧文件名 -> 新文件名 的映射（同时写入 <images_dir>/migration_map.json）
+    """
+    images_dir = Path(images_dir or GENERATED_IMAGES_DIR)
+    flat_files = sorted(
+        (path for path in images_dir.iterdir() if path.is_file() and path.suffix.lower() in IMAGE_SUFFIXES),
+        key=lambda path: path.stat().st_mtime
+    )
+    originals = [path for path in flat_files if not path.stem.endswith(DERIVED_SUFFIXES)]
+
+    mapping = {}
+    for original in originals:
+        image_id = new_image_id(original.stat().st_mtime)
+        moves = [(original, image_path(images_dir, image_id, extension=original.suffix.lower()))]
+        for suffix in DERIVED_SUFFIXES:
+            derived = original.with_name(f"{original.stem}{suffix}.png")
+            if derived.exists():
+                moves.append((derived, image_path(images_dir, image_id, suffix)))
+
+        for source, target in moves:
+            mapping[source.name] = target.name
+            if dry_run:
+                continue
+            target.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(source, target)
+        if not dry_run and index is not None:
+            index.rename(original.name, moves[0][1].name)
+
+    if not dry_run and mapping:
+        map_path = images_dir / "migration_map.json"
+        previous = json.loads(map_path.read_text(encoding="utf-8")) if map_path.exists() else {}
+        previous.update(mapping)
+        map_path.write_text(json.dumps(previous, indent=2), encoding="utf-8")
+    return mapping
+
+
+def main(argv=None):
+    """主函数：把平铺目录迁移到分片布局"""
+    parser = argparse.ArgumentParser(description="把平铺目录中的生成图像迁移到按 ID 分片的目录布局")
+    parser.add_argument("images_dir", nargs="?", default=GENERATED_IMAGES_DIR, help="图像目录")
+    parser.add_argument("--dry-run", action="store_true", help="只打印迁移计划，不移动文件")
+    args = parser.parse_args(argv)
+
+    from image_index import get_image_index
+
+    mapping = migrate_flat_directory(args.images_dir, args.dry_run,
+                                     index=None if args.dry_run else get_image_index())
+    for old_name, new_name in mapping.items():
+        print(f"{'📋' if args.dry_run else '📦'} {old_name} -> {new_name}")
+    print(f"✅ {'计划迁移' if args.dry_run else '已迁移'} {len(mapping)} 个文件")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+"""
+按需生成图像的派生版本（缩略图、最近邻放大、格式转换），并缓存结果
+
+派生图以 "源文件内容哈希 + 变换参数" 为键，先查内存 LRU，再查磁盘 LRU（DerivedFileCache，
+按实际编码格式保存扩展名），都未命中时在线程池中计算；同一键的并发请求共享同一次计算。
+"""
+
+import os
+import sys
+import inspect
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from io import BytesIO
+from pathlib import Path
+from typing import Dict, Mapping, Optional
+
+from PIL import Image
+
+from image_cache import ImageResultCache, payload_hash
+
+# Get the project root directory to import config
+current_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parent_dir = os.path.dirname(current_dir)
+if parent_dir not in sys.path:
+    sys.path.insert(0, parent_dir)
+
+try:
+    from config import Config
+    DERIVED_CACHE_DIR = Config.DERIVED_CACHE_DIR
+    DERIVED_CACHE_MAX_BYTES = Config.DERIVED_CACHE_MAX_BYTES
+    DERIVED_MEMORY_CACHE_BYTES = Config.DERIVED_MEMORY_CACHE_BYTES
+    TRANSFORM_WORKERS = Config.TRANSFORM_WORKERS
+except ImportError:
+    # Fallback to defaults if config is not available
+    DERIVED_CACHE_DIR = "derived_cache"
+    DERIVED_CACHE_MAX_BYTES = 256 * 1024 ** 2
+    DERIVED_MEMORY_CACHE_BYTES = 32 * 1024 ** 2
+    TRANSFORM_WORKERS = 4
+
+FORMATS = {
+    "png": ("PNG", "image/png"),
+    "webp": ("WEBP", "image/webp"),
+    "jpeg": ("JPEG", "image/jpeg"),
+}
+MAX_SCALE = 8
+MAX_SIZE_LIMIT = 2048
+
+
+@dataclass(frozen=True)
+class TransformParams:
+    """一次变换的参数：先按 scale 最近邻放大，再等比缩小到 max_size 以内，最后转换格式"""
+    scale: int = 1
+    max_size: Optional[int] = None
+    format: str = "png"
+
+    @property
+    def mimetype(self) -> str:
+        return FORMATS[self.format][1]
+
+    @property
+    def tag(self) -> str:
+        """参数的短标识，用于拼接 ETag"""
+        return f"s{self.scale}-m{self.max_size or 0}-{self.format}"
+
+    def cache_key(self, source_hash: str) -> str:
+        """缓存键 "<哈希>.<格式>"，同时也是磁盘缓存中的文件名"""
+        digest = payload_hash({"source": source_hash, "scale": self.scale,
+                               "max_size": self.max_size, "format": self.format})
+        return f"{digest}.{self.format}"
+
+
+def parse_transform(args: Mapping[str, str]) -> Optional[TransformParams]:
+    """
+    从查询参数解析变换（scale、max_size、format）
+
+    Returns:
+        TransformParams: 变换参数；没有任何变换参数时返回 None
+
+    Raises:
+        ValueError: 参数不合法
+    """
+    if not any(name in args for name in ("scale", "max_size", "format")):
+        return None
+    try:
+        scale = int(args.get("scale", 1))
+        max_size = int(args["max_size"]) if args.get("max_size") else None
+    except ValueError:
+        raise ValueError("scale and max_size must be integers")
+    image_format = args.get("format", "png").lower()
+    if image_format == "jpg":
+        image_format = "jpeg"
+    if not 1 <= scale <= MAX_SCALE:
+        raise ValueError(f"scale must be between 1 and {MAX_SCALE}")
+    if max_size is not None and not 1 <= max_size <= MAX_SIZE_LIMIT:
+        raise ValueError(f"max_size must be between 1 and {MAX_SIZE_LIMIT}")
+    if image_format not in FORMATS:
+        raise ValueError(f"format must be one of {', '.join(FORMATS)}")
+    return TransformParams(scale, max_size, image_format)
+
+
+def transform_image(source_path, params: TransformParams) -> bytes:
+    """
+    按参数生成派生图；所有缩放都使用最近邻采样，保持像素画的硬边
+
+    Returns:
+        bytes: 编码后的图像数据
+    """
+    with Image.open(source_path) as img:
+        img.load()
+    if params.scale > 1:
+        img = img.resize((img.width * params.scale, img.height * params.scale), Image.NEAREST)
+    if params.max_size and max(img.size) > params.max_size:
+        ratio = params.max_size / max(img.size)
+        img = img.resize((max(1, round(img.width * ratio)), max(1, round(img.height * ratio))), Image.NEAREST)
+
+    pil_format = FORMATS[params.format][0]
+    save_kwargs = {}
+    if pil_format == "JPEG":
+        # JPEG 没有透明通道，把透明区域铺成提示词要求的白色背景
+        if img.mode in ("RGBA", "LA", "P"):
+            rgba = img.convert("RGBA")
+            img = Image.new("RGB", rgba.size, "white")
+            img.paste(rgba, mask=rgba.getchannel("A"))
+        else:
+            img = img.convert("RGB")
+        save_kwargs["quality"] = 90
+    elif pil_format == "WEBP":
+        save_kwargs["lossless"] = True
+    else:
+        save_kwargs["optimize"] = True
+
+    buffer = BytesIO()
+    img.save(buffer, format=pil_format, **save_kwargs)
+    return buffer.getvalue()
+
+
+class DerivedFileCache(ImageResultCache):
+    """派生图的磁盘 LRU：键本身带有格式扩展名，WebP、JPEG 不会以 .png 保存"""
+
+    FILE_PATTERNS = tuple(f"*/*.{image_format}" for image_format in FORMATS)
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / key
+
+    def _key(self, path: Path) -> str:
+        return path.name
+
+
+class DerivedImageCache:
+    """
+    派生图缓存：内存 LRU（按字节数限制）+ 磁盘 LRU，未命中时在线程池中计算
+    """
+
+    def __init__(self, cache_dir: str = None, max_bytes: int = None,
+                 memory_bytes: int = None, workers: int = None):
+        self.disk = DerivedFileCache(cache_dir or DERIVED_CACHE_DIR,
+                                     DERIVED_CACHE_MAX_BYTES if max_bytes is None else max_bytes)
+        self.memory_bytes = DERIVED_MEMORY_CACHE_BYTES if memory_bytes is None else memory_bytes
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._memory_total = 0
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers or TRANSFORM_WORKERS,
+                                            thread_name_prefix="image-transform")
+
+    def render(self, source_path, source_hash: str, params: TransformParams) -> bytes:
+        """返回派生图数据，优先从缓存读取"""
+        key = params.cache_key(source_hash)
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return data
+
+        data = self.disk.get(key)
+        if data is not None:
+            with self._lock:
+                self.disk_hits += 1
+                self._remember(key, data)
+            return data
+
+        with self._lock:
+            future = self._inflight.get(key)
+            if future is None:
+                self.misses += 1
+                future = self._executor.submit(self._compute, key, source_path, params)
+                self._inflight[key] = future
+        return future.result()
+
+    def _compute(self, key: str, source_path, params: TransformParams) -> bytes:
+        try:
+            data = transform_image(source_path, params)
+            self.disk.put(key, data)
+            with self._lock:
+                self._remember(key, data)
+            return data
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def _remember(self, key: str, data: bytes):
+        """放入内存 LRU（调用方需持有锁）"""
+        if len(data) > self.memory_bytes:
+            return
+        previous = self._memory.pop(key, None)
+        if previous is not None:
+            self._memory_total -= len(previous)
+        self._memory[key] = data
+        self._memory_total += len(data)
+        while self._memory_total > self.memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_total -= len(evicted)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_total,
+                "disk_bytes": self.disk.stats()["total_bytes"],
+            }
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_derived_cache() -> DerivedImageCache:
+    """获取进程内共享的派生图缓存"""
+    global _default_cache
+    if _default_cache is None:
+        with _default_cache_lock:
+            if _default_cache is None:
+                _default_cache = DerivedImageCache()
+    return _default_cache
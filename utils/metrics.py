@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+"""
+进程内指标：各生成阶段的耗时直方图、进行中的请求数、按原因分类的错误数和生成的字节数
+
+以 Prometheus 文本格式（text exposition format 0.0.4）通过 /metrics 暴露，不依赖 prometheus_client。
+"""
+
+import time
+import threading
+import functools
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Tuple
+
+import requests
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# 覆盖从毫秒级的解码到数分钟的图像生成
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Iterable[str], values: Iterable, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """带标签的指标基类"""
+
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+                for key, value in items]
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Counter(_Metric):
+    """只增不减的计数器"""
+
+    type_name = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """可增可减的当前值；也可以用回调函数在输出时取值"""
+
+    type_name = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._function = None
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, function: Callable):
+        """
+        输出时调用 function 取值：无标签时返回一个数，有标签时返回 {标签值元组: 数值}
+        """
+        self._function = function
+
+    def samples(self) -> List[str]:
+        if self._function is not None:
+            result = self._function()
+            values = result if self.labelnames else {(): result}
+            with self._lock:
+                self._values = {tuple(str(v) for v in key): value for key, value in values.items()}
+        return super().samples()
+
+
+class Histogram(_Metric):
+    """按桶统计的分布，输出累计桶计数、总和与样本数"""
+
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 buckets: Iterable[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state["counts"][i] += 1
+                    break
+            state["sum"] += value
+            state["count"] += 1
+
+    def count(self, **labels) -> int:
+        with self._lock:
+            state = self._values.get(self._key(labels))
+            return state["count"] if state else 0
+
+    def total(self, **labels) -> float:
+        """样本值之和"""
+        with self._lock:
+            state = self._values.get(self._key(labels))
+            return state["sum"] if state else 0.0
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = sorted((key, dict(state, counts=list(state["counts"]))) for key, state in self._values.items())
+        lines = []
+        for key, state in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, state["counts"]):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, f'le="{_format_value(bound)}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(state['sum'])}")
+            lines.append(f"{self.name}_count{labels} {state['count']}")
+        return lines
+
+
+class Registry:
+    """指标注册表"""
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """按 Prometheus 文本格式输出所有指标"""
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.header())
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    "pixelart_stage_duration_seconds",
+    "Latency of each generation stage (prompt, image, base64_decode, png_decode, save, postprocess)",
+    ["stage"]
+))
+STAGE_IN_FLIGHT = REGISTRY.register(Gauge(
+    "pixelart_stage_in_flight", "Calls currently running in each generation stage", ["stage"]
+))
+STAGE_ERRORS = REGISTRY.register(Counter(
+    "pixelart_stage_errors_total", "Failed calls per generation stage by cause", ["stage", "cause"]
+))
+CACHE_HITS = REGISTRY.register(Counter(
+    "pixelart_cache_hits_total", "Requests served from a cache instead of a backend", ["cache"]
+))
+CIRCUIT_STATE = REGISTRY.register(Gauge(
+    "pixelart_circuit_breaker_state", "Circuit breaker state per backend (0 closed, 1 half-open, 2 open)",
+    ["backend"]
+))
+CIRCUIT_SHORT_CIRCUITS = REGISTRY.register(Counter(
+    "pixelart_circuit_breaker_short_circuits_total",
+    "Requests answered by the fallback without contacting an open backend", ["backend"]
+))
+COALESCED_REQUESTS = REGISTRY.register(Counter(
+    "pixelart_coalesced_requests_total",
+    "Requests that attached to an identical in-flight computation instead of running their own", ["stage"]
+))
+IMAGES_GENERATED = REGISTRY.register(Counter(
+    "pixelart_images_generated_total", "Images written to disk"
+))
+IMAGE_BYTES = REGISTRY.register(Counter(
+    "pixelart_image_bytes_generated_total", "Bytes of image data written to disk"
+))
+
+
+def error_cause(error: BaseException) -> str:
+    """把异常归类为错误原因标签"""
+    if isinstance(error, requests.exceptions.Timeout):
+        return "timeout"
+    if isinstance(error, requests.exceptions.ConnectionError):
+        return "connection"
+    return type(error).__name__
+
+
+def record_error(stage: str, cause: str):
+    STAGE_ERRORS.inc(stage=stage, cause=cause)
+
+
+@contextmanager
+def track(stage: str):
+    """统计一个阶段的耗时和进行中数量；异常按原因计数后继续抛出"""
+    STAGE_IN_FLIGHT.inc(stage=stage)
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        record_error(stage, error_cause(e))
+        raise
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage=stage)
+        STAGE_IN_FLIGHT.dec(stage=stage)
+
+
+def timed(stage: str):
+    """装饰器版本的 track"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with track(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+"""
+调色板量化：把生成的图像压缩到有限的调色板，并保存为索引色（P 模式）PNG
+
+提示词要求纯白背景和平涂的像素画，但模型输出的是带噪点的 24 位 RGB 图像。
+这里用 NumPy 向量化的加权 k-means 在图像的去重颜色上求调色板，
+也可以改为吸附到整个项目共享的调色板，让一套素材的颜色保持一致。
+"""
+
+import sys
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+from typing import Iterable, List, Optional
+
+import numpy as np
+from PIL import Image
+
+from image_store import DERIVED_SUFFIXES
+
+# alpha 低于该值的像素视为透明，统一映射到调色板的透明索引
+ALPHA_THRESHOLD = 128
+# 索引色 PNG 最多 256 个索引，其中一个要留给透明色
+MAX_COLORS = 255
+
+
+def _pack(rgb: np.ndarray) -> np.ndarray:
+    """把 (..., 3) 的 RGB 数组打包成整数，便于一维去重"""
+    rgb = rgb.astype(np.int32)
+    return (rgb[..., 0] << 16) | (rgb[..., 1] << 8) | rgb[..., 2]
+
+
+def _unpack(packed: np.ndarray) -> np.ndarray:
+    return np.stack([(packed >> 16) & 0xFF, (packed >> 8) & 0xFF, packed & 0xFF], axis=-1)
+
+
+def _nearest(colors: np.ndarray, centers: np.ndarray) -> np.ndarray:
+    """每个颜色最近的中心索引；用 |a|² - 2ab + |b|² 展开，只分配 (颜色数, 中心数) 的矩阵"""
+    distances = (
+        (colors ** 2).sum(axis=1)[:, None]
+        - 2 * colors @ centers.T
+        + (centers ** 2).sum(axis=1)[None, :]
+    )
+    return np.argmin(distances, axis=1)
+
+
+def kmeans_palette(colors: np.ndarray, weights: np.ndarray, n_colors: int,
+                   iterations: int = 20, seed: int = 0) -> np.ndarray:
+    """
+    加权 k-means 求调色板
+
+    Args:
+        colors: (N, 3) 去重后的颜色
+        weights: (N,) 每个颜色出现的次数
+        n_colors: 调色板大小
+        iterations: 最大迭代次数
+        seed: k-means++ 初始化的随机种子，固定后结果可复现
+
+    Returns:
+        np.ndarray: (<=n_colors, 3) 的 uint8 调色板
+    """
+    if len(colors) <= n_colors:
+        return colors.astype(np.uint8)
+
+    points = colors.astype(np.float64)
+    weights = weights.astype(np.float64)
+    rng = np.random.default_rng(seed)
+
+    # k-means++ 初始化：按到已选中心的距离平方（乘以权重）抽样
+    centers = [points[np.argmax(weights)]]
+    closest = ((points - centers[0]) ** 2).sum(axis=1)
+    for _ in range(1, n_colors):
+        probabilities = closest * weights
+        total = probabilities.sum()
+        if total <= 0:
+            break
+        center = points[rng.choice(len(points), p=probabilities / total)]
+        centers.append(center)
+        closest = np.minimum(closest, ((points - center) ** 2).sum(axis=1))
+    centers = np.array(centers)
+
+    for _ in range(iterations):
+        labels = _nearest(points, centers)
+        counts = np.bincount(labels, weights=weights, minlength=len(centers))
+        sums = np.stack([
+            np.bincount(labels, weights=weights * points[:, channel], minlength=len(centers))
+            for channel in range(3)
+        ], axis=1)
+        # 空簇保留原来的中心
+        updated = np.where(counts[:, None] > 0, sums / np.maximum(counts, 1e-9)[:, None], centers)
+        if np.allclose(updated, centers, atol=0.5):
+            centers = updated
+            break
+        centers = updated
+
+    return np.unique(np.clip(np.rint(centers), 0, 255).astype(np.uint8), axis=0)
+
+
+def _split_alpha(img: Image.Image):
+    """返回 (RGB 数组, 不透明掩码)；没有透明度时掩码为 None"""
+    if img.mode in ("RGBA", "LA") or "transparency" in img.info:
+        rgba = np.asarray(img.convert("RGBA"))
+        return rgba[..., :3], rgba[..., 3] >= ALPHA_THRESHOLD
+    return np.asarray(img.convert("RGB")), None
+
+
+def image_palette(img: Image.Image, n_colors: int = 16) -> np.ndarray:
+    """求单张图像的调色板（忽略透明像素）"""
+    rgb, opaque = _split_alpha(img)
+    packed = _pack(rgb if opaque is None else rgb[opaque])
+    unique, counts = np.unique(packed.ravel(), return_counts=True)
+    return kmeans_palette(_unpack(unique), counts, n_colors)
+
+
+def build_palette(paths: Iterable, n_colors: int = 16) -> np.ndarray:
+    """
+    从一组图像求共享的项目调色板
+
+    所有图像的去重颜色及出现次数合并后再做一次 k-means，
+    每张图的像素数相同时，出现频率高的颜色在调色板里占的位置也更多。
+    """
+    packed_counts = {}
+    for path in paths:
+        rgb, opaque = _split_alpha(Image.open(path))
+        unique, counts = np.unique(_pack(rgb if opaque is None else rgb[opaque]).ravel(), return_counts=True)
+        for color, count in zip(unique.tolist(), counts.tolist()):
+            packed_counts[color] = packed_counts.get(color, 0) + count
+    if not packed_counts:
+        raise ValueError("没有可用于生成调色板的图像")
+    colors = np.fromiter(packed_counts.keys(), dtype=np.int64)
+    counts = np.fromiter(packed_counts.values(), dtype=np.int64)
+    return kmeans_palette(_unpack(colors), counts, n_colors)
+
+
+@lru_cache(maxsize=8)
+def load_palette(path: str) -> np.ndarray:
+    """
+    读取调色板文件
+
+    支持每行一个十六进制颜色的 .hex/.txt、GIMP 的 .gpl，以及直接使用一张图像（取其中所有颜色）。
+    """
+    path = Path(path)
+    suffix = path.suffix.lower()
+    if suffix in (".png", ".gif", ".bmp"):
+        rgb, opaque = _split_alpha(Image.open(path))
+        unique = np.unique(_pack(rgb if opaque is None else rgb[opaque]).ravel())
+        colors = _unpack(unique)
+    else:
+        colors = []
+        for line in path.read_text(encoding="utf-8").splitlines():
+            line = line.strip()
+            if suffix == ".gpl":
+                # GIMP 调色板：跳过文件头和注释，只取 "R G B 名称" 行
+                parts = line.split()
+                if len(parts) >= 3 and all(part.isdigit() for part in parts[:3]):
+                    colors.append([int(part) for part in parts[:3]])
+            elif line and not line.startswith(";"):
+                # RRGGBB，或 Paint.NET 的 AARRGGBB
+                value = line.lstrip("#")[-6:]
+                colors.append([int(value[i:i + 2], 16) for i in (0, 2, 4)])
+        colors = np.array(colors)
+    if len(colors) == 0 or len(colors) > 256:
+        raise ValueError(f"调色板 {path} 必须包含 1 到 256 种颜色")
+    return colors.astype(np.uint8)
+
+
+def save_palette(palette: np.ndarray, path) -> Path:
+    """把调色板保存为每行一个十六进制颜色的 .hex 文件"""
+    path = Path(path)
+    path.write_text("".join(f"{r:02x}{g:02x}{b:02x}\n" for r, g, b in palette.tolist()), encoding="utf-8")
+    return path
+
+
+def quantize_image(img: Image.Image, n_colors: int = 16, palette: Optional[np.ndarray] = None) -> Image.Image:
+    """
+    把图像量化为索引色图像
+
+    Args:
+        img: 原始图像
+        n_colors: 没有指定 palette 时，为该图像求的调色板大小
+        palette: 共享调色板，指定后所有像素吸附到其中最近的颜色
+
+    Returns:
+        PIL.Image: P 模式图像；原图有透明度时，索引 0 为透明色
+    """
+    rgb, opaque = _split_alpha(img)
+    if palette is None:
+        palette = image_palette(img, n_colors)
+    if len(palette) > 256:
+        raise ValueError("索引色 PNG 的调色板最多 256 种颜色")
+    if opaque is not None and len(palette) > MAX_COLORS:
+        raise ValueError(f"带透明度的图像需要预留一个透明索引，调色板最多 {MAX_COLORS} 种颜色")
+
+    # 只对去重后的颜色求最近的调色板颜色，再按 inverse 映射回像素
+    unique, inverse = np.unique(_pack(rgb).ravel(), return_inverse=True)
+    indices = _nearest(_unpack(unique).astype(np.float64), palette.astype(np.float64))[inverse]
+    indices = indices.reshape(rgb.shape[:2])
+
+    colors = palette.tolist()
+    if opaque is not None:
+        indices = np.where(opaque, indices + 1, 0)
+        colors = [[0, 0, 0]] + colors
+    result = Image.frombytes("P", img.size, indices.astype(np.uint8).tobytes())
+    result.putpalette([channel for color in colors for channel in color])
+    if opaque is not None:
+        result.info["transparency"] = 0
+    return result
+
+
+def save_indexed_image(image_path, img: Image.Image = None, n_colors: int = 16,
+                       palette: Optional[np.ndarray] = None, output_path=None) -> Path:
+    """
+    量化图像并保存为索引色 PNG（默认保存到原图旁边：<文件名>_indexed.png）
+
+    Returns:
+        Path: 索引色 PNG 的路径
+    """
+    image_path = Path(image_path)
+    if img is None:
+        img = Image.open(image_path)
+    indexed = quantize_image(img, n_colors, palette)
+    output_path = Path(output_path) if output_path else image_path.with_name(f"{image_path.stem}_indexed.png")
+    save_kwargs = {"format": "PNG", "optimize": True}
+    if "transparency" in indexed.info:
+        save_kwargs["transparency"] = indexed.info["transparency"]
+    indexed.save(output_path, **save_kwargs)
+    return output_path
+
+
+def _quantize_file(args):
+    """进程池任务：量化单个文件，返回 (源文件, 输出文件, 源大小, 输出大小)"""
+    image_path, output_path, n_colors, palette = args
+    output_path = save_indexed_image(image_path, n_colors=n_colors, palette=palette, output_path=output_path)
+    return str(image_path), str(output_path), Path(image_path).stat().st_size, output_path.stat().st_size
+
+
+def quantize_directory(input_dir, output_dir=None, n_colors: int = 16,
+                       palette: Optional[np.ndarray] = None, workers: int = None) -> List[tuple]:
+    """
+    用多个进程量化目录中的所有 PNG
+
+    Args:
+        input_dir: 源目录（跳过后处理生成的派生文件）
+        output_dir: 输出目录；为空时保存到原图旁边（<文件名>_indexed.png）
+        n_colors: 每张图的调色板大小（未指定 palette 时）
+        palette: 共享调色板
+        workers: 进程数，默认为 CPU 核数
+
+    Returns:
+        list: 每个文件的 (源文件, 输出文件, 源大小, 输出大小)
+    """
+    input_dir = Path(input_dir)
+    if output_dir:
+        output_dir = Path(output_dir)
+        output_dir.mkdir(parents=True, exist_ok=True)
+    tasks = []
+    for image_path in sorted(input_dir.rglob("*.png")):
+        if image_path.stem.endswith(DERIVED_SUFFIXES):
+            continue
+        output_path = output_dir / image_path.name if output_dir else None
+        tasks.append((image_path, output_path, n_colors, palette))
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(_quantize_file, tasks, chunksize=4))
+
+
+def main(argv=None):
+    """主函数：批量量化目录，或从目录生成共享调色板"""
+    parser = argparse.ArgumentParser(description="把生成的图像量化为索引色 PNG")
+    parser.add_argument("input_dir", help="包含 PNG 的目录")
+    parser.add_argument("--output-dir", help="输出目录（默认保存到原图旁边，后缀 _indexed）")
+    parser.add_argument("--colors", type=int, default=16, help="调色板大小（默认 16）")
+    parser.add_argument("--palette", help="共享调色板文件（.hex/.txt/.gpl 或图像）")
+    parser.add_argument("--build-palette", metavar="PATH",
+                        help="从目录中的所有图像生成共享调色板并保存为 .hex，然后用它量化")
+    parser.add_argument("--workers", type=int, help="进程数（默认 CPU 核数）")
+    args = parser.parse_args(argv)
+
+    if not 1 <= args.colors <= MAX_COLORS:
+        parser.error(f"--colors 必须在 1 到 {MAX_COLORS} 之间")
+
+    palette = None
+    if args.build_palette:
+        sources = [path for path in sorted(Path(args.input_dir).rglob("*.png"))
+                   if not path.stem.endswith(DERIVED_SUFFIXES)]
+        palette = build_palette(sources, args.colors)
+        print(f"🎨 已生成 {len(palette)} 色共享调色板: {save_palette(palette, args.build_palette)}")
+    elif args.palette:
+        palette = load_palette(args.palette)
+        print(f"🎨 使用共享调色板 {args.palette}（{len(palette)} 色）")
+
+    results = quantize_directory(args.input_dir, args.output_dir, args.colors, palette, args.workers)
+    before = sum(result[2] for result in results)
+    after = sum(result[3] for result in results)
+    print(f"✅ 已量化 {len(results)} 张图像: {before / 1024:.1f} KiB -> {after / 1024:.1f} KiB")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
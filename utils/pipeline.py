@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+"""
+进程内的生成流水线：提示词扩展 -> 图像生成 -> 保存 -> 后处理（可选）
+
+gen_all.py 和 api/main.py 共用这一套阶段实现，不再为每个阶段启动子进程，
+也不再通过 prompt.json 在阶段之间传递数据。
+"""
+
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from functools import partial
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import gen_prompt
+import gen_images
+from metrics import track
+from singleflight import coalesce_enabled, get_flight, request_key
+
+try:
+    from config import Config
+except ImportError:
+    Config = None
+
+
+# 后处理步骤：(名称, func(image_path, img) -> 派生文件路径或 None)
+Postprocessor = Tuple[str, Callable[[Path, Any], Optional[Path]]]
+
+
+def default_postprocessors() -> List[Postprocessor]:
+    """根据配置启用的后处理步骤"""
+    postprocessors = []
+    if getattr(Config, "REMOVE_BACKGROUND", False):
+        import background
+        postprocessors.append(("alpha", partial(background.save_transparent_image,
+                                                tolerance=getattr(Config, "BACKGROUND_TOLERANCE", 24))))
+    if getattr(Config, "SAVE_NATIVE_SPRITE", False):
+        import pixel_grid
+        postprocessors.append(("native", pixel_grid.save_native_sprite))
+    palette_colors = getattr(Config, "PALETTE_COLORS", 0)
+    if palette_colors > 0:
+        import palette
+        if palette_colors > palette.MAX_COLORS:
+            print(f"⚠️  PALETTE_COLORS={palette_colors} 超出上限，按 {palette.MAX_COLORS} 种颜色量化")
+            palette_colors = palette.MAX_COLORS
+        palette_path = getattr(Config, "PALETTE_PATH", "")
+        shared_palette = palette.load_palette(palette_path) if palette_path else None
+        postprocessors.append(("indexed", partial(palette.save_indexed_image,
+                                                  n_colors=palette_colors, palette=shared_palette)))
+    return postprocessors
+
+
+class PipelineError(Exception):
+    """流水线某个阶段失败"""
+
+
+@dataclass
+class GenerationRequest:
+    """一次生成请求的输入"""
+    description: str
+    negative_requirements: str = ""
+    seed: int = -1
+    variants: int = 1
+
+
+@dataclass
+class GenerationRecord:
+    """提示词阶段的输出：完整的 txt2img 生成参数"""
+    positive: str
+    negative: str
+    steps: int = 8
+    cfg: float = 10.0
+    width: int = 512
+    height: int = 512
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "GenerationRecord":
+        return cls(
+            positive=data.get("positive", ""),
+            negative=data.get("negative", ""),
+            steps=data.get("steps", 8),
+            cfg=data.get("cfg", 10.0),
+            width=data.get("width", 512),
+            height=data.get("height", 512),
+        )
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "positive": self.positive,
+            "negative": self.negative,
+            "steps": self.steps,
+            "cfg": self.cfg,
+            "width": self.width,
+            "height": self.height,
+        }
+
+
+@dataclass
+class GenerationResult:
+    """整条流水线的输出"""
+    request: GenerationRequest
+    record: GenerationRecord
+    image_paths: List[Path]
+    timings: Dict[str, float] = field(default_factory=dict)
+    # 每张变体的派生文件，例如 {"native": Path(...)}
+    renditions: List[Dict[str, Path]] = field(default_factory=list)
+
+    @property
+    def image_path(self) -> Path:
+        """第一张变体的路径"""
+        return self.image_paths[0]
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "image_filename": self.image_path.name,
+            "image_filenames": [path.name for path in self.image_paths],
+            "renditions": [
+                {name: path.name for name, path in renditions.items()}
+                for renditions in self.renditions
+            ],
+            "positive_prompt": self.record.positive,
+            "negative_prompt": self.record.negative,
+            "steps": self.record.steps,
+            "cfg": self.record.cfg,
+            "seed": self.request.seed,
+            "timings": self.timings,
+        }
+
+
+class GenerationPipeline:
+    """
+    按阶段执行生成流程，并记录每个阶段的耗时
+
+    各阶段也可以单独调用（例如批量模式中由不同的线程池分别执行提示词阶段和图像阶段）。
+    """
+
+    STAGES = ("prompt", "image", "save", "postprocess")
+
+    def __init__(self, output_dir: str = None, postprocessors: Optional[List[Postprocessor]] = None):
+        self.output_dir = output_dir
+        self.postprocessors = default_postprocessors() if postprocessors is None else postprocessors
+
+    def expand_prompt(self, request: GenerationRequest) -> GenerationRecord:
+        """提示词阶段：调用 LLM 扩展描述，并与模板参数合并；相同描述的并发请求共享一次 LLM 调用"""
+        generate = partial(gen_prompt.generate_stable_diffusion_prompt,
+                           request.description, request.negative_requirements)
+        if coalesce_enabled("prompt"):
+            key = request_key(request.description, request.negative_requirements)
+            (positive, negative), _ = get_flight("prompt").do(key, generate)
+        else:
+            positive, negative = generate()
+        return GenerationRecord.from_dict(gen_prompt.build_prompt_record(positive, negative))
+
+    def render(self, request: GenerationRequest, record: GenerationRecord,
+               on_event: Optional[Callable[..., None]] = None):
+        """图像阶段：调用 Draw Things 生成图像，一次请求返回 request.variants 张变体"""
+        images = gen_images.call_draw_things_api_batch(
+            prompt=record.positive,
+            negative_prompt=record.negative,
+            steps=record.steps,
+            cfg=record.cfg,
+            width=record.width,
+            height=record.height,
+            seed=request.seed,
+            batch_size=request.variants,
+            on_event=on_event
+        )
+        if not images:
+            raise PipelineError("Image generation failed - check if Draw Things API is running")
+        return images
+
+    def save(self, images, request: GenerationRequest, record: GenerationRecord) -> List[Path]:
+        """保存阶段：写入每张变体的图像文件和图像索引"""
+        return [
+            Path(gen_images.save_image(
+                img,
+                output_dir=self.output_dir,
+                record=record.to_dict(),
+                seed=request.seed
+            ))
+            for img in images
+        ]
+
+    def postprocess(self, images, image_paths: List[Path]) -> List[Dict[str, Path]]:
+        """
+        后处理阶段：为每张变体生成派生文件（例如原生分辨率精灵），单个步骤失败不影响结果
+
+        保存阶段复用了已有文件的图像（img.reused），其派生文件 <文件名>_<步骤名>.png
+        已经存在时直接沿用：这些文件可能正被当作不可变资源读取，不能原地重写。
+        """
+        if not self.postprocessors:
+            return [{} for _ in image_paths]
+        renditions = []
+        with track("postprocess"):
+            for img, image_path in zip(images, image_paths):
+                derived = {}
+                for name, func in self.postprocessors:
+                    existing = image_path.with_name(f"{image_path.stem}_{name}.png")
+                    if getattr(img, "reused", False) and existing.exists():
+                        derived[name] = existing
+                        continue
+                    try:
+                        # 后处理需要像素：在这里才解码（每张图只解码一次）
+                        path = func(image_path, gen_images.decode_image(img))
+                    except Exception as e:
+                        print(f"⚠️  后处理 {name} 失败 ({image_path.name}): {e}")
+                        continue
+                    if path is not None:
+                        derived[name] = Path(path)
+                renditions.append(derived)
+        return renditions
+
+    def run(self, request: GenerationRequest,
+            on_stage: Optional[Callable[[str], None]] = None,
+            on_event: Optional[Callable[..., None]] = None) -> GenerationResult:
+        """
+        依次执行全部阶段
+
+        Args:
+            request: 生成请求
+            on_stage: 每个阶段开始前调用的回调，参数为阶段名；回调抛出的异常会终止流水线
+            on_event: 进度事件回调 on_event(event, **data)，依次收到 prompt_expanded、
+                      image_queued、rendering（以及可选的 progress 预览）、image_generated、saved，
+                      启用后处理时最后还有 postprocessed
+
+        Returns:
+            GenerationResult: 生成结果，timings 中包含各阶段耗时（秒）
+        """
+        timings = {}
+        emit = on_event or (lambda event, **data: None)
+
+        with self._stage("prompt", timings, on_stage):
+            record = self.expand_prompt(request)
+        emit("prompt_expanded", positive=record.positive, negative=record.negative,
+             seconds=timings["prompt"])
+
+        emit("image_queued")
+        with self._stage("image", timings, on_stage):
+            images = self.render(request, record, on_event)
+        emit("image_generated", count=len(images), seconds=timings["image"])
+
+        with self._stage("save", timings, on_stage):
+            image_paths = self.save(images, request, record)
+        emit("saved", image_filenames=[path.name for path in image_paths], seconds=timings["save"])
+
+        renditions = [{} for _ in image_paths]
+        if self.postprocessors:
+            with self._stage("postprocess", timings, on_stage):
+                renditions = self.postprocess(images, image_paths)
+            emit("postprocessed", renditions=[{name: path.name for name, path in derived.items()}
+                                              for derived in renditions],
+                 seconds=timings["postprocess"])
+
+        timings["total"] = sum(timings.values())
+        return GenerationResult(request, record, image_paths, timings, renditions)
+
+    @contextmanager
+    def _stage(self, name: str, timings: Dict[str, float], on_stage=None):
+        if on_stage is not None:
+            on_stage(name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            timings[name] = time.perf_counter() - start
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""
+检测 AI 生成像素画的有效像素网格，并把图像缩小到真实的精灵分辨率
+
+像素画 LoRA 输出的 512x512 图像实际上是约 32x32 到 64x64 的精灵放大后的结果。
+这里用 NumPy 向量化地统计相邻像素的颜色突变（边缘）和同色游程长度，推断网格大小与偏移，
+再把每个网格单元缩成它的主色，得到原生分辨率的精灵图。
+"""
+
+import sys
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+from PIL import Image
+
+# 相邻像素各通道差值之和超过该值时视为颜色突变
+EDGE_THRESHOLD = 48
+# 计算主色前每个通道丢弃的低位数，合并肉眼不可分辨的噪点颜色
+QUANTIZE_SHIFT = 3
+
+
+@dataclass
+class PixelGrid:
+    """检测到的像素网格"""
+    cell_size: int
+    offset_x: int
+    offset_y: int
+    cols: int
+    rows: int
+    confidence: float
+
+
+def _edge_profiles(arr: np.ndarray):
+    """每一列 / 每一行边界上出现颜色突变的比例"""
+    col_diff = np.abs(np.diff(arr, axis=1)).sum(axis=2) > EDGE_THRESHOLD
+    row_diff = np.abs(np.diff(arr, axis=0)).sum(axis=2) > EDGE_THRESHOLD
+    return col_diff, row_diff
+
+
+def _phase_scores(profile: np.ndarray, cell_size: int):
+    """
+    把边缘比例按 (位置 + 1) % cell_size 分组求均值
+
+    Returns:
+        tuple: (最佳偏移, 网格边界处的平均边缘比例 - 其余位置的平均边缘比例)
+    """
+    positions = np.arange(1, len(profile) + 1)
+    phases = positions % cell_size
+    counts = np.bincount(phases, minlength=cell_size)
+    sums = np.bincount(phases, weights=profile, minlength=cell_size)
+    means = sums / np.maximum(counts, 1)
+    best = int(np.argmax(means))
+    others = (sums.sum() - sums[best]) / max(counts.sum() - counts[best], 1)
+    return best, float(means[best] - others)
+
+
+def _run_length_agreement(edges: np.ndarray, cell_size: int) -> float:
+    """同色游程长度接近 cell_size 整数倍的比例"""
+    rows, cols = np.nonzero(edges)
+    if len(cols) < 2:
+        return 0.0
+    # 同一行内相邻两个边缘之间的距离就是一段同色游程的长度
+    same_row = rows[1:] == rows[:-1]
+    lengths = (cols[1:] - cols[:-1])[same_row]
+    if len(lengths) == 0:
+        return 0.0
+    remainder = lengths % cell_size
+    distance = np.minimum(remainder, cell_size - remainder)
+    return float(np.mean(distance <= max(1, cell_size // 8)))
+
+
+def detect_grid(img: Image.Image, min_cell: int = 2, max_cell: int = 32, min_cells: int = 8) -> PixelGrid:
+    """
+    检测图像的像素网格
+
+    Args:
+        img: PIL 图像
+        min_cell: 最小网格尺寸（像素）
+        max_cell: 最大网格尺寸（像素）
+        min_cells: 每个方向至少需要的网格数
+
+    Returns:
+        PixelGrid: 检测结果；没有明显网格时 cell_size 为 1
+    """
+    arr = np.asarray(img.convert("RGB"), dtype=np.int16)
+    height, width = arr.shape[:2]
+    col_edges, row_edges = _edge_profiles(arr)
+    col_profile = col_edges.mean(axis=0)
+    row_profile = row_edges.mean(axis=1)
+
+    best = PixelGrid(1, 0, 0, width, height, 0.0)
+    best_score = 0.0
+    max_cell = min(max_cell, width // min_cells, height // min_cells)
+    for cell_size in range(min_cell, max_cell + 1):
+        offset_x, contrast_x = _phase_scores(col_profile, cell_size)
+        offset_y, contrast_y = _phase_scores(row_profile, cell_size)
+        contrast = (contrast_x + contrast_y) / 2
+        if contrast <= 0:
+            continue
+        agreement = (_run_length_agreement(col_edges, cell_size) + _run_length_agreement(row_edges.T, cell_size)) / 2
+        score = contrast * agreement
+        if score > best_score:
+            best_score = score
+            best = PixelGrid(
+                cell_size=cell_size,
+                offset_x=offset_x,
+                offset_y=offset_y,
+                cols=(width - offset_x) // cell_size,
+                rows=(height - offset_y) // cell_size,
+                confidence=round(score, 4),
+            )
+    return best
+
+
+def _cell_modes(cells: np.ndarray) -> np.ndarray:
+    """对二维数组的每一行求众数（向量化：排序后找最长的相同值游程）"""
+    ordered = np.sort(cells, axis=1)
+    index = np.arange(ordered.shape[1])
+    starts = np.ones_like(ordered, dtype=bool)
+    starts[:, 1:] = ordered[:, 1:] != ordered[:, :-1]
+    run_start = np.maximum.accumulate(np.where(starts, index, 0), axis=1)
+    run_length = index - run_start + 1
+    return ordered[np.arange(len(ordered)), np.argmax(run_length, axis=1)]
+
+
+def downscale_to_grid(img: Image.Image, grid: PixelGrid) -> Image.Image:
+    """
+    按网格把每个单元缩成一个像素，颜色取该单元的主色
+
+    Args:
+        img: 原始图像
+        grid: detect_grid 的结果
+
+    Returns:
+        PIL.Image: 原生分辨率的精灵图（cols x rows）
+    """
+    mode = "RGBA" if img.mode in ("RGBA", "LA") or "transparency" in img.info else "RGB"
+    arr = np.asarray(img.convert(mode), dtype=np.int64)
+    size = grid.cell_size
+    channels = arr.shape[2]
+    region = arr[grid.offset_y:grid.offset_y + grid.rows * size,
+                 grid.offset_x:grid.offset_x + grid.cols * size]
+    # (rows, size, cols, size, C) -> (rows * cols, size * size, C)
+    cells = region.reshape(grid.rows, size, grid.cols, size, channels).transpose(0, 2, 1, 3, 4)
+    # 只取单元中心区域，避开生成模型在网格边界处留下的模糊过渡色
+    margin = size // 4
+    cells = cells[:, :, margin:size - margin, margin:size - margin]
+    inner = size - 2 * margin
+    cells = cells.reshape(grid.rows * grid.cols, inner * inner, channels)
+
+    # 量化后打包成一个整数求众数，再取属于众数的原始颜色的平均值
+    quantized = cells >> QUANTIZE_SHIFT
+    bits = 8 - QUANTIZE_SHIFT
+    packed = np.zeros(quantized.shape[:2], dtype=np.int64)
+    for channel in range(channels):
+        packed = (packed << bits) | quantized[:, :, channel]
+    dominant = _cell_modes(packed)
+    mask = packed == dominant[:, None]
+    colors = (cells * mask[:, :, None]).sum(axis=1) / mask.sum(axis=1)[:, None]
+
+    sprite = np.rint(colors).astype(np.uint8).reshape(grid.rows, grid.cols, channels)
+    return Image.fromarray(sprite)
+
+
+def save_native_sprite(image_path, img: Image.Image = None, min_confidence: float = 0.05) -> Optional[Path]:
+    """
+    检测网格并把原生分辨率精灵保存到原图旁边（<文件名>_native.png）
+
+    Args:
+        image_path: 原图路径
+        img: 已解码的原图（可选，避免重复读取）
+        min_confidence: 最低置信度，低于它时认为没有可靠的网格
+
+    Returns:
+        Path: 精灵图路径；未检测到网格时返回 None
+    """
+    image_path = Path(image_path)
+    if img is None:
+        img = Image.open(image_path)
+    grid = detect_grid(img)
+    if grid.cell_size < 2 or grid.confidence < min_confidence:
+        return None
+    sprite = downscale_to_grid(img, grid)
+    native_path = image_path.with_name(f"{image_path.stem}_native.png")
+    sprite.save(native_path, format="PNG", optimize=True)
+    return native_path
+
+
+def main():
+    """主函数：为命令行给出的图像生成原生分辨率精灵"""
+    if len(sys.argv) < 2:
+        print("用法: python pixel_grid.py <image.png> [...]")
+        sys.exit(1)
+    for path in sys.argv[1:]:
+        img = Image.open(path)
+        grid = detect_grid(img)
+        print(f"🔍 {path}: 网格 {grid.cell_size}px, 偏移 ({grid.offset_x}, {grid.offset_y}), "
+              f"{grid.cols}x{grid.rows}, 置信度 {grid.confidence}")
+        native_path = save_native_sprite(path, img)
+        if native_path:
+            print(f"💾 精灵图已保存到: {native_path}")
+        else:
+            print("⚠️  未检测到可靠的像素网格")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+"""
+LLM 提示词扩展结果的缓存：内存 LRU + 可选的 SQLite 持久化存储，
+相同的描述无需再次调用 LM Studio
+"""
+
+import os
+import sys
+import json
+import sqlite3
+import hashlib
+import threading
+import time
+import inspect
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+# Get the project root directory to import config
+current_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parent_dir = os.path.dirname(current_dir)
+if parent_dir not in sys.path:
+    sys.path.insert(0, parent_dir)
+
+try:
+    from config import Config
+    PROMPT_CACHE_SIZE = Config.PROMPT_CACHE_SIZE
+    PROMPT_CACHE_TTL = Config.PROMPT_CACHE_TTL
+    PROMPT_CACHE_PATH = Config.PROMPT_CACHE_PATH
+    PROMPT_CACHE_STORE_SIZE = Config.PROMPT_CACHE_STORE_SIZE
+except ImportError:
+    # Fallback to defaults if config is not available
+    PROMPT_CACHE_SIZE = 1024
+    PROMPT_CACHE_TTL = 7 * 24 * 3600
+    PROMPT_CACHE_PATH = ""
+    PROMPT_CACHE_STORE_SIZE = 100000
+
+# 每写入这么多条记录清理一次持久化存储中过期和超出上限的行
+STORE_PRUNE_INTERVAL = 256
+
+
+def normalize_text(text: str) -> str:
+    """统一大小写和空白，使 "Sword  Icon" 与 "sword icon" 命中同一条缓存"""
+    return " ".join((text or "").lower().split())
+
+
+class PromptCache:
+    """
+    (positive, negative) 提示词对的缓存
+
+    内存中保存最近使用的 max_entries 条记录（LRU 淘汰）；配置了 store_path 时，
+    所有记录同时写入 SQLite，进程重启后仍可命中。ttl 为 0 表示永不过期。
+    SQLite 中最多保留 store_max_entries 条最新的记录（0 表示不限），过期的行在打开存储、
+    读到时和定期写入时删除。
+    """
+
+    def __init__(self, max_entries: int = None, ttl: float = None, store_path: str = None,
+                 store_max_entries: int = None):
+        self.max_entries = max(1, int(max_entries if max_entries is not None else PROMPT_CACHE_SIZE))
+        self.ttl = float(ttl if ttl is not None else PROMPT_CACHE_TTL)
+        self.store_path = store_path if store_path is not None else PROMPT_CACHE_PATH
+        self.store_max_entries = max(0, int(
+            store_max_entries if store_max_entries is not None else PROMPT_CACHE_STORE_SIZE))
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        if self.store_path:
+            self._init_store()
+
+    @staticmethod
+    def make_key(user_description: str, negative_requirements: str, model_name: str, system_prompt: str) -> str:
+        """根据规范化后的描述、负面要求、模型名和系统提示生成缓存键"""
+        payload = json.dumps([
+            normalize_text(user_description),
+            normalize_text(negative_requirements),
+            model_name,
+            system_prompt,
+        ], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[Tuple[str, str]]:
+        """
+        查找缓存
+
+        Returns:
+            tuple: (positive_prompt, negative_prompt)，未命中或已过期时返回 None
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if self._expired(entry[2], now):
+                    del self._entries[key]
+                else:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[0], entry[1]
+
+        entry = self._load(key) if self.store_path else None
+        if entry is not None and self._expired(entry[2], now):
+            self._delete(key)
+            entry = None
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self._remember(key, entry)
+            self.hits += 1
+            return entry[0], entry[1]
+
+    def put(self, key: str, value: Tuple[str, str]):
+        """写入一条缓存记录"""
+        entry = (value[0], value[1], time.time())
+        with self._lock:
+            self._remember(key, entry)
+            self._writes += 1
+            prune = self._writes % STORE_PRUNE_INTERVAL == 0
+        if self.store_path:
+            self._save(key, entry)
+            if prune:
+                self.prune()
+
+    def prune(self) -> int:
+        """
+        删除持久化存储中过期的记录，以及超出 store_max_entries 的最旧记录
+
+        Returns:
+            int: 删除的行数
+        """
+        if not self.store_path:
+            return 0
+        try:
+            conn = self._connect()
+            with conn:
+                deleted = 0
+                if self.ttl > 0:
+                    deleted += conn.execute(
+                        "DELETE FROM prompt_cache WHERE created_at < ?", (time.time() - self.ttl,)
+                    ).rowcount
+                if self.store_max_entries:
+                    deleted += conn.execute(
+                        "DELETE FROM prompt_cache WHERE key IN ("
+                        "SELECT key FROM prompt_cache ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                        (self.store_max_entries,),
+                    ).rowcount
+            return deleted
+        except sqlite3.Error as e:
+            print(f"⚠️  清理提示词缓存失败: {e}")
+            return 0
+
+    def clear(self):
+        """清空内存和持久化存储中的全部记录"""
+        with self._lock:
+            self._entries.clear()
+        if self.store_path:
+            conn = self._connect()
+            with conn:
+                conn.execute("DELETE FROM prompt_cache")
+
+    def stats(self) -> Dict[str, float]:
+        """返回命中/未命中计数等统计信息"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "size": len(self._entries),
+                "max_entries": self.max_entries,
+            }
+
+    def _expired(self, created_at: float, now: float) -> bool:
+        return self.ttl > 0 and now - created_at > self.ttl
+
+    def _remember(self, key: str, entry: tuple):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.store_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def _init_store(self):
+        store_dir = os.path.dirname(os.path.abspath(self.store_path))
+        os.makedirs(store_dir, exist_ok=True)
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS prompt_cache ("
+                "key TEXT PRIMARY KEY, positive TEXT NOT NULL, negative TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS prompt_cache_created_at ON prompt_cache (created_at)")
+        self.prune()
+
+    def _load(self, key: str) -> Optional[tuple]:
+        try:
+            return self._connect().execute(
+                "SELECT positive, negative, created_at FROM prompt_cache WHERE key = ?", (key,)
+            ).fetchone()
+        except sqlite3.Error as e:
+            print(f"⚠️  读取提示词缓存失败: {e}")
+            return None
+
+    def _delete(self, key: str):
+        try:
+            conn = self._connect()
+            with conn:
+                conn.execute("DELETE FROM prompt_cache WHERE key = ?", (key,))
+        except sqlite3.Error as e:
+            print(f"⚠️  删除提示词缓存失败: {e}")
+
+    def _save(self, key: str, entry: tuple):
+        try:
+            conn = self._connect()
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO prompt_cache (key, positive, negative, created_at) VALUES (?, ?, ?, ?)",
+                    (key, *entry),
+                )
+        except sqlite3.Error as e:
+            print(f"⚠️  写入提示词缓存失败: {e}")
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_prompt_cache() -> PromptCache:
+    """获取进程内共享的提示词缓存"""
+    global _default_cache
+    if _default_cache is None:
+        with _default_cache_lock:
+            if _default_cache is None:
+                _default_cache = PromptCache()
+    return _default_cache
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+相同请求的合并执行（single flight）
+
+同一个键同时只有一次计算在进行：第一个调用者执行，其余并发调用者挂到这次计算上等待，
+拿到同一个结果（或同一个异常）。计算结束后键立即释放，这里不缓存结果，缓存由各阶段自己负责。
+"""
+
+import os
+import sys
+import inspect
+import threading
+from typing import Any, Callable, Dict, Hashable, Tuple
+
+from metrics import COALESCED_REQUESTS
+from prompt_cache import normalize_text
+
+# Get the project root directory to import config
+current_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parent_dir = os.path.dirname(current_dir)
+if parent_dir not in sys.path:
+    sys.path.insert(0, parent_dir)
+
+try:
+    from config import Config
+    COALESCE_MODE = Config.COALESCE_MODE
+except ImportError:
+    # Fallback to defaults if config is not available
+    COALESCE_MODE = "pipeline"
+
+# off: 不合并；prompt: 只合并提示词扩展；pipeline: 合并整条生成流水线（也包含提示词扩展）
+COALESCE_MODES = ("off", "prompt", "pipeline")
+
+
+def coalesce_enabled(stage: str) -> bool:
+    """当前配置下某个阶段（"prompt" 或 "pipeline"）是否合并相同请求"""
+    mode = COALESCE_MODE if COALESCE_MODE in COALESCE_MODES else "off"
+    return COALESCE_MODES.index(mode) >= COALESCE_MODES.index(stage)
+
+
+def request_key(description: str, negative_requirements: str = "", **params) -> Tuple:
+    """由归一化后的描述、负面要求和其余参数组成的合并键（规范化方式与提示词缓存相同）"""
+    return (normalize_text(description), normalize_text(negative_requirements)) + tuple(sorted(params.items()))
+
+
+class _Call:
+    """一次进行中的计算"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.followers = 0
+
+
+class SingleFlight:
+    """按键合并并发调用"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._calls: Dict[Hashable, _Call] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: Hashable, func: Callable[[], Any]) -> Tuple[Any, bool]:
+        """
+        执行 func，或者等待同一个键上已经在进行的那次执行
+
+        Args:
+            key: 合并键
+            func: 无参数的计算函数
+
+        Returns:
+            tuple: (结果, 是否复用了其他调用者的计算)
+
+        Raises:
+            Exception: func 抛出的异常会同时抛给所有等待者
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                call.followers += 1
+
+        if leader:
+            try:
+                call.result = func()
+                return call.result, False
+            except BaseException as e:
+                call.error = e
+                raise
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+
+        COALESCED_REQUESTS.inc(stage=self.name)
+        call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result, True
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._calls)
+
+
+_flights: Dict[str, SingleFlight] = {}
+_flights_lock = threading.Lock()
+
+
+def get_flight(stage: str) -> SingleFlight:
+    """获取某个阶段在进程内共享的 SingleFlight"""
+    with _flights_lock:
+        flight = _flights.get(stage)
+        if flight is None:
+            flight = _flights[stage] = SingleFlight(stage)
+        return flight